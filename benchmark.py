@@ -0,0 +1,96 @@
+"""
+ Copyright (c) 2022, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+"""
+
+import argparse
+import logging
+import sys
+
+import torch
+from omegaconf import OmegaConf
+
+from daiv.benchmarks import (
+    ALL_CASES,
+    TINY_CONFIGS,
+    compare_results,
+    load_results,
+    load_tiny_config,
+    log_comparison,
+    log_results,
+    run_benchmarks,
+    save_results,
+)
+from daiv.common.logger import setup_logger
+from daiv.common.utils import now
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="CPU benchmarks on tiny random BLIVA models")
+
+    parser.add_argument(
+        "--models",
+        nargs="+",
+        default=list(TINY_CONFIGS.keys()),
+        help="tiny config names ({}) or yaml paths.".format(", ".join(TINY_CONFIGS)),
+    )
+    parser.add_argument("--cases", nargs="+", default=ALL_CASES, choices=ALL_CASES)
+    parser.add_argument("--output", default=None, help="json file to write the results to.")
+    parser.add_argument("--baseline", default=None, help="json results to compare against.")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="relative slowdown of the median latency reported as a regression.",
+    )
+    parser.add_argument("--num-threads", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--assets-dir", default=None, help="where the tiny checkpoints are cached.")
+    parser.add_argument(
+        "--options",
+        nargs="+",
+        default=[],
+        help="override the tiny configs, e.g. benchmark.batch_size=4",
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    """
+    Benchmark forward, generate, predict_answers, predict_class, the VQA
+    dataloader and VQAEval on tiny randomly initialized configs, on cpu and
+    without downloads. Exits with status 1 when a baseline is given and a
+    benchmark regressed.
+    """
+    args = parse_args()
+    setup_logger()
+
+    torch.set_num_threads(args.num_threads)
+
+    results, configs = {}, {}
+    for name in args.models:
+        cfg = OmegaConf.merge(load_tiny_config(name), OmegaConf.from_dotlist(args.options))
+        configs[name] = OmegaConf.to_container(cfg)
+        results.update(
+            run_benchmarks(name, cfg, cases=args.cases, assets_dir=args.assets_dir, seed=args.seed)
+        )
+
+    log_results(results)
+
+    output = args.output or "benchmark_{}.json".format(now())
+    save_results(results, output, config=configs)
+    logging.info("Results written to {}".format(output))
+
+    if args.baseline is not None:
+        rows = compare_results(results, load_results(args.baseline), tolerance=args.tolerance)
+        log_comparison(rows)
+
+        if any(row["regression"] for row in rows):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+ Copyright (c) 2022, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+"""
+
+import argparse
+import contextlib
+import logging
+import sys
+
+import torch
+
+import daiv.models  # noqa: F401, registers the models
+from daiv.common.logger import setup_logger
+from daiv.common.registry import registry
+from daiv.models.dmformer.mcan.mca import MCA_ED, check_fast_parity
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="MCAN performance mode parity check")
+
+    parser.add_argument("--model", default="blip2", help="registered model whose MCAN Config is used.")
+    parser.add_argument("--checkpoint", default=None, help="checkpoint with MCAN.backbone weights.")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--text-len", type=int, default=32)
+    parser.add_argument("--image-len", type=int, default=257)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--atol", type=float, default=1e-4, help="tolerance in fp32.")
+    parser.add_argument("--amp-atol", type=float, default=5e-2, help="tolerance under fp16 autocast.")
+
+    return parser.parse_args()
+
+
+def main():
+    """
+    Compare MCA_ED.forward_fast with forward layer by layer, in fp32 and
+    (on GPU) under fp16 autocast, on random inputs with padded text. Exits
+    with status 1 if a layer differs by more than the tolerance.
+    """
+    args = parse_args()
+    setup_logger()
+    torch.manual_seed(0)
+
+    config = registry.get_model_class(args.model).Config
+    backbone = MCA_ED(config)
+    if args.checkpoint is not None:
+        state_dict = torch.load(args.checkpoint, map_location="cpu")
+        state_dict = state_dict.get("model", state_dict)
+        prefix = "MCAN.backbone."
+        backbone.load_state_dict({k[len(prefix) :]: v for k, v in state_dict.items() if k.startswith(prefix)})
+    backbone = backbone.to(args.device).eval()
+
+    bs, device = args.batch_size, args.device
+    x = torch.randn(bs, args.text_len, config.HIDDEN_SIZE, device=device)
+    y = torch.randn(bs, args.image_len, config.HIDDEN_SIZE, device=device)
+    # text of random lengths padded to text_len, images without padding
+    lengths = torch.randint(1, args.text_len + 1, (bs,), device=device)
+    x_mask = (torch.arange(args.text_len, device=device)[None, :] >= lengths[:, None])[:, None, None, :]
+    y_mask = torch.zeros(bs, 1, 1, args.image_len, dtype=torch.bool, device=device)
+
+    runs = [("fp32", contextlib.nullcontext(), args.atol)]
+    if device.startswith("cuda"):
+        runs.append(("fp16 autocast", torch.cuda.amp.autocast(dtype=torch.float16), args.amp_atol))
+
+    failed = False
+    for name, context, atol in runs:
+        with context:
+            diffs = check_fast_parity(backbone, x, y, x_mask, y_mask)
+        for layer, diff in diffs:
+            ok = diff <= atol
+            failed |= not ok
+            logging.info("{} {}: max abs diff {:.2e}{}".format(name, layer, diff, "" if ok else " FAILED"))
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+ Copyright (c) 2022, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+"""
+
+import argparse
+import contextlib
+import logging
+import sys
+import tempfile
+from types import SimpleNamespace
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, Dataset
+
+from daiv.common.logger import setup_logger
+from daiv.models.blip2 import compute_sim_matrix
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Chunked retrieval parity check")
+
+    parser.add_argument("--num-images", type=int, default=37)
+    parser.add_argument("--num-texts", type=int, default=83)
+    parser.add_argument("--k-test", type=int, default=8)
+    parser.add_argument("--chunk-size", type=int, default=10, help="gallery chunk size, small to cross chunks.")
+    parser.add_argument("--itm-batch-size", type=int, default=13)
+    parser.add_argument("--atol", type=float, default=1e-4)
+
+    return parser.parse_args()
+
+
+class _ToyTokenizer:
+    # texts are space-separated token ids, 0 is padding
+    def __call__(self, texts, padding="max_length", truncation=True, max_length=35, return_tensors="pt"):
+        input_ids = torch.zeros(len(texts), max_length, dtype=torch.long)
+        for i, text in enumerate(texts):
+            tokens = [int(token) for token in text.split()][:max_length]
+            input_ids[i, : len(tokens)] = torch.tensor(tokens)
+        return SimpleNamespace(input_ids=input_ids, attention_mask=(input_ids != 0).long())
+
+
+class _ToyModel(nn.Module):
+    """
+    The retrieval interface of Blip2Qformer (forward_text, forward_image,
+    compute_itm) on small random layers.
+    """
+
+    def __init__(self, vocab_size=50, vision_width=8, dim=16):
+        super().__init__()
+        self.tokenizer = _ToyTokenizer()
+        self.text_embedding = nn.Embedding(vocab_size, dim, padding_idx=0)
+        self.image_proj = nn.Linear(vision_width, dim)
+        self.itm_text = nn.Embedding(vocab_size, vision_width)
+
+    @property
+    def device(self):
+        return self.image_proj.weight.device
+
+    def maybe_autocast(self):
+        return contextlib.nullcontext()
+
+    def forward_text(self, text_tokens):
+        return self.text_embedding(text_tokens.input_ids).sum(1)
+
+    def forward_image(self, image):
+        return self.image_proj(image.mean(1)), image
+
+    def compute_itm(self, image_inputs, text_ids, text_atts):
+        text = (self.itm_text(text_ids) * text_atts.unsqueeze(-1)).sum(1)
+        return (image_inputs.mean(1) * text).sum(-1)
+
+
+class _ToyDataset(Dataset):
+    def __init__(self, num_images, num_texts, vocab_size=50, vision_width=8, num_patches=5):
+        self.images = torch.randn(num_images, num_patches, vision_width)
+        self.image = list(range(num_images))
+        self.text = [
+            " ".join(str(t) for t in torch.randint(1, vocab_size, (int(n),)).tolist())
+            for n in torch.randint(1, 12, (num_texts,))
+        ]
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        return {"image": self.images[index]}
+
+
+@torch.no_grad()
+def dense_reference(model, dataset, k_test):
+    """
+    The dense computation compute_sim_matrix replaced: full similarity
+    matrices, then ITM on the k_test candidates of one query at a time.
+    Embeddings and ViT features are rounded to fp16 as the index stores them.
+    """
+    tokens = model.tokenizer(dataset.text, max_length=35)
+    text_embeds = F.normalize(model.forward_text(tokens), dim=-1).half().float()
+    image_feats, vit_feats = model.forward_image(dataset.images)
+    image_embeds = F.normalize(image_feats, dim=-1).half().float()
+    vit_feats = vit_feats.half().float()
+
+    sims_matrix = image_embeds @ text_embeds.t()
+    score_matrix_i2t = torch.full(sims_matrix.shape, -100.0)
+    for i, sims in enumerate(sims_matrix):
+        topk_sim, topk_idx = sims.topk(k=k_test, dim=0)
+        score = model.compute_itm(
+            image_inputs=vit_feats[i].repeat(k_test, 1, 1),
+            text_ids=tokens.input_ids[topk_idx],
+            text_atts=tokens.attention_mask[topk_idx],
+        )
+        score_matrix_i2t[i, topk_idx] = score + topk_sim
+
+    sims_matrix = sims_matrix.t()
+    score_matrix_t2i = torch.full(sims_matrix.shape, -100.0)
+    for i, sims in enumerate(sims_matrix):
+        topk_sim, topk_idx = sims.topk(k=k_test, dim=0)
+        score = model.compute_itm(
+            image_inputs=vit_feats[topk_idx],
+            text_ids=tokens.input_ids[i].repeat(k_test, 1),
+            text_atts=tokens.attention_mask[i].repeat(k_test, 1),
+        )
+        score_matrix_t2i[i, topk_idx] = score + topk_sim
+
+    return score_matrix_i2t.numpy(), score_matrix_t2i.numpy()
+
+
+def main():
+    """
+    Compare compute_sim_matrix (chunked top-k and batched ITM re-ranking,
+    with in-memory, new on-disk and reused on-disk indexes) with the dense
+    computation on a toy gallery. Exits with status 1 if the top-k
+    candidates or their scores differ.
+    """
+    args = parse_args()
+    setup_logger()
+    torch.manual_seed(0)
+
+    model = _ToyModel().eval()
+    dataset = _ToyDataset(args.num_images, args.num_texts)
+    data_loader = DataLoader(dataset, batch_size=4)
+    expected = dense_reference(model, dataset, args.k_test)
+
+    failed = False
+    with tempfile.TemporaryDirectory() as index_dir:
+        for name, run_index_dir in [("in memory", None), ("on disk", index_dir), ("reused", index_dir)]:
+            scores = compute_sim_matrix(
+                model,
+                data_loader,
+                k_test=args.k_test,
+                index_dir=run_index_dir,
+                chunk_size=args.chunk_size,
+                itm_batch_size=args.itm_batch_size,
+            )
+            for direction, score, reference in zip(["i2t", "t2i"], scores, expected):
+                same_topk = ((score == -100.0) == (reference == -100.0)).all()
+                diff = abs(score - reference).max()
+                ok = bool(same_topk) and diff <= args.atol
+                failed |= not ok
+                logging.info(
+                    "{} {}: same top-k {}, max abs diff {:.2e}{}".format(
+                        name, direction, bool(same_topk), diff, "" if ok else " FAILED"
+                    )
+                )
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+ Copyright (c) 2022, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+from omegaconf import OmegaConf
+
+from daiv.common.logger import setup_logger
+from daiv.runners.runner_base import RunnerBase
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="ZeRO / FSDP checkpoint round trip on CPU")
+
+    parser.add_argument("--world-size", type=int, default=2)
+    parser.add_argument("--modes", nargs="+", default=["zero", "fsdp"], choices=["ddp", "zero", "fsdp"])
+    parser.add_argument("--port", default="29511")
+
+    return parser.parse_args()
+
+
+class _LoraLinear(nn.Linear):
+    # frozen bf16 base weight with a trainable fp32 low-rank update as a child, like peft
+    def __init__(self, dim, rank=2):
+        super().__init__(dim, dim, dtype=torch.bfloat16)
+        self.weight.requires_grad = False
+        self.bias.requires_grad = False
+        self.lora_A = nn.Linear(dim, rank, bias=False)
+        self.lora_B = nn.Linear(rank, dim, bias=False)
+
+    def forward(self, x):
+        return super().forward(x.to(self.weight.dtype)).float() + self.lora_B(self.lora_A(x))
+
+
+class _ToyModel(nn.Module):
+    """
+    Frozen bf16 encoder, LoRA layers mixing bf16 and fp32 parameters, and
+    trainable fp32 layers, as in bliva_vicuna_lora.
+    """
+
+    def __init__(self, dim=16):
+        super().__init__()
+        self.encoder = nn.Linear(dim, dim, dtype=torch.bfloat16)
+        self.encoder.requires_grad_(False)
+        self.llm = nn.Sequential(_LoraLinear(dim), _LoraLinear(dim))
+        self.proj = nn.Linear(dim, dim)
+        self.query = nn.Parameter(torch.randn(dim))
+
+    @property
+    def device(self):
+        return self.query.device
+
+    def forward(self, x):
+        x = self.encoder(x.to(torch.bfloat16)).float()
+        return (self.proj(self.llm(x)) + self.query).pow(2).mean()
+
+
+class _CheckRunner(RunnerBase):
+    # no datasets: gather_resume_states() skips the data positions
+    train_loader = None
+
+    def setup_output_dir(self):
+        pass
+
+
+def _build_runner(sharding):
+    torch.manual_seed(0)
+    run_cfg = OmegaConf.create(
+        {
+            "device": "cpu",
+            "distributed": True,
+            "sharding": sharding,
+            "gpu": None,
+            "init_lr": 1e-2,
+            "weight_decay": 0.05,
+            "fsdp_min_num_params": 1,
+        }
+    )
+    return _CheckRunner(SimpleNamespace(run_cfg=run_cfg), task=None, model=_ToyModel(), datasets=None, job_id="check")
+
+
+def _train_step(runner):
+    loss = runner.model(torch.randn(4, 16))
+    loss.backward()
+    runner.optimizer.step()
+    runner.optimizer.zero_grad()
+
+
+def _gathered_state(runner):
+    runner.gather_checkpoint_state()
+    state = runner.checkpoint_state_dicts() if dist.get_rank() == 0 else None
+    runner.clear_gathered_state()
+    return state
+
+
+def _differences(a, b, path=""):
+    if isinstance(a, dict) and isinstance(b, dict):
+        if a.keys() != b.keys():
+            return ["{}: keys {} != {}".format(path, sorted(map(str, a)), sorted(map(str, b)))]
+        return [d for k in a for d in _differences(a[k], b[k], "{}.{}".format(path, k))]
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        if len(a) != len(b):
+            return ["{}: length {} != {}".format(path, len(a), len(b))]
+        return [d for i, (x, y) in enumerate(zip(a, b)) for d in _differences(x, y, "{}[{}]".format(path, i))]
+    if isinstance(a, torch.Tensor) and isinstance(b, torch.Tensor):
+        return [] if a.shape == b.shape and torch.equal(a.cpu(), b.cpu()) else ["{}: tensors differ".format(path)]
+    return [] if a == b else ["{}: {} != {}".format(path, a, b)]
+
+
+def run(rank, world_size, port, modes, checkpoint_dir, failures):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = port
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    setup_logger()
+
+    for mode in modes:
+        # train a step and save a full checkpoint from rank 0
+        runner = _build_runner(mode)
+        torch.manual_seed(rank)
+        _train_step(runner)
+        model_state, optimizer_state = _gathered_state(runner) or (None, None)
+
+        checkpoint_path = os.path.join(checkpoint_dir, "{}.pth".format(mode))
+        if rank == 0:
+            torch.save({"model": model_state, "optimizer": optimizer_state}, checkpoint_path)
+        dist.barrier()
+
+        # reload it into a fresh runner on every rank and gather it again
+        runner = _build_runner(mode)
+        runner.load_checkpoint_state_dicts(torch.load(checkpoint_path, map_location="cpu"))
+        reloaded = _gathered_state(runner)
+
+        if rank == 0:
+            differences = _differences((model_state, optimizer_state), reloaded)
+            for difference in differences:
+                logging.error("{}: {}".format(mode, difference))
+            logging.info("{}: checkpoint round trip {}".format(mode, "FAILED" if differences else "ok"))
+            if differences:
+                failures.value += 1
+        dist.barrier()
+
+    dist.destroy_process_group()
+
+
+def main():
+    """
+    Save a checkpoint of a small model with mixed-dtype LoRA layers under
+    each sharding mode with world_size gloo processes on CPU, reload it in a
+    fresh runner and check that the gathered model and optimizer states are
+    unchanged. Exits with status 1 if a mode fails.
+    """
+    args = parse_args()
+
+    failures = mp.get_context("spawn").Value("i", 0)
+    with tempfile.TemporaryDirectory() as checkpoint_dir:
+        mp.spawn(
+            run,
+            args=(args.world_size, args.port, args.modes, checkpoint_dir, failures),
+            nprocs=args.world_size,
+        )
+
+    sys.exit(1 if failures.value else 0)
+
+
+if __name__ == "__main__":
+    main()
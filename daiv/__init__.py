@@ -12,9 +12,6 @@ from omegaconf import OmegaConf
 
 from daiv.common.registry import registry
 
-from daiv.models import *
-from daiv.processors import *
-
 
 root_dir = os.path.dirname(os.path.abspath(__file__))
 default_cfg = OmegaConf.load(os.path.join(root_dir, "configs/default.yaml"))
@@ -27,3 +24,10 @@ registry.register_path("cache_root", cache_root)
 
 registry.register("MAX_INT", sys.maxsize)
 registry.register("SPLIT_NAMES", ["train", "val", "test"])
+
+# declare where registered classes live; their modules are imported on first lookup
+import daiv.datasets.builders
+import daiv.models
+import daiv.processors
+import daiv.runners
+import daiv.tasks
@@ -0,0 +1,32 @@
+"""
+ Copyright (c) 2022, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+"""
+
+from daiv.benchmarks.cases import ALL_CASES, DATA_CASES, MODEL_CASES, measure, run_benchmarks
+from daiv.benchmarks.results import (
+    compare_results,
+    load_results,
+    log_comparison,
+    log_results,
+    save_results,
+)
+from daiv.benchmarks.tiny import TINY_CONFIGS, build_tiny_model, load_tiny_config
+
+__all__ = [
+    "ALL_CASES",
+    "DATA_CASES",
+    "MODEL_CASES",
+    "TINY_CONFIGS",
+    "build_tiny_model",
+    "compare_results",
+    "load_results",
+    "load_tiny_config",
+    "log_comparison",
+    "log_results",
+    "measure",
+    "run_benchmarks",
+    "save_results",
+]
@@ -0,0 +1,306 @@
+"""
+ Copyright (c) 2022, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+"""
+
+import json
+import logging
+import math
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader
+
+from daiv.benchmarks.tiny import TINY_WORDS, build_tiny_model, tiny_corpus
+from daiv.common.profiling import stage_timer
+
+MODEL_CASES = ["forward", "generate", "predict_answers", "predict_class"]
+DATA_CASES = ["dataloader", "vqa_eval"]
+ALL_CASES = MODEL_CASES + DATA_CASES
+
+
+def measure(fn, warmup=2, repeat=10, items=1):
+    """
+    Time fn() over ``repeat`` runs after ``warmup`` untimed runs.
+
+    Returns latency statistics in milliseconds, throughput in items per second
+    and the mean time per instrumented model stage (see daiv.common.profiling).
+    """
+    for _ in range(warmup):
+        fn()
+
+    timer = stage_timer()
+    was_enabled = timer.enabled
+    timer.enable(sync=True)
+    timer.reset()
+
+    times = []
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+    finally:
+        stages = {name: stats["total_s"] * 1000 / repeat for name, stats in timer.report().items()}
+        timer.reset()
+        if not was_enabled:
+            timer.disable()
+
+    times_ms = sorted(t * 1000 for t in times)
+    mean_ms = sum(times_ms) / len(times_ms)
+
+    return {
+        "repeat": repeat,
+        "items": items,
+        "mean_ms": mean_ms,
+        "median_ms": times_ms[len(times_ms) // 2],
+        "min_ms": times_ms[0],
+        "max_ms": times_ms[-1],
+        "std_ms": math.sqrt(sum((t - mean_ms) ** 2 for t in times_ms) / len(times_ms)),
+        "items_per_s": 1000 * items / mean_ms,
+        "stages_ms": stages,
+    }
+
+
+def random_samples(cfg, seed=0):
+    """
+    A deterministic batch of random images and questions for a tiny config.
+    """
+    bench_cfg = cfg.benchmark
+    bs = bench_cfg.batch_size
+    image_size = cfg.model.image_size
+
+    generator = torch.Generator().manual_seed(seed)
+    image = torch.randn(bs, 3, image_size, image_size, generator=generator)
+
+    questions = tiny_corpus(num_sentences=bs, seed=seed)
+    answers = tiny_corpus(num_sentences=2 * bs, seed=seed + 1)[bs:]
+
+    return {
+        "image": image,
+        "text_input": questions,
+        "text_output": answers,
+        "prompt": bench_cfg.prompt,
+    }
+
+
+def bench_forward(model, cfg, samples):
+    batch = {k: samples[k] for k in ["image", "text_input", "text_output"]}
+
+    def fn():
+        with torch.no_grad():
+            model(dict(batch))
+
+    return fn, len(batch["text_input"])
+
+
+def bench_generate(model, cfg, samples):
+    bench_cfg = cfg.benchmark
+    prompts = [bench_cfg.prompt.format(q) for q in samples["text_input"]]
+    batch = {"image": samples["image"], "prompt": prompts}
+
+    def fn():
+        with torch.no_grad():
+            # fixed number of new tokens, a random model may emit eos anywhere
+            model.generate(
+                dict(batch),
+                num_beams=bench_cfg.num_beams,
+                max_length=bench_cfg.max_len,
+                min_length=bench_cfg.max_len,
+            )
+
+    return fn, len(prompts) * bench_cfg.max_len
+
+
+def bench_predict_answers(model, cfg, samples):
+    bench_cfg = cfg.benchmark
+    batch = {"image": samples["image"], "text_input": samples["text_input"]}
+
+    def fn():
+        with torch.no_grad():
+            model.predict_answers(
+                dict(batch),
+                num_beams=bench_cfg.num_beams,
+                max_len=bench_cfg.max_len,
+                min_len=1,
+                prompt=bench_cfg.prompt,
+            )
+
+    return fn, len(batch["text_input"])
+
+
+def bench_predict_class(model, cfg, samples):
+    bench_cfg = cfg.benchmark
+    candidates = TINY_WORDS[: bench_cfg.num_candidates]
+    batch = {
+        "image": samples["image"],
+        "text_input": samples["text_input"],
+        "prompt": bench_cfg.prompt,
+    }
+
+    def fn():
+        with torch.no_grad():
+            model.predict_class(dict(batch), candidates)
+
+    return fn, len(batch["text_input"])
+
+
+def build_vqa_image_folder(root, num_images, image_size, seed=0):
+    """
+    Write random jpeg images and a COCO VQA style annotation file under root.
+    """
+    rng = np.random.RandomState(seed)
+    words = random.Random(seed)
+
+    image_dir = os.path.join(root, "train2014")
+    os.makedirs(image_dir, exist_ok=True)
+
+    annotations = []
+    for image_id in range(num_images):
+        pixels = rng.randint(0, 256, size=(image_size, image_size, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(
+            os.path.join(image_dir, f"COCO_train2014_{image_id:012d}.jpg")
+        )
+        annotations.append(
+            {
+                "image_id": image_id,
+                "question_id": image_id,
+                "question": tiny_corpus(num_sentences=1, seed=seed + image_id)[0],
+                "answers": [{"answer": words.choice(TINY_WORDS)} for _ in range(10)],
+            }
+        )
+
+    ann_path = os.path.join(root, "annotations.json")
+    with open(ann_path, "w") as f:
+        json.dump({"annotations": annotations}, f)
+
+    return ann_path
+
+
+def bench_dataloader(cfg, workdir, seed=0):
+    from daiv.datasets.datasets.coco_vqa_datasets import COCOVQADataset
+    from daiv.processors.blip_processors import (
+        Blip2ImageTrainProcessor,
+        BlipQuestionProcessor,
+    )
+
+    bench_cfg = cfg.benchmark
+    image_size = cfg.model.image_size
+
+    # store images at 4x the model resolution so that decoding and resizing are measured
+    ann_path = build_vqa_image_folder(workdir, bench_cfg.num_images, 4 * image_size, seed)
+    dataset = COCOVQADataset(
+        vis_processor=Blip2ImageTrainProcessor(image_size=image_size),
+        text_processor=BlipQuestionProcessor(),
+        vis_root=workdir,
+        ann_paths=[ann_path],
+    )
+
+    def fn():
+        loader = DataLoader(
+            dataset,
+            batch_size=bench_cfg.batch_size,
+            num_workers=bench_cfg.num_workers,
+            collate_fn=dataset.collater,
+            shuffle=False,
+        )
+        for _ in loader:
+            pass
+
+    return fn, len(dataset)
+
+
+def bench_vqa_eval(cfg, seed=0):
+    from daiv.common.vqa_tools.vqa import VQA
+    from daiv.common.vqa_tools.vqa_eval import VQAEval
+
+    rng = random.Random(seed)
+    num_questions = cfg.benchmark.num_questions
+
+    annotations, questions, results = [], [], []
+    for question_id in range(num_questions):
+        info = {
+            "question_id": question_id,
+            "image_id": question_id,
+            "question_type": rng.choice(["what is", "how many", "is the"]),
+            "answer_type": rng.choice(["other", "number", "yes/no"]),
+        }
+        annotations.append(
+            {
+                **info,
+                "answers": [
+                    {"answer": rng.choice(TINY_WORDS), "answer_id": i} for i in range(10)
+                ],
+            }
+        )
+        questions.append({"question_id": question_id, "image_id": question_id})
+        results.append({**info, "answer": rng.choice(TINY_WORDS) + rng.choice(["", ".", "s"])})
+
+    def make_vqa(anns):
+        vqa = VQA()
+        vqa.dataset = {"annotations": anns}
+        vqa.questions = {"questions": questions}
+        vqa.createIndex()
+        return vqa
+
+    vqa, vqa_result = make_vqa(annotations), make_vqa(results)
+
+    def fn():
+        VQAEval(vqa, vqa_result, n=2).evaluate()
+
+    return fn, num_questions
+
+
+_MODEL_CASE_FNS = {
+    "forward": bench_forward,
+    "generate": bench_generate,
+    "predict_answers": bench_predict_answers,
+    "predict_class": bench_predict_class,
+}
+
+
+def run_benchmarks(name, cfg, cases=ALL_CASES, assets_dir=None, seed=0):
+    """
+    Run the selected benchmark cases of a tiny config.
+
+    Returns a dict of per-case statistics keyed by "<name>/<case>".
+    """
+    bench_cfg = cfg.benchmark
+    results = {}
+
+    model_cases = [c for c in cases if c in MODEL_CASES]
+    if len(model_cases) > 0:
+        model = build_tiny_model(cfg, assets_dir=assets_dir)
+        samples = random_samples(cfg, seed=seed)
+
+        for case in model_cases:
+            logging.info("Benchmarking {}/{}".format(name, case))
+            torch.manual_seed(seed)
+            fn, items = _MODEL_CASE_FNS[case](model, cfg, samples)
+            results["{}/{}".format(name, case)] = measure(
+                fn, warmup=bench_cfg.warmup, repeat=bench_cfg.repeat, items=items
+            )
+
+    if "dataloader" in cases:
+        logging.info("Benchmarking {}/dataloader".format(name))
+        with tempfile.TemporaryDirectory() as workdir:
+            fn, items = bench_dataloader(cfg, workdir, seed=seed)
+            results["{}/dataloader".format(name)] = measure(
+                fn, warmup=1, repeat=max(bench_cfg.repeat // 5, 1), items=items
+            )
+
+    if "vqa_eval" in cases:
+        logging.info("Benchmarking {}/vqa_eval".format(name))
+        fn, items = bench_vqa_eval(cfg, seed=seed)
+        results["{}/vqa_eval".format(name)] = measure(
+            fn, warmup=1, repeat=max(bench_cfg.repeat // 5, 1), items=items
+        )
+
+    return results
@@ -0,0 +1,120 @@
+"""
+ Copyright (c) 2022, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+"""
+
+import json
+import logging
+import os
+import platform
+import subprocess
+
+import torch
+
+
+def environment_info():
+    """
+    What a benchmark result depends on besides the code: library versions,
+    hardware and thread settings, and the git commit when available.
+    """
+    import transformers
+
+    info = {
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "num_threads": torch.get_num_threads(),
+    }
+
+    try:
+        info["git_commit"] = (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        info["git_commit"] = None
+
+    return info
+
+
+def save_results(results, filename, config=None):
+    output = {"environment": environment_info(), "config": config, "results": results}
+
+    dirname = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(dirname, exist_ok=True)
+    with open(filename, "w") as f:
+        json.dump(output, f, indent=2)
+
+    return output
+
+
+def load_results(filename):
+    with open(filename, "r") as f:
+        return json.load(f)["results"]
+
+
+def compare_results(results, baseline, metric="median_ms", tolerance=0.1):
+    """
+    Compare each benchmark present in both results against the baseline.
+
+    A benchmark regresses when its ``metric`` grows by more than ``tolerance``
+    (relative). Returns one row per benchmark.
+    """
+    rows = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+
+        current, base = results[name][metric], baseline[name][metric]
+        ratio = current / max(base, 1e-12)
+        rows.append(
+            {
+                "name": name,
+                "baseline": base,
+                "current": current,
+                "ratio": ratio,
+                "regression": ratio > 1 + tolerance,
+            }
+        )
+
+    missing = sorted(set(baseline) - set(results))
+    if len(missing) > 0:
+        logging.info("Not run, present in baseline: {}".format(", ".join(missing)))
+
+    return rows
+
+
+def log_results(results):
+    lines = ["{:<36s} {:>12s} {:>12s} {:>12s}".format("benchmark", "median ms", "std ms", "items/s")]
+    for name, stats in sorted(results.items()):
+        lines.append(
+            "{:<36s} {:12.3f} {:12.3f} {:12.1f}".format(
+                name, stats["median_ms"], stats["std_ms"], stats["items_per_s"]
+            )
+        )
+    logging.info("\n" + "\n".join(lines))
+
+
+def log_comparison(rows):
+    lines = ["{:<36s} {:>12s} {:>12s} {:>8s}".format("benchmark", "baseline", "current", "ratio")]
+    for row in rows:
+        lines.append(
+            "{:<36s} {:12.3f} {:12.3f} {:8.3f}{}".format(
+                row["name"],
+                row["baseline"],
+                row["current"],
+                row["ratio"],
+                "  REGRESSION" if row["regression"] else "",
+            )
+        )
+    logging.info("\n" + "\n".join(lines))
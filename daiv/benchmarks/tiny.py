@@ -0,0 +1,240 @@
+"""
+ Copyright (c) 2022, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+"""
+
+import hashlib
+import logging
+import os
+import random
+from functools import partial
+
+import torch
+import torch.nn as nn
+from omegaconf import OmegaConf
+
+from daiv.common.registry import registry
+from daiv.models.blip2 import LayerNorm
+from daiv.models.eva_vit import VisionTransformer
+
+TINY_CONFIGS = {
+    "bliva_vicuna": "configs/tiny_bliva_vicuna.yaml",
+    "bliva_flant5": "configs/tiny_bliva_flant5.yaml",
+}
+
+# words the tiny tokenizers are built from; benchmark prompts and answers use them too
+TINY_WORDS = (
+    "a an the is are what which who where when how many much color colour of in on at "
+    "to with for from by this that there image picture photo question answer short "
+    "yes no one two three four five man woman person people dog cat car bus train "
+    "table chair room street sky water tree grass red blue green white black yellow "
+    "brown small large left right top bottom front back sitting standing holding "
+    "playing eating wearing riding looking sign text number time day night food "
+    "given based respond use provided provide possible following can be using"
+).split()
+
+
+def load_tiny_config(name):
+    """
+    Load a tiny benchmark config by model name (see TINY_CONFIGS) or yaml path.
+    """
+    if name in TINY_CONFIGS:
+        name = os.path.join(os.path.dirname(os.path.abspath(__file__)), TINY_CONFIGS[name])
+    return OmegaConf.load(name)
+
+
+def tiny_corpus(num_sentences=2000, seed=0):
+    rng = random.Random(seed)
+    return [
+        " ".join(rng.choice(TINY_WORDS) for _ in range(rng.randint(3, 12))) + rng.choice(["?", ".", ""])
+        for _ in range(num_sentences)
+    ]
+
+
+def _train_sentencepiece(filename, vocab_size, seed, **special_ids):
+    import sentencepiece as spm
+
+    spm.SentencePieceTrainer.train(
+        sentence_iterator=iter(tiny_corpus(seed=seed)),
+        model_prefix=filename,
+        vocab_size=vocab_size,
+        hard_vocab_limit=False,
+        character_coverage=1.0,
+        num_threads=1,
+        minloglevel=2,
+        **special_ids,
+    )
+    return filename + ".model"
+
+
+def _build_bert(path, cfg, seed):
+    from transformers import BertTokenizer
+
+    from daiv.models.Qformer import BertConfig, BertLMHeadModel
+
+    vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+    vocab += list("abcdefghijklmnopqrstuvwxyz0123456789.,?!'\"-:;()")
+    vocab += ["##" + c for c in "abcdefghijklmnopqrstuvwxyz0123456789"]
+    vocab += sorted(set(TINY_WORDS) - set(vocab))
+
+    os.makedirs(path, exist_ok=True)
+    vocab_file = os.path.join(path, "vocab.txt")
+    with open(vocab_file, "w") as f:
+        f.write("\n".join(vocab) + "\n")
+    BertTokenizer(vocab_file).save_pretrained(path)
+
+    torch.manual_seed(seed)
+    config = BertConfig(
+        vocab_size=len(vocab),
+        hidden_size=cfg.hidden_size,
+        num_hidden_layers=cfg.num_hidden_layers,
+        num_attention_heads=cfg.num_attention_heads,
+        intermediate_size=cfg.intermediate_size,
+        max_position_embeddings=cfg.get("max_position_embeddings", 128),
+    )
+    BertLMHeadModel(config).save_pretrained(path)
+
+
+def _build_llama(path, cfg, seed):
+    from transformers import LlamaConfig, LlamaTokenizer
+
+    from daiv.models.modeling_llama import LlamaForCausalLM
+
+    os.makedirs(path, exist_ok=True)
+    spm_file = _train_sentencepiece(
+        os.path.join(path, "spm"), cfg.vocab_size, seed, unk_id=0, bos_id=1, eos_id=2, pad_id=-1
+    )
+    tokenizer = LlamaTokenizer(vocab_file=spm_file)
+    tokenizer.save_pretrained(path)
+
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=cfg.hidden_size,
+        intermediate_size=cfg.intermediate_size,
+        num_hidden_layers=cfg.num_hidden_layers,
+        num_attention_heads=cfg.num_attention_heads,
+        max_position_embeddings=cfg.get("max_position_embeddings", 512),
+    )
+    LlamaForCausalLM(config).save_pretrained(path)
+
+
+def _build_t5(path, cfg, seed):
+    from transformers import T5Tokenizer
+
+    from daiv.models.modeling_t5 import T5Config, T5ForConditionalGeneration
+
+    os.makedirs(path, exist_ok=True)
+    spm_file = _train_sentencepiece(
+        os.path.join(path, "spm"), cfg.vocab_size, seed, pad_id=0, eos_id=1, unk_id=2, bos_id=-1
+    )
+    tokenizer = T5Tokenizer(vocab_file=spm_file, extra_ids=cfg.get("extra_ids", 0))
+    tokenizer.save_pretrained(path)
+
+    torch.manual_seed(seed)
+    config = T5Config(
+        vocab_size=len(tokenizer),
+        d_model=cfg.hidden_size,
+        d_kv=cfg.hidden_size // cfg.num_attention_heads,
+        d_ff=cfg.intermediate_size,
+        num_layers=cfg.num_hidden_layers,
+        num_decoder_layers=cfg.num_hidden_layers,
+        num_heads=cfg.num_attention_heads,
+        feed_forward_proj="gated-gelu",
+        decoder_start_token_id=0,
+        pad_token_id=0,
+        eos_token_id=1,
+    )
+    T5ForConditionalGeneration(config).save_pretrained(path)
+
+
+def build_tiny_assets(tiny_cfg, assets_dir=None):
+    """
+    Write the tokenizers and randomly initialized Q-Former BERT and language model
+    of a tiny config as local HF checkpoints, so that the regular model
+    constructors can build from them without downloads. Assets are keyed by the
+    tiny config and reused across runs.
+
+    Returns the assets directory, with "bert" and "llm" subdirectories.
+    """
+    key = hashlib.md5(OmegaConf.to_yaml(tiny_cfg).encode()).hexdigest()[:12]
+    if assets_dir is None:
+        assets_dir = os.path.join(registry.get_path("cache_root"), "benchmark")
+    assets_dir = os.path.join(assets_dir, key)
+
+    done_file = os.path.join(assets_dir, "DONE")
+    if os.path.exists(done_file):
+        return assets_dir
+
+    logging.info("Building tiny benchmark assets in {}".format(assets_dir))
+    seed = tiny_cfg.get("seed", 0)
+
+    _build_bert(os.path.join(assets_dir, "bert"), tiny_cfg.qformer, seed)
+
+    llm_type = tiny_cfg.llm.get("type", "llama")
+    if llm_type == "llama":
+        _build_llama(os.path.join(assets_dir, "llm"), tiny_cfg.llm, seed)
+    elif llm_type == "t5":
+        _build_t5(os.path.join(assets_dir, "llm"), tiny_cfg.llm, seed)
+    else:
+        raise ValueError("Unknown tiny llm type {}".format(llm_type))
+
+    open(done_file, "w").close()
+    return assets_dir
+
+
+class TinyVisionMixin:
+    """
+    Replace the EVA ViT-g of a BLIP-2 style model with a small randomly initialized
+    EVA ViT described by ``tiny_vit``.
+    """
+
+    tiny_vit = None
+
+    def init_vision_encoder(
+        self, model_name, img_size, drop_path_rate, use_grad_checkpoint, precision, load_weights=True
+    ):
+        cfg = self.tiny_vit
+        visual_encoder = VisionTransformer(
+            img_size=img_size,
+            patch_size=cfg.get("patch_size", 14),
+            use_mean_pooling=False,
+            embed_dim=cfg.embed_dim,
+            depth=cfg.depth,
+            num_heads=cfg.num_heads,
+            mlp_ratio=cfg.get("mlp_ratio", 4.0),
+            qkv_bias=True,
+            drop_path_rate=drop_path_rate,
+            norm_layer=partial(nn.LayerNorm, eps=1e-6),
+            use_checkpoint=use_grad_checkpoint,
+        )
+        ln_vision = LayerNorm(visual_encoder.num_features)
+        self.vit_name = model_name
+        return visual_encoder, ln_vision
+
+
+def build_tiny_model(cfg, assets_dir=None):
+    """
+    Build the model of a tiny benchmark config from random weights, in fp32 and
+    eval mode.
+    """
+    tiny_cfg = cfg.tiny
+    assets_dir = build_tiny_assets(tiny_cfg, assets_dir)
+
+    model_cfg = cfg.model.copy()
+    model_cls = registry.get_model_class(model_cfg.arch)
+    llm_key = "t5_model" if tiny_cfg.llm.get("type", "llama") == "t5" else "llm_model"
+    model_cfg[llm_key] = os.path.join(assets_dir, "llm")
+
+    tiny_cls = type(
+        "Tiny" + model_cls.__name__,
+        (TinyVisionMixin, model_cls),
+        {"tiny_vit": tiny_cfg.vit, "bert_model": os.path.join(assets_dir, "bert")},
+    )
+
+    torch.manual_seed(tiny_cfg.get("seed", 0))
+    model = tiny_cls.from_config(model_cfg)
+
+    return model.float().eval()
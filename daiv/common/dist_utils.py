@@ -69,8 +69,10 @@ def init_distributed_mode(args):
 
     args.distributed = True
 
-    torch.cuda.set_device(args.gpu)
-    args.dist_backend = "nccl"
+    # gloo allows running distributed training on cpu, e.g. for tests
+    args.dist_backend = args.get("dist_backend", "nccl")
+    if args.dist_backend == "nccl":
+        torch.cuda.set_device(args.gpu)
     print(
         "| distributed init (rank {}, world {}): {}".format(
             args.rank, args.world_size, args.dist_url
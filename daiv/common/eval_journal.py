@@ -0,0 +1,93 @@
+"""
+ Copyright (c) 2022, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+"""
+
+import glob
+import json
+import logging
+import os
+
+
+class EvalJournal:
+    """
+    Append-only record of evaluation results, one JSONL file per rank.
+
+    Every rank appends its results as batches finish, so that an interrupted
+    evaluation can restart, skip the samples whose ``id_key`` is already
+    journaled and compute the final metrics from all journals. Journals of a
+    previous run with a different world size are read as well.
+    """
+
+    def __init__(self, journal_dir, rank=0, id_key="question_id"):
+        os.makedirs(journal_dir, exist_ok=True)
+
+        self.journal_dir = journal_dir
+        self.id_key = id_key
+        self.filename = os.path.join(journal_dir, "rank{}.jsonl".format(rank))
+        self.file = None
+
+    def _open(self):
+        # a process killed mid-write leaves a partial last line, start on a new one
+        needs_newline = False
+        if os.path.exists(self.filename) and os.path.getsize(self.filename) > 0:
+            with open(self.filename, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+
+        self.file = open(self.filename, "a")
+        if needs_newline:
+            self.file.write("\n")
+
+    def write(self, results):
+        if self.file is None:
+            self._open()
+
+        for res in results:
+            self.file.write(json.dumps(res) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def read(self):
+        records = []
+        for filename in sorted(glob.glob(os.path.join(self.journal_dir, "rank*.jsonl"))):
+            with open(filename, "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        logging.warning("Skip a partially written record in {}.".format(filename))
+        return records
+
+    def done_ids(self):
+        return {str(res[self.id_key]) for res in self.read() if self.id_key in res}
+
+    def collect(self, annotation=None):
+        """
+        All journaled results, one per id. Results are put in dataset order when
+        the dataset annotation is given.
+        """
+        results, seen = [], set()
+        for res in self.read():
+            if self.id_key in res:
+                res_id = str(res[self.id_key])
+                if res_id in seen:
+                    continue
+                seen.add(res_id)
+            results.append(res)
+
+        if annotation is not None:
+            order = {str(ann.get(self.id_key)): i for i, ann in enumerate(annotation)}
+            results.sort(key=lambda res: order.get(str(res.get(self.id_key)), len(order)))
+
+        return results
@@ -0,0 +1,124 @@
+"""
+ Copyright (c) 2022, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+"""
+
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+_IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$")
+
+
+def parse_import_times(stderr):
+    """
+    Parse the ``python -X importtime`` output into one record per imported
+    module, in import order. Times are in microseconds, depth is the nesting
+    level of the import.
+    """
+    records = []
+    for line in stderr.splitlines():
+        match = _IMPORT_TIME_LINE.match(line)
+        if match is None:
+            continue
+
+        self_us, cumulative_us, indent, name = match.groups()
+        records.append(
+            {
+                "name": name,
+                "self_us": int(self_us),
+                "cumulative_us": int(cumulative_us),
+                "depth": (len(indent) - 1) // 2,
+            }
+        )
+    return records
+
+
+def measure_imports(statement, python=None, cwd=None):
+    """
+    Run ``statement`` in a fresh interpreter with ``-X importtime`` and return
+    the parsed import records and the wall time of the whole process.
+    """
+    cmd = [python or sys.executable, "-X", "importtime", "-c", statement]
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+
+    start = time.perf_counter()
+    proc = subprocess.run(cmd, cwd=cwd, env=env, capture_output=True, text=True)
+    wall_s = time.perf_counter() - start
+
+    if proc.returncode != 0:
+        errors = [line for line in proc.stderr.splitlines() if not line.startswith("import time:")]
+        raise RuntimeError("Failed to run {!r}:\n{}".format(statement, "\n".join(errors)))
+
+    return parse_import_times(proc.stderr), wall_s
+
+
+def summarize_imports(records, top=20):
+    """
+    Total import time, the slowest modules by cumulative and self time and
+    the self time per top-level package.
+    """
+    per_package = defaultdict(int)
+    for rec in records:
+        per_package[rec["name"].split(".")[0]] += rec["self_us"]
+
+    return {
+        "num_modules": len(records),
+        "total_ms": sum(rec["self_us"] for rec in records) / 1000,
+        "top_cumulative": sorted(records, key=lambda r: r["cumulative_us"], reverse=True)[:top],
+        "top_self": sorted(records, key=lambda r: r["self_us"], reverse=True)[:top],
+        "packages_ms": {
+            name: us / 1000
+            for name, us in sorted(per_package.items(), key=lambda x: x[1], reverse=True)[:top]
+        },
+    }
+
+
+def log_import_summary(summary, wall_s=None):
+    lines = [
+        "{} modules imported in {:.1f} ms{}".format(
+            summary["num_modules"],
+            summary["total_ms"],
+            "" if wall_s is None else " (process wall time {:.1f} ms)".format(wall_s * 1000),
+        ),
+        "",
+        "{:<60s} {:>12s}".format("slowest by cumulative time", "ms"),
+    ]
+    for rec in summary["top_cumulative"]:
+        lines.append("{:<60s} {:12.1f}".format(rec["name"], rec["cumulative_us"] / 1000))
+
+    lines += ["", "{:<60s} {:>12s}".format("slowest by self time", "ms")]
+    for rec in summary["top_self"]:
+        lines.append("{:<60s} {:12.1f}".format(rec["name"], rec["self_us"] / 1000))
+
+    lines += ["", "{:<60s} {:>12s}".format("self time per package", "ms")]
+    for name, ms in summary["packages_ms"].items():
+        lines.append("{:<60s} {:12.1f}".format(name, ms))
+
+    logging.info("\n" + "\n".join(lines))
+
+
+def config_import_statement(cfg_path):
+    """
+    A statement importing what running ``cfg_path`` imports before the first
+    batch: the daiv packages and the registered model, dataset builder, task
+    and runner classes named in the config.
+    """
+    return "\n".join(
+        [
+            "from omegaconf import OmegaConf",
+            "import daiv",
+            "from daiv.common.registry import registry",
+            "cfg = OmegaConf.load({!r})".format(os.path.abspath(cfg_path)),
+            "registry.get_model_class(cfg.model.arch)",
+            "[registry.get_builder_class(name) for name in cfg.get('datasets', {})]",
+            "registry.get_task_class(cfg.run.task)",
+            "registry.get_runner_class(cfg.run.get('runner', 'runner_base'))",
+        ]
+    )
@@ -0,0 +1,215 @@
+"""
+ Copyright (c) 2022, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+"""
+
+import contextlib
+import logging
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from types import SimpleNamespace
+
+# the lemmas only need the tagger, attribute_ruler and lemmatizer
+DISABLED_COMPONENTS = ("parser", "ner")
+
+
+def lemmatize_doc(doc):
+    words = []
+    for token in doc:
+        if token.pos_ in ["NOUN", "VERB"]:
+            words.append(token.lemma_)
+        else:
+            words.append(token.text)
+    return " ".join(words)
+
+
+class Lemmatizer:
+    """
+    Lemmatizes predicted answers with spaCy: nouns and verbs are replaced by
+    their lemma.
+
+    Answers are lemmatized in batches with ``nlp.pipe`` and memoized in an LRU
+    cache of ``cache_size`` answers, so repeated answers ("yes", "2", "red")
+    only go through the pipeline once. With ``num_workers > 0`` the pipeline
+    and its cache live in a worker process and ``submit()`` returns a future,
+    which lets the caller lemmatize a batch while the next one is generated.
+    """
+
+    def __init__(
+        self,
+        model_name="en_core_web_sm",
+        batch_size=256,
+        cache_size=65536,
+        disable=DISABLED_COMPONENTS,
+        num_workers=0,
+    ):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.disable = list(disable)
+        self.num_workers = num_workers
+
+        self._nlp = None
+        self._cache = OrderedDict()
+        self._executor = None
+        self._deferred = None
+
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def nlp(self):
+        if self._nlp is None:
+            try:
+                import spacy
+
+                self._nlp = spacy.load(self.model_name, disable=self.disable)
+            except ImportError:
+                logging.error(
+                    """
+                    Please install spacy and en_core_web_sm model to apply lemmatization.
+                    python -m spacy download en_core_web_sm
+                    OR
+                    import spacy.cli
+                    spacy.cli.download("en_core_web_sm")
+                    """
+                )
+                exit(1)
+
+        return self._nlp
+
+    def lemmatize(self, answers):
+        """
+        Lemmatize in this process, running the pipeline once per distinct
+        answer that is not cached.
+        """
+        outputs = [None] * len(answers)
+        todo = OrderedDict()
+        for i, answer in enumerate(answers):
+            if answer in self._cache:
+                self._cache.move_to_end(answer)
+                outputs[i] = self._cache[answer]
+                self.hits += 1
+            else:
+                todo.setdefault(answer, []).append(i)
+                self.misses += 1
+
+        texts = list(todo.keys())
+        for text, doc in zip(texts, self.nlp.pipe(texts, batch_size=self.batch_size)):
+            lemma = lemmatize_doc(doc)
+            for i in todo[text]:
+                outputs[i] = lemma
+
+            if self.cache_size > 0:
+                self._cache[text] = lemma
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        return outputs
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            # spawn, a forked worker would inherit the CUDA context of the parent
+            self._executor = ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.model_name, self.batch_size, self.cache_size, self.disable),
+            )
+        return self._executor
+
+    def submit(self, answers):
+        """
+        Lemmatize answers, in the worker process when num_workers > 0.
+        Returns a future of the lemmatized answers.
+        """
+        answers = list(answers)
+        if self.num_workers > 0:
+            return self.executor.submit(_worker_lemmatize, answers)
+
+        future = Future()
+        future.set_result(self.lemmatize(answers))
+        return future
+
+    def __call__(self, answers):
+        if self._deferred is not None:
+            self._deferred.requested = True
+            return list(answers)
+
+        return self.submit(answers).result()
+
+    @contextlib.contextmanager
+    def deferred(self):
+        """
+        Within this context, calls return the answers unchanged and record that
+        lemmatization was requested, so the caller can submit() them itself.
+        Without worker process nothing is deferred.
+        """
+        if self.num_workers == 0:
+            yield SimpleNamespace(requested=False)
+            return
+
+        self._deferred = SimpleNamespace(requested=False)
+        try:
+            yield self._deferred
+        finally:
+            self._deferred = None
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+_worker_lemmatizer = None
+
+
+def _init_worker(model_name, batch_size, cache_size, disable):
+    global _worker_lemmatizer
+    _worker_lemmatizer = Lemmatizer(
+        model_name=model_name, batch_size=batch_size, cache_size=cache_size, disable=disable
+    )
+
+
+def _worker_lemmatize(answers):
+    return _worker_lemmatizer.lemmatize(answers)
+
+
+_lemmatizer = None
+
+
+def get_lemmatizer():
+    """
+    The lemmatizer shared by all models of this process.
+    """
+    global _lemmatizer
+    if _lemmatizer is None:
+        _lemmatizer = Lemmatizer()
+    return _lemmatizer
+
+
+def set_lemmatizer(lemmatizer):
+    global _lemmatizer
+    if _lemmatizer is not None and _lemmatizer is not lemmatizer:
+        _lemmatizer.close()
+    _lemmatizer = lemmatizer
+
+
+def map_future(future, fn):
+    """
+    A future of fn(result) once ``future`` is done.
+    """
+    mapped = Future()
+
+    def done(f):
+        try:
+            mapped.set_result(fn(f.result()))
+        except Exception as e:
+            mapped.set_exception(e)
+
+    future.add_done_callback(done)
+    return mapped
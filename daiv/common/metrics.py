@@ -0,0 +1,165 @@
+"""
+ Copyright (c) 2022, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+"""
+
+import json
+import logging
+import os
+import queue
+import threading
+
+import torch
+import torch.distributed as dist
+
+from daiv.common import dist_utils
+
+
+class DeviceMetricAccumulator:
+    """
+    Accumulate scalar tensors on their device without synchronizing with the host.
+
+    reduce() averages the accumulated values over steps and ranks with a single
+    all_reduce and a single device-to-host copy, then starts a new window.
+    """
+
+    def __init__(self):
+        self.sums = {}
+        self.count = 0
+
+    @staticmethod
+    def _reduce_device():
+        # NCCL only reduces CUDA tensors
+        if dist_utils.is_dist_avail_and_initialized() and dist.get_backend() == "nccl":
+            return torch.device("cuda", torch.cuda.current_device())
+        return None
+
+    def _device(self, kwargs):
+        device = self._reduce_device()
+        if device is not None:
+            return device
+        for v in list(self.sums.values()) + list(kwargs.values()):
+            if isinstance(v, torch.Tensor):
+                return v.device
+        return torch.device("cpu")
+
+    def update(self, **kwargs):
+        device = self._device(kwargs)
+        for k, v in kwargs.items():
+            if not isinstance(v, torch.Tensor):
+                # python numbers go to the device of the losses, not the CPU
+                v = torch.tensor(float(v), device=self.sums[k].device if k in self.sums else device)
+            v = v.detach().float()
+            if k in self.sums:
+                self.sums[k] += v
+            else:
+                self.sums[k] = v.clone()
+        self.count += 1
+
+    def reduce(self):
+        if self.count == 0:
+            return {}
+
+        names = list(self.sums.keys())
+        device = self._reduce_device() or self.sums[names[0]].device
+        values = torch.stack([self.sums[k].to(device) for k in names]) / self.count
+
+        if dist_utils.is_dist_avail_and_initialized():
+            dist.all_reduce(values)
+            values /= dist_utils.get_world_size()
+
+        self.sums = {}
+        self.count = 0
+
+        return dict(zip(names, values.tolist()))
+
+
+class StdoutSink:
+    def write(self, record):
+        logging.info(json.dumps(record))
+
+    def close(self):
+        pass
+
+
+class FileSink:
+    def __init__(self, filename):
+        self.file = open(filename, "a")
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class WandbSink:
+    def __init__(self, project="bliva"):
+        import wandb
+
+        self.wandb = wandb
+        if wandb.run is None:
+            wandb.init(project=project)
+
+    def write(self, record):
+        self.wandb.log(record)
+
+    def close(self):
+        self.wandb.finish()
+
+
+def build_metric_sinks(names, output_dir, wandb_project="bliva"):
+    """
+    Build metric sinks by name: "stdout", "file" (metrics.jsonl in output_dir)
+    and "wandb", which is skipped when wandb is not installed.
+    """
+    sinks = []
+    for name in names:
+        if name == "stdout":
+            sinks.append(StdoutSink())
+        elif name == "file":
+            sinks.append(FileSink(os.path.join(output_dir, "metrics.jsonl")))
+        elif name == "wandb":
+            try:
+                sinks.append(WandbSink(project=wandb_project))
+            except ImportError:
+                logging.warning("wandb is not installed, skip the wandb metric sink.")
+        else:
+            raise ValueError("Unknown metric sink {}".format(name))
+    return sinks
+
+
+class AsyncMetricWriter:
+    """
+    Ship metric records to sinks from a background thread, so that file, network
+    and console I/O stay off the training loop.
+    """
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for sink in self.sinks:
+                try:
+                    sink.write(record)
+                except Exception as e:
+                    logging.warning("Failed to write metrics to {}: {}".format(type(sink).__name__, e))
+
+    def write(self, record):
+        self.queue.put(record)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        for sink in self.sinks:
+            sink.close()
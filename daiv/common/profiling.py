@@ -0,0 +1,219 @@
+"""
+ Copyright (c) 2022, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+"""
+
+import contextlib
+import logging
+import os
+import time
+
+import torch
+from transformers import LogitsProcessor
+
+from daiv.common.logger import MetricLogger, SmoothedValue
+
+
+class StageTimer:
+    """
+    Named timing regions around model stages (ViT, Q-Former, LLM prefill, ...).
+
+    When enabled, every region records its wall time (after a device sync, so that
+    asynchronous cuda kernels are attributed to the right stage) and the peak
+    cuda memory allocated while it ran, aggregated in a MetricLogger. Regions
+    also show up by name in torch.profiler traces. When disabled a region costs a
+    single attribute check.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.sync = True
+        self.depth = 0
+        self.reset()
+
+    def enable(self, sync=True):
+        self.enabled = True
+        self.sync = sync
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.metric_logger = MetricLogger(delimiter="  ")
+        self.peak_memory = {}
+
+    def _synchronize(self):
+        if self.sync and torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    @contextlib.contextmanager
+    def region(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        use_cuda = torch.cuda.is_available()
+        if use_cuda and self.depth == 0:
+            torch.cuda.reset_peak_memory_stats()
+
+        self._synchronize()
+        start = time.perf_counter()
+        self.depth += 1
+        try:
+            with torch.profiler.record_function(name):
+                yield
+        finally:
+            self.depth -= 1
+            self._synchronize()
+            self.add(name, time.perf_counter() - start)
+            if use_cuda:
+                self.add_memory(name, torch.cuda.max_memory_allocated() / 1024 ** 2)
+
+    def add(self, name, seconds):
+        if name not in self.metric_logger.meters:
+            self.metric_logger.add_meter(name, SmoothedValue(window_size=1))
+        self.metric_logger.meters[name].update(seconds)
+
+    def add_memory(self, name, megabytes):
+        self.peak_memory[name] = max(self.peak_memory.get(name, 0), megabytes)
+
+    def report(self):
+        """
+        Per-stage breakdown: number of calls, total and mean seconds, share of the
+        summed stage time and peak memory in MB.
+        """
+        meters = self.metric_logger.meters
+        total = sum(m.total for m in meters.values())
+
+        report = {}
+        for name, meter in sorted(meters.items(), key=lambda x: -x[1].total):
+            report[name] = {
+                "calls": meter.count,
+                "total_s": meter.total,
+                "mean_ms": 1000 * meter.global_avg,
+                "share": meter.total / max(total, 1e-12),
+            }
+            if name in self.peak_memory:
+                report[name]["peak_mem_mb"] = self.peak_memory[name]
+
+        return report
+
+    def log_report(self, header="Stage timing"):
+        report = self.report()
+        if len(report) == 0:
+            return report
+
+        lines = [header]
+        for name, stats in report.items():
+            line = "{:<20s} calls: {:<8d} total: {:10.3f}s  mean: {:9.3f}ms  share: {:6.1%}".format(
+                name, stats["calls"], stats["total_s"], stats["mean_ms"], stats["share"]
+            )
+            if "peak_mem_mb" in stats:
+                line += "  peak mem: {:.0f}MB".format(stats["peak_mem_mb"])
+            lines.append(line)
+        logging.info("\n".join(lines))
+
+        return report
+
+
+_STAGE_TIMER = StageTimer()
+
+
+def stage_timer():
+    """
+    The process-wide StageTimer used by model instrumentation.
+    """
+    return _STAGE_TIMER
+
+
+def timed_region(name):
+    return _STAGE_TIMER.region(name)
+
+
+class FirstTokenTimer(LogitsProcessor):
+    """
+    Pass-through logits processor recording when the first decoding step starts,
+    used to split generate() time into LLM prefill and decode.
+    """
+
+    def __init__(self, timer):
+        self.timer = timer
+        self.first_token_time = None
+
+    def __call__(self, input_ids, scores):
+        if self.first_token_time is None:
+            self.timer._synchronize()
+            self.first_token_time = time.perf_counter()
+        return scores
+
+
+@contextlib.contextmanager
+def timed_generate(logits_processor=None):
+    """
+    Time an LLM generate() call as "llm_prefill" (up to the first next-token
+    scores) and "llm_decode" (the rest). Yields the logits processor list to pass
+    to generate().
+    """
+    from transformers import LogitsProcessorList
+
+    timer = _STAGE_TIMER
+    if not timer.enabled:
+        yield logits_processor
+        return
+
+    first_token_timer = FirstTokenTimer(timer)
+    processors = LogitsProcessorList([first_token_timer])
+    if logits_processor is not None:
+        processors.extend(logits_processor)
+
+    timer._synchronize()
+    start = time.perf_counter()
+    with torch.profiler.record_function("llm_generate"):
+        yield processors
+    timer._synchronize()
+    end = time.perf_counter()
+
+    if first_token_timer.first_token_time is not None:
+        timer.add("llm_prefill", first_token_timer.first_token_time - start)
+        timer.add("llm_decode", end - first_token_timer.first_token_time)
+    else:
+        timer.add("llm_prefill", end - start)
+
+
+def build_profiler(profiler_cfg, output_dir):
+    """
+    Build a torch.profiler.profile from run_cfg.profiler, e.g.
+
+        profiler:
+          wait: 5
+          warmup: 2
+          active: 3
+          repeat: 1
+          record_shapes: False
+          profile_memory: True
+          with_stack: False
+
+    Traces of the active steps are written to output_dir/profiler for TensorBoard.
+    """
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    trace_dir = os.path.join(output_dir, "profiler")
+    os.makedirs(trace_dir, exist_ok=True)
+
+    return torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(
+            wait=profiler_cfg.get("wait", 5),
+            warmup=profiler_cfg.get("warmup", 2),
+            active=profiler_cfg.get("active", 3),
+            repeat=profiler_cfg.get("repeat", 1),
+        ),
+        on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+        record_shapes=profiler_cfg.get("record_shapes", False),
+        profile_memory=profiler_cfg.get("profile_memory", True),
+        with_stack=profiler_cfg.get("with_stack", False),
+    )
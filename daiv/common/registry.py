@@ -5,6 +5,8 @@
  For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
 """
 
+import importlib
+
 
 class Registry:
     mapping = {
@@ -16,8 +18,51 @@ class Registry:
         "runner_name_mapping": {},
         "state": {},
         "paths": {},
+        # name -> module path, for classes registered when their module is imported
+        "lazy": {
+            "builder_name_mapping": {},
+            "task_name_mapping": {},
+            "processor_name_mapping": {},
+            "model_name_mapping": {},
+            "lr_scheduler_name_mapping": {},
+            "runner_name_mapping": {},
+        },
     }
 
+    @classmethod
+    def register_lazy(cls, kind, name, module):
+        r"""Declare that the {kind} registered with key 'name' is defined in 'module'.
+
+        The module is only imported when the class is first looked up, so that a
+        run imports the model, builders and task named in its config and nothing else.
+
+        Args:
+            kind: one of "builder", "task", "processor", "model", "lr_scheduler", "runner".
+            name: Key with which the class registers itself.
+            module: Dotted path of the module defining the class.
+
+        Usage:
+
+            from daiv.common.registry import registry
+
+            registry.register_lazy("model", "bliva_vicuna", "daiv.models.bliva_vicuna7b")
+        """
+        cls.mapping["lazy"][kind + "_name_mapping"][name] = module
+
+    @classmethod
+    def _get_class(cls, kind, name):
+        mapping_name = kind + "_name_mapping"
+        if name not in cls.mapping[mapping_name]:
+            module = cls.mapping["lazy"][mapping_name].get(name, None)
+            if module is not None:
+                importlib.import_module(module)
+        return cls.mapping[mapping_name].get(name, None)
+
+    @classmethod
+    def _list(cls, kind):
+        mapping_name = kind + "_name_mapping"
+        return sorted(set(cls.mapping[mapping_name]) | set(cls.mapping["lazy"][mapping_name]))
+
     @classmethod
     def register_builder(cls, name):
         r"""Register a dataset builder to registry with key 'name'
@@ -92,7 +137,7 @@ class Registry:
         """
 
         def wrap(model_cls):
-            from daiv.models import BaseModel
+            from daiv.models.base_model import BaseModel
 
             assert issubclass(
                 model_cls, BaseModel
@@ -121,7 +166,7 @@ class Registry:
         """
 
         def wrap(processor_cls):
-            from daiv.processors import BaseProcessor
+            from daiv.processors.base_processor import BaseProcessor
 
             assert issubclass(
                 processor_cls, BaseProcessor
@@ -230,51 +275,51 @@ class Registry:
 
     @classmethod
     def get_builder_class(cls, name):
-        return cls.mapping["builder_name_mapping"].get(name, None)
+        return cls._get_class("builder", name)
 
     @classmethod
     def get_model_class(cls, name):
-        return cls.mapping["model_name_mapping"].get(name, None)
+        return cls._get_class("model", name)
 
     @classmethod
     def get_task_class(cls, name):
-        return cls.mapping["task_name_mapping"].get(name, None)
+        return cls._get_class("task", name)
 
     @classmethod
     def get_processor_class(cls, name):
-        return cls.mapping["processor_name_mapping"].get(name, None)
+        return cls._get_class("processor", name)
 
     @classmethod
     def get_lr_scheduler_class(cls, name):
-        return cls.mapping["lr_scheduler_name_mapping"].get(name, None)
+        return cls._get_class("lr_scheduler", name)
 
     @classmethod
     def get_runner_class(cls, name):
-        return cls.mapping["runner_name_mapping"].get(name, None)
+        return cls._get_class("runner", name)
 
     @classmethod
     def list_runners(cls):
-        return sorted(cls.mapping["runner_name_mapping"].keys())
+        return cls._list("runner")
 
     @classmethod
     def list_models(cls):
-        return sorted(cls.mapping["model_name_mapping"].keys())
+        return cls._list("model")
 
     @classmethod
     def list_tasks(cls):
-        return sorted(cls.mapping["task_name_mapping"].keys())
+        return cls._list("task")
 
     @classmethod
     def list_processors(cls):
-        return sorted(cls.mapping["processor_name_mapping"].keys())
+        return cls._list("processor")
 
     @classmethod
     def list_lr_schedulers(cls):
-        return sorted(cls.mapping["lr_scheduler_name_mapping"].keys())
+        return cls._list("lr_scheduler")
 
     @classmethod
     def list_datasets(cls):
-        return sorted(cls.mapping["builder_name_mapping"].keys())
+        return cls._list("builder")
 
     @classmethod
     def get_path(cls, name):
@@ -327,3 +372,22 @@ class Registry:
 
 
 registry = Registry()
+
+
+def lazy_getattr(package, attributes):
+    """
+    Module-level __getattr__ for a package that re-exports classes from
+    submodules: ``attributes`` maps each name to the module defining it, which is
+    imported on first access.
+
+    Usage:
+
+        __getattr__ = lazy_getattr(__name__, {"BLIVAVicuna": "daiv.models.bliva_vicuna7b"})
+    """
+
+    def __getattr__(name):
+        if name in attributes:
+            return getattr(importlib.import_module(attributes[name]), name)
+        raise AttributeError("module {!r} has no attribute {!r}".format(package, name))
+
+    return __getattr__
@@ -10,6 +10,7 @@ import json
 import logging
 import os
 import pickle
+import random
 import re
 import shutil
 import urllib
@@ -20,6 +21,7 @@ from urllib.parse import urlparse
 
 import numpy as np
 import pandas as pd
+import torch
 import yaml
 from iopath.common.download import download
 from iopath.common.file_io import file_lock, g_pathmgr
@@ -38,6 +40,26 @@ def now():
     return datetime.now().strftime("%Y%m%d%H%M")[:-1]
 
 
+def get_rng_state():
+    """
+    States of the python, numpy, torch and cuda random number generators.
+    """
+    return {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    }
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"].cpu())
+    if state["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state["cuda"]])
+
+
 def is_url(url_or_filename):
     parsed = urlparse(url_or_filename)
     return parsed.scheme in ("http", "https")
@@ -137,10 +137,14 @@ CONV_DIRECT= Conversation(
 )
 
 class Chat:
-    def __init__(self, model, vis_processor, device='cuda:0'):
+    def __init__(self, model, vis_processor, device='cuda:0', cache=None):
         self.device = device
         self.model = model
         self.vis_processor = vis_processor
+        # an InferenceCache of the model, see daiv/models/inference_cache.py
+        self.cache = cache
+        if cache is not None:
+            cache.attach()
 
     def ask(self, text, conv):
         conv.messages = [] #hack not keeping history.
@@ -6,26 +6,32 @@
 """
 
 from daiv.datasets.builders.base_dataset_builder import load_dataset_config
-from daiv.datasets.builders.caption_builder import (
-    COCOCapBuilder,
-    TextCapsBuilder,
-    NoCapBuilder,
-    LLaVAPretrainBuilder,
-    Flickr30kBuilder,
-)
-from daiv.datasets.builders.vqa_builder import (
-    COCOVQABuilder,
-    OKVQABuilder,
-    OCRVQABuilder,
-    TEXTVQABuilder,
-    LLAVABuilder,
-    VQGCOCOVQABuilder,
-    VQGAOKVQABuilder,
-    VQGOKVQABuilder,
-    STVQABuilder,
-    DocVQABuilder,
-)
-from daiv.common.registry import registry
+from daiv.common.registry import lazy_getattr, registry
+
+_CAPTION_BUILDERS = "daiv.datasets.builders.caption_builder"
+_VQA_BUILDERS = "daiv.datasets.builders.vqa_builder"
+
+# builder modules are imported when a builder is first used, see Registry.register_lazy
+_BUILDER_MODULES = {
+    "coco_caption": _CAPTION_BUILDERS,
+    "flickr30k": _CAPTION_BUILDERS,
+    "llava_pretrain": _CAPTION_BUILDERS,
+    "nocaps": _CAPTION_BUILDERS,
+    "textcaps": _CAPTION_BUILDERS,
+    "aok_vqa": _VQA_BUILDERS,
+    "coco_vqa": _VQA_BUILDERS,
+    "docvqa": _VQA_BUILDERS,
+    "llavavqa": _VQA_BUILDERS,
+    "ocrvqa": _VQA_BUILDERS,
+    "ok_vqa": _VQA_BUILDERS,
+    "stvqa": _VQA_BUILDERS,
+    "textvqa": _VQA_BUILDERS,
+    "vqg_aok_vqa": _VQA_BUILDERS,
+    "vqg_coco_vqa": _VQA_BUILDERS,
+    "vqg_ok_vqa": _VQA_BUILDERS,
+}
+for _name, _module in _BUILDER_MODULES.items():
+    registry.register_lazy("builder", _name, _module)
 
 __all__ = [
     "COCOCapBuilder",
@@ -45,6 +51,16 @@ __all__ = [
     "DocVQABuilder"
 ]
 
+__getattr__ = lazy_getattr(
+    __name__,
+    {
+        name: _CAPTION_BUILDERS
+        if name in ["COCOCapBuilder", "TextCapsBuilder", "NoCapBuilder", "LLaVAPretrainBuilder", "Flickr30kBuilder"]
+        else _VQA_BUILDERS
+        for name in __all__
+    },
+)
+
 
 def load_dataset(name, cfg_path=None, vis_path=None, data_type=None):
     """
@@ -85,10 +101,12 @@ def load_dataset(name, cfg_path=None, vis_path=None, data_type=None):
 
 
 class DatasetZoo:
-    def __init__(self) -> None:
-        self.dataset_zoo = {
-            k: list(v.DATASET_CONFIG_DICT.keys())
-            for k, v in sorted(registry.mapping["builder_name_mapping"].items())
+    @property
+    def dataset_zoo(self):
+        # imports every builder module
+        return {
+            k: list(registry.get_builder_class(k).DATASET_CONFIG_DICT.keys())
+            for k in registry.list_datasets()
         }
 
     def get_names(self):
@@ -12,22 +12,22 @@ import random as rnd
 import tarfile
 import zipfile
 
-import decord
-import webdataset as wds
 import numpy as np
 import torch
 from torch.utils.data.dataset import IterableDataset, ChainDataset
-from decord import VideoReader
 from daiv.common.registry import registry
 from daiv.datasets.datasets.base_dataset import ConcatDataset
 from tqdm import tqdm
 
-decord.bridge.set_bridge("torch")
 MAX_INT = registry.get("MAX_INT")
 
 
 def load_video(video_path, n_frms=MAX_INT, height=-1, width=-1, sampling="uniform"):
-    vr = VideoReader(uri=video_path, height=height, width=width)
+    # imported here, only video datasets need decord
+    import decord
+
+    decord.bridge.set_bridge("torch")
+    vr = decord.VideoReader(uri=video_path, height=height, width=width)
 
     vlen = len(vr)
     start, end = 0, vlen
@@ -131,6 +131,8 @@ def concat_datasets(datasets):
         element is a chained DataPipeline dataset.
 
     """
+    import webdataset as wds
+
     # concatenate datasets in the same split
     for split_name in datasets:
         if split_name != "train":
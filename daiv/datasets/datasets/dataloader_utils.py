@@ -5,11 +5,13 @@
  For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
 """
 
+import itertools
+import logging
 import time
 import random
 import torch
 from daiv.datasets.data_utils import move_to_cuda
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 
 
 class MultiIterLoader:
@@ -36,12 +38,33 @@ class MultiIterLoader:
             print("MultiIterLoader ratios: {}".format(ratios))
         self.loaders = loaders
         self.ratios = ratios
+        # own generator so that the loader choices can be checkpointed
+        self._random = random.Random(random.getrandbits(64))
 
     def __next__(self):
         # random sample from each loader by ratio
-        loader_idx = random.choices(range(len(self.loaders)), self.ratios, k=1)[0]
+        loader_idx = self._random.choices(range(len(self.loaders)), self.ratios, k=1)[0]
         return next(self.loaders[loader_idx])
 
+    def state_dict(self):
+        return {
+            "random": self._random.getstate(),
+            "loaders": [
+                loader.state_dict() if hasattr(loader, "state_dict") else None
+                for loader in self.loaders
+            ],
+        }
+
+    def load_state_dict(self, state_dict):
+        self._random.setstate(state_dict["random"])
+        for loader, loader_state in zip(self.loaders, state_dict["loaders"]):
+            if loader_state is None:
+                continue
+            if not hasattr(loader, "load_state_dict"):
+                logging.warning("Cannot restore the position of {}.".format(type(loader).__name__))
+                continue
+            loader.load_state_dict(loader_state)
+
 
 class PrefetchLoader(object):
     """
@@ -124,37 +147,197 @@ def record_cuda_stream(batch):
         pass
 
 
+class ResumableSampler:
+    """
+    Wrap a sampler so that the next epoch can start at a given index.
+
+    Skipped indices are dropped before they reach the dataset, so fast-forwarding
+    does not load or decode any sample.
+    """
+
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.start_index = 0
+
+    def __iter__(self):
+        start_index, self.start_index = self.start_index, 0
+        return itertools.islice(iter(self.sampler), start_index, None)
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def set_epoch(self, epoch):
+        if hasattr(self.sampler, "set_epoch"):
+            self.sampler.set_epoch(epoch)
+
+
+PROMPT_TEXT_KEYS = ["text_input", "question", "prompt", "caption"]
+
+
+def dataset_annotations(dataset):
+    """
+    The annotation of every sample of a map-style dataset, including ConcatDataset
+    and Subset, or None when the dataset does not keep a per-sample annotation list.
+    """
+    if isinstance(dataset, Subset):
+        annotation = dataset_annotations(dataset.dataset)
+        if annotation is None:
+            return None
+        return [annotation[i] for i in dataset.indices]
+
+    if hasattr(dataset, "datasets"):
+        # ConcatDataset
+        annotations = [dataset_annotations(d) for d in dataset.datasets]
+        if any(annotation is None for annotation in annotations):
+            return None
+        return [ann for annotation in annotations for ann in annotation]
+
+    annotation = getattr(dataset, "annotation", None)
+    if isinstance(annotation, list) and len(annotation) == len(dataset):
+        return annotation
+    return None
+
+
+def estimate_prompt_lengths(dataset, tokenizer=None, text_keys=PROMPT_TEXT_KEYS):
+    """
+    Prompt length of every sample of a map-style dataset, read from its annotation
+    without loading images. Lengths are counted in tokens of ``tokenizer`` when
+    given, in whitespace-separated words otherwise. Samples without any of
+    ``text_keys`` get length 0.
+    """
+    annotation = dataset_annotations(dataset)
+    if annotation is None:
+        logging.warning(
+            "Cannot read prompts of {}, evaluation batches are not length grouped.".format(
+                type(dataset).__name__
+            )
+        )
+        return [0] * len(dataset)
+
+    texts = []
+    for ann in annotation:
+        text = next((ann[k] for k in text_keys if isinstance(ann.get(k), str)), "")
+        texts.append(text)
+
+    if tokenizer is not None:
+        return [len(ids) for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]]
+    return [len(text.split()) for text in texts]
+
+
+class LengthGroupedBatchSampler:
+    """
+    Batch sampler for evaluation that groups samples of similar prompt length.
+
+    Samples are sorted by length and cut into batches of batch_size, so that
+    batches carry little padding. Batches are then assigned to ranks greedily,
+    most expensive first to the least loaded rank, with the cost of a batch
+    estimated as its size times (longest length + cost_offset). cost_offset stands
+    for the length-independent work per sample, such as visual tokens and decoding.
+
+    All ranks compute the same assignment from the same lengths. ``indices`` lists
+    the dataset indices of this rank in iteration order, to restore the original
+    order of the results.
+    """
+
+    def __init__(self, lengths, batch_size, num_replicas=1, rank=0, cost_offset=0):
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+        order = sorted(range(len(lengths)), key=lambda i: (-lengths[i], i))
+        batches = [order[i : i + batch_size] for i in range(0, len(order), batch_size)]
+        costs = [len(b) * (lengths[b[0]] + cost_offset) for b in batches]
+
+        loads = [0] * num_replicas
+        assigned = [[] for _ in range(num_replicas)]
+        for b in sorted(range(len(batches)), key=lambda b: (-costs[b], b)):
+            r = min(range(num_replicas), key=lambda r: (loads[r], r))
+            loads[r] += costs[b]
+            assigned[r].append(batches[b])
+
+        self.batches = assigned[rank]
+        self.loads = loads
+
+        logging.info(
+            "Length-grouped evaluation: {} batches on rank {}, estimated cost per rank {}.".format(
+                len(self.batches), rank, loads
+            )
+        )
+
+    @property
+    def indices(self):
+        return [i for batch in self.batches for i in batch]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
 class IterLoader:
     """
     A wrapper to convert DataLoader as an infinite iterator.
 
+    The position in the data stream (epoch and batches consumed in it) can be
+    saved and restored with state_dict() and load_state_dict(); the latter needs a
+    DataLoader built on a ResumableSampler.
+
     Modified from:
         https://github.com/open-mmlab/mmcv/blob/master/mmcv/runner/iter_based_runner.py
     """
 
     def __init__(self, dataloader: DataLoader, use_distributed: bool = False):
         self._dataloader = dataloader
-        self.iter_loader = iter(self._dataloader)
+        # created on first use, so that restoring a position does not start a
+        # throw-away iterator
+        self.iter_loader = None
         self._use_distributed = use_distributed
         self._epoch = 0
+        self._num_batches = 0
 
     @property
     def epoch(self) -> int:
         return self._epoch
 
+    def _set_epoch(self, epoch):
+        self._epoch = epoch
+        sampler = self._dataloader.sampler
+        if hasattr(sampler, "set_epoch") and (
+            self._use_distributed or isinstance(sampler, ResumableSampler)
+        ):
+            sampler.set_epoch(self._epoch)
+
     def __next__(self):
+        if self.iter_loader is None:
+            self.iter_loader = iter(self._dataloader)
+
         try:
             data = next(self.iter_loader)
         except StopIteration:
-            self._epoch += 1
-            if hasattr(self._dataloader.sampler, "set_epoch") and self._use_distributed:
-                self._dataloader.sampler.set_epoch(self._epoch)
+            self._set_epoch(self._epoch + 1)
+            self._num_batches = 0
             time.sleep(2)  # Prevent possible deadlock during epoch transition
             self.iter_loader = iter(self._dataloader)
             data = next(self.iter_loader)
 
+        self._num_batches += 1
         return data
 
+    def state_dict(self):
+        return {"epoch": self._epoch, "num_batches": self._num_batches}
+
+    def load_state_dict(self, state_dict):
+        sampler = self._dataloader.sampler
+        assert isinstance(
+            sampler, ResumableSampler
+        ), "Restoring the loader position requires a ResumableSampler."
+
+        self._set_epoch(state_dict["epoch"])
+        self._num_batches = state_dict["num_batches"]
+        sampler.start_index = self._num_batches * self._dataloader.batch_size
+        self.iter_loader = None
+
     def __iter__(self):
         return self
 
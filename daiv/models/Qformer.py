@@ -175,6 +175,7 @@ class BertSelfAttention(nn.Module):
         encoder_attention_mask=None,
         past_key_value=None,
         output_attentions=False,
+        cross_key_value=None,
     ):
 
         # If this is instantiated as a cross-attention module, the keys
@@ -183,8 +184,13 @@ class BertSelfAttention(nn.Module):
         is_cross_attention = encoder_hidden_states is not None
 
         if is_cross_attention:
-            key_layer = self.transpose_for_scores(self.key(encoder_hidden_states))
-            value_layer = self.transpose_for_scores(self.value(encoder_hidden_states))
+            if cross_key_value is not None:
+                # projected once for several calls, see BertModel.project_cross_attention;
+                # a single row is broadcast over the batch
+                key_layer, value_layer = cross_key_value
+            else:
+                key_layer = self.transpose_for_scores(self.key(encoder_hidden_states))
+                value_layer = self.transpose_for_scores(self.value(encoder_hidden_states))
             attention_mask = encoder_attention_mask
         elif past_key_value is not None:
             key_layer = self.transpose_for_scores(self.key(hidden_states))
@@ -328,6 +334,7 @@ class BertAttention(nn.Module):
         encoder_attention_mask=None,
         past_key_value=None,
         output_attentions=False,
+        cross_key_value=None,
     ):
         self_outputs = self.self(
             hidden_states,
@@ -337,6 +344,7 @@ class BertAttention(nn.Module):
             encoder_attention_mask,
             past_key_value,
             output_attentions,
+            cross_key_value,
         )
         attention_output = self.output(self_outputs[0], hidden_states)
 
@@ -409,6 +417,7 @@ class BertLayer(nn.Module):
         past_key_value=None,
         output_attentions=False,
         query_length=0,
+        cross_key_value=None,
     ):
         # decoder uni-directional self-attention cached key/values tuple is at positions 1,2
         self_attn_past_key_value = (
@@ -440,6 +449,7 @@ class BertLayer(nn.Module):
                     encoder_hidden_states,
                     encoder_attention_mask,
                     output_attentions=output_attentions,
+                    cross_key_value=cross_key_value,
                 )
                 query_attention_output = cross_attention_outputs[0]
                 outputs = (
@@ -505,6 +515,7 @@ class BertEncoder(nn.Module):
         output_hidden_states=False,
         return_dict=True,
         query_length=0,
+        cross_attention_key_values=None,
     ):
         all_hidden_states = () if output_hidden_states else None
         all_self_attentions = () if output_attentions else None
@@ -521,6 +532,11 @@ class BertEncoder(nn.Module):
 
             layer_head_mask = head_mask[i] if head_mask is not None else None
             past_key_value = past_key_values[i] if past_key_values is not None else None
+            cross_key_value = (
+                cross_attention_key_values[i]
+                if cross_attention_key_values is not None
+                else None
+            )
 
             if getattr(self.config, "gradient_checkpointing", False) and self.training:
 
@@ -533,7 +549,11 @@ class BertEncoder(nn.Module):
                 def create_custom_forward(module):
                     def custom_forward(*inputs):
                         return module(
-                            *inputs, past_key_value, output_attentions, query_length
+                            *inputs,
+                            past_key_value,
+                            output_attentions,
+                            query_length,
+                            cross_key_value,
                         )
 
                     return custom_forward
@@ -556,6 +576,7 @@ class BertEncoder(nn.Module):
                     past_key_value,
                     output_attentions,
                     query_length,
+                    cross_key_value,
                 )
 
             hidden_states = layer_outputs[0]
@@ -801,6 +822,28 @@ class BertModel(BertPreTrainedModel):
         extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
         return extended_attention_mask
 
+    def project_cross_attention(self, encoder_hidden_states):
+        """
+        Project encoder_hidden_states to the keys and values of every
+        cross-attention layer, once, so that several forward passes against
+        the same image can share them through ``cross_attention_key_values``.
+        Layers without cross-attention get None.
+        """
+        key_values = ()
+        for layer in self.encoder.layer:
+            if not layer.has_cross_attention:
+                key_values += (None,)
+                continue
+
+            attn = layer.crossattention.self
+            key_values += (
+                (
+                    attn.transpose_for_scores(attn.key(encoder_hidden_states)),
+                    attn.transpose_for_scores(attn.value(encoder_hidden_states)),
+                ),
+            )
+        return key_values
+
     def forward(
         self,
         input_ids=None,
@@ -816,6 +859,7 @@ class BertModel(BertPreTrainedModel):
         output_hidden_states=None,
         return_dict=None,
         is_decoder=False,
+        cross_attention_key_values=None,
     ):
         r"""
         encoder_hidden_states  (:obj:`torch.FloatTensor` of shape :obj:`(batch_size, sequence_length, hidden_size)`, `optional`):
@@ -834,6 +878,9 @@ class BertModel(BertPreTrainedModel):
         use_cache (:obj:`bool`, `optional`):
             If set to :obj:`True`, :obj:`past_key_values` key value states are returned and can be used to speed up
             decoding (see :obj:`past_key_values`).
+        cross_attention_key_values (:obj:`tuple`, `optional`):
+            Keys and values of the cross-attention layers computed from :obj:`encoder_hidden_states` by
+            :meth:`project_cross_attention`, used instead of projecting :obj:`encoder_hidden_states` again.
         """
         output_attentions = (
             output_attentions
@@ -946,6 +993,7 @@ class BertModel(BertPreTrainedModel):
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
             query_length=query_length,
+            cross_attention_key_values=cross_attention_key_values,
         )
         sequence_output = encoder_outputs[0]
         pooled_output = (
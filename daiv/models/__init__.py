@@ -8,23 +8,43 @@
 import logging
 import torch
 from omegaconf import OmegaConf
-from daiv.common.registry import registry
+from daiv.common.registry import lazy_getattr, registry
 
 from daiv.models.base_model import BaseModel
 
-from daiv.models.blip2 import Blip2Base
-from daiv.models.blip2_vicuna_instruct import Blip2VicunaInstruct
-from daiv.models.blip2_t5_instruct import Blip2T5Instruct
-from daiv.models.bliva_flant5xxl import BLIVAFlanT5
-from daiv.models.bliva_vicuna7b import BLIVAVicuna
-from daiv.models.pretrain_bliva_vicuna7b import PretrainBLIVAVicuna
-from daiv.models.pretrain_bliva_flant5 import PretrainBlivaT5
-from daiv.models.bliva_vicuna7b_lora import BlivaVicunaLoRA
-from daiv.models.vit import VisionTransformerEncoder
-from daiv.models.blip2_qformer import Blip2Qformer
+from daiv.processors.base_processor import BaseProcessor
 
 
-from daiv.processors.base_processor import BaseProcessor
+# model modules are imported when their class is first used, see Registry.register_lazy
+_MODEL_MODULES = {
+    "blip2": "daiv.models.blip2_qformer",
+    "blip2_feature_extractor": "daiv.models.blip2_qformer",
+    "blip2_t5_instruct": "daiv.models.blip2_t5_instruct",
+    "blip2_vicuna_instruct": "daiv.models.blip2_vicuna_instruct",
+    "bliva_flant5": "daiv.models.bliva_flant5xxl",
+    "bliva_vicuna": "daiv.models.bliva_vicuna7b",
+    "bliva_vicuna_lora": "daiv.models.bliva_vicuna7b_lora",
+    "pretrain_bliva_flant5": "daiv.models.pretrain_bliva_flant5",
+    "pretrain_bliva_vicuna": "daiv.models.pretrain_bliva_vicuna7b",
+}
+for _name, _module in _MODEL_MODULES.items():
+    registry.register_lazy("model", _name, _module)
+
+__getattr__ = lazy_getattr(
+    __name__,
+    {
+        "Blip2Base": "daiv.models.blip2",
+        "Blip2VicunaInstruct": "daiv.models.blip2_vicuna_instruct",
+        "Blip2T5Instruct": "daiv.models.blip2_t5_instruct",
+        "BLIVAFlanT5": "daiv.models.bliva_flant5xxl",
+        "BLIVAVicuna": "daiv.models.bliva_vicuna7b",
+        "PretrainBLIVAVicuna": "daiv.models.pretrain_bliva_vicuna7b",
+        "PretrainBlivaT5": "daiv.models.pretrain_bliva_flant5",
+        "BlivaVicunaLoRA": "daiv.models.bliva_vicuna7b_lora",
+        "VisionTransformerEncoder": "daiv.models.vit",
+        "Blip2Qformer": "daiv.models.blip2_qformer",
+    },
+)
 
 
 __all__ = [
@@ -187,10 +207,12 @@ class ModelZoo:
     >>> print(len(model_zoo))
     """
 
-    def __init__(self) -> None:
-        self.model_zoo = {
-            k: list(v.PRETRAINED_MODEL_CONFIG_DICT.keys())
-            for k, v in registry.mapping["model_name_mapping"].items()
+    @property
+    def model_zoo(self):
+        # imports every model module
+        return {
+            k: list(registry.get_model_class(k).PRETRAINED_MODEL_CONFIG_DICT.keys())
+            for k in registry.list_models()
         }
 
     def __str__(self) -> str:
@@ -0,0 +1,82 @@
+"""
+ Copyright (c) 2023, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+"""
+
+import weakref
+
+import torch
+from transformers import LogitsProcessor
+
+
+class AnswerTrie:
+    """
+    Token-level prefix trie over a closed answer vocabulary.
+
+    Every answer is stored as its token ids followed by the eos token, so a
+    sequence is complete exactly when it reaches a leaf.
+    """
+
+    def __init__(self, sequences):
+        self.root = {}
+        self.max_depth = 0
+
+        for sequence in sequences:
+            node = self.root
+            for token_id in sequence:
+                node = node.setdefault(token_id, {})
+            self.max_depth = max(self.max_depth, len(sequence))
+
+    def allowed_tokens(self, prefix):
+        node = self.root
+        for token_id in prefix:
+            if token_id not in node:
+                return []
+            node = node[token_id]
+        return list(node.keys())
+
+
+_ANSWER_TRIES = weakref.WeakKeyDictionary()
+
+
+def get_answer_trie(tokenizer, answer_list):
+    """
+    Build the trie of ``answer_list`` once and cache it per tokenizer.
+    """
+    tries = _ANSWER_TRIES.setdefault(tokenizer, {})
+    key = tuple(answer_list)
+
+    if key not in tries:
+        token_ids = tokenizer(list(answer_list), add_special_tokens=False).input_ids
+        tries[key] = AnswerTrie([ids + [tokenizer.eos_token_id] for ids in token_ids])
+
+    return tries[key]
+
+
+class TrieConstrainedLogitsProcessor(LogitsProcessor):
+    """
+    Restrict generation to the continuations allowed by an AnswerTrie.
+
+    The length of ``input_ids`` at the first call is taken as the prompt length,
+    which covers both decoder-only models generating from inputs_embeds (empty
+    prompt) and encoder-decoder models (decoder start token). Finished sequences
+    may only continue with ``fallback_token_ids`` (eos/pad).
+    """
+
+    def __init__(self, trie, fallback_token_ids):
+        self.trie = trie
+        self.fallback_token_ids = fallback_token_ids
+        self.prompt_length = None
+
+    def __call__(self, input_ids, scores):
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.size(1)
+
+        mask = torch.full_like(scores, float("-inf"))
+        for row, prefix in enumerate(input_ids[:, self.prompt_length :].tolist()):
+            allowed = self.trie.allowed_tokens(prefix)
+            mask[row, allowed if len(allowed) > 0 else self.fallback_token_ids] = 0
+
+        return scores + mask
@@ -5,6 +5,7 @@
  For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
 """
 import contextlib
+import hashlib
 import logging
 import os
 import time
@@ -14,25 +15,62 @@ import torch
 import torch.nn as nn
 import torch.distributed as dist
 import torch.nn.functional as F
+from transformers import BatchEncoding
 
 import daiv.common.dist_utils as dist_utils
 from daiv.common.dist_utils import download_cached_file
+from daiv.common.lemmatizer import get_lemmatizer
 from daiv.common.utils import is_url
-from daiv.common.logger import MetricLogger
 from daiv.models.base_model import BaseModel
+from daiv.models.answer_trie import TrieConstrainedLogitsProcessor, get_answer_trie
 from daiv.models.Qformer import BertConfig, BertLMHeadModel
-from daiv.models.eva_vit import create_eva_vit_g
-from daiv.models.clip_vit import create_clip_vit_L
-from transformers import BertTokenizer
+from daiv.models.eva_vit import EVA_VIT_G_URL, create_eva_vit_g
+from daiv.models.eva_vit import interpolate_pos_embed as interpolate_eva_pos_embed
+from daiv.models.clip_vit import CLIP_VIT_L_URL, create_clip_vit_L
+from daiv.models.clip_vit import interpolate_pos_embed as interpolate_clip_pos_embed
+from daiv.models.lazy_init import (
+    WeightSource,
+    load_weights_into_empty_model,
+    resolve_checkpoint_file,
+)
+from daiv.models.quantization import quantize_model
+from daiv.models.retrieval import EmbeddingIndex, chunked_topk, rerank_itm
+from daiv.models.vision_pool import (
+    extract_vision_features,
+    get_vision_encoder,
+    register_vision_encoder,
+)
+from transformers import BertTokenizer, LogitsProcessorList
 
 
 class Blip2Base(BaseModel):
+    # name or local path of the BERT checkpoint the Q-Former and its tokenizer start from
+    bert_model = "bert-base-uncased"
+    # shortens the patch tokens fed to the LLM, see daiv/models/token_reducer.py
+    token_reducer = None
+    # pool key of a vision encoder shared with other models, see daiv/models/vision_pool.py
+    vision_encoder_key = None
+    # generate() accepts precomputed "inputs_llm" and "add_feature_llm", see daiv/models/inference_cache.py
+    accepts_image_embeddings = False
+
     @classmethod
     def init_tokenizer(cls, truncation_side="right"):
-        tokenizer = BertTokenizer.from_pretrained("bert-base-uncased", truncation_side=truncation_side)
+        tokenizer = BertTokenizer.from_pretrained(cls.bert_model, truncation_side=truncation_side)
         tokenizer.add_special_tokens({"bos_token": "[DEC]"})
         return tokenizer
 
+    def project_patch_features(self, image_features):
+        """
+        Penultimate ViT layer output -> patch embeddings of the LLM prefix: drop
+        the CLS token, reduce the patch tokens if a token reducer is configured
+        and apply vision_project.
+        """
+        image_features = image_features[:, 1:]
+        if self.token_reducer is not None:
+            image_features = self.token_reducer(image_features)
+
+        return self.vision_project(image_features)
+
     def maybe_autocast(self, dtype=torch.float16):
         # if on cpu, don't use autocast
         # if on gpu, use autocast with dtype if provided, otherwise use torch.float16
@@ -44,16 +82,19 @@ class Blip2Base(BaseModel):
             return contextlib.nullcontext()
 
     @classmethod
-    def init_Qformer(cls, num_query_token, vision_width, cross_attention_freq=2):
-        encoder_config = BertConfig.from_pretrained("bert-base-uncased")
+    def init_Qformer(cls, num_query_token, vision_width, cross_attention_freq=2, load_weights=True):
+        encoder_config = BertConfig.from_pretrained(cls.bert_model)
         encoder_config.encoder_width = vision_width
         # insert cross-attention layer every other block
         encoder_config.add_cross_attention = True
         encoder_config.cross_attention_freq = cross_attention_freq
         encoder_config.query_length = num_query_token
-        Qformer = BertLMHeadModel.from_pretrained(
-            "bert-base-uncased", config=encoder_config
-        )
+        if load_weights:
+            Qformer = BertLMHeadModel.from_pretrained(
+                cls.bert_model, config=encoder_config
+            )
+        else:
+            Qformer = BertLMHeadModel(encoder_config)
         query_tokens = nn.Parameter(
             torch.zeros(1, num_query_token, encoder_config.hidden_size)
         )
@@ -61,29 +102,69 @@ class Blip2Base(BaseModel):
         return Qformer, query_tokens
 
     def init_vision_encoder(
-        self, model_name, img_size, drop_path_rate, use_grad_checkpoint, precision
+        self, model_name, img_size, drop_path_rate, use_grad_checkpoint, precision, load_weights=True, shared=False
     ):
+        """
+        With shared=True, models of the process asking for the same frozen
+        encoder (model_name, img_size, precision and pretrained weights) get
+        one instance, and the features of an image are computed once for all
+        of them. ln_vision is never shared.
+        """
         assert model_name in [
             "eva_clip_g",
             "eva2_clip_L",
             "clip_L",
             'cpe_eva_clip_g'
         ], "vit model must be eva_clip_g, eva2_clip_L or clip_L or cpe_eva_clip_g"
-        if model_name == "eva_clip_g":
-            visual_encoder = create_eva_vit_g(
-                img_size, drop_path_rate, use_grad_checkpoint, precision
-            )
-#         elif model_name == "eva2_clip_L":
-#             visual_encoder = create_eva2_vit_L(
-#                 img_size, drop_path_rate, use_grad_checkpoint, precision
-#             )
-        elif model_name == "clip_L":
-            visual_encoder = create_clip_vit_L(img_size, use_grad_checkpoint, precision)
+
+        def build():
+            if model_name == "eva_clip_g":
+                visual_encoder = create_eva_vit_g(
+                    img_size, drop_path_rate, use_grad_checkpoint, precision, load_weights
+                )
+#             elif model_name == "eva2_clip_L":
+#                 visual_encoder = create_eva2_vit_L(
+#                     img_size, drop_path_rate, use_grad_checkpoint, precision
+#                 )
+            elif model_name == "clip_L":
+                visual_encoder = create_clip_vit_L(img_size, use_grad_checkpoint, precision, load_weights)
+            return visual_encoder
+
+        if shared:
+            vit_url = EVA_VIT_G_URL if model_name == "eva_clip_g" else CLIP_VIT_L_URL
+            self.vision_encoder_key = (model_name, img_size, precision, vit_url)
+            visual_encoder = get_vision_encoder(self.vision_encoder_key, build, register=load_weights)
+        else:
+            visual_encoder = build()
             
         ln_vision = LayerNorm(visual_encoder.num_features)
         self.vit_name = model_name
         return visual_encoder, ln_vision
 
+    def vision_features(self, image):
+        """
+        Last and penultimate ViT layer outputs of ``image`` from one ViT pass.
+        """
+        return extract_vision_features(self.visual_encoder, image)
+
+    def load_state_dict(self, state_dict, strict=True):
+        if self.vision_encoder_key is None:
+            return super().load_state_dict(state_dict, strict=strict)
+
+        # a shared vision encoder keeps the pretrained weights it is pooled by,
+        # so its keys are neither loaded nor required by the strict check
+        state_dict = {k: v for k, v in state_dict.items() if not k.startswith("visual_encoder.")}
+        msg = super().load_state_dict(state_dict, strict=False)
+        msg.missing_keys[:] = [k for k in msg.missing_keys if not k.startswith("visual_encoder.")]
+
+        if strict and (msg.missing_keys or msg.unexpected_keys):
+            raise RuntimeError(
+                "Error(s) in loading state_dict for {}: missing keys {}, unexpected keys {}".format(
+                    type(self).__name__, msg.missing_keys, msg.unexpected_keys
+                )
+            )
+        return msg
+
     def load_from_pretrained(self, url_or_filename):
         if is_url(url_or_filename):
             cached_file = download_cached_file(
@@ -104,6 +185,138 @@ class Blip2Base(BaseModel):
 
         return msg
 
+    def init_missing_parameter(self, name, param):
+        """
+        Constructor initializer of a parameter under lazy_init that no weight
+        source provides and no reset_parameters() covers. Returns whether
+        ``name`` was initialized.
+        """
+        if name == "query_tokens":
+            param.data.normal_(mean=0.0, std=self.Qformer.config.initializer_range)
+            return True
+        return False
+
+    def lazy_weight_sources(self, cfg):
+        """
+        Weight sources for a model built under init_empty_weights(), in the order the
+        eager constructor would load them. Subclasses append their language model.
+        """
+
+        def vision_transform(state_dict):
+            if self.vit_name == "eva_clip_g":
+                interpolate_eva_pos_embed(self.visual_encoder, state_dict)
+            else:
+                interpolate_clip_pos_embed(self.visual_encoder, state_dict)
+            return state_dict
+
+        def qformer_transform(state_dict):
+            # old bert checkpoints name layernorm parameters gamma/beta
+            return {
+                k.replace("LayerNorm.gamma", "LayerNorm.weight").replace(
+                    "LayerNorm.beta", "LayerNorm.bias"
+                ): v
+                for k, v in state_dict.items()
+            }
+
+        def qformer_files():
+            from transformers.utils import cached_file
+
+            return [cached_file(self.bert_model, "pytorch_model.bin")]
+
+        vit_url = EVA_VIT_G_URL if self.vit_name == "eva_clip_g" else CLIP_VIT_L_URL
+
+        return [
+            WeightSource(
+                lambda: [resolve_checkpoint_file(vit_url)],
+                prefix="visual_encoder.",
+                transform=vision_transform,
+                name=self.vit_name,
+            ),
+            WeightSource(
+                qformer_files,
+                prefix="Qformer.",
+                transform=qformer_transform,
+                name=self.bert_model,
+            ),
+        ]
+
+    def load_lazy_weights_from_config(self, cfg):
+        """
+        Materialize a model built under init_empty_weights().
+
+        Pretrained component weights and the checkpoint named in the config are
+        treated as one ordered list of sources, so each parameter is read once,
+        directly in its target dtype, from the last source that defines it.
+        A pre-quantized checkpoint replaces all other sources.
+        """
+        quantization_cfg = cfg.get("quantization", None)
+        if quantization_cfg is not None and quantization_cfg.get("checkpoint", None):
+            checkpoint = quantization_cfg.checkpoint
+            # create empty quantized layers, then fill them from the checkpoint
+            quantize_model(self, quantization_cfg)
+            msg = load_weights_into_empty_model(
+                self, [WeightSource(lambda: [resolve_checkpoint_file(checkpoint)], name=checkpoint)]
+            )
+            self._register_shared_vision_encoder()
+            return msg
+
+        sources = self.lazy_weight_sources(cfg)
+
+        if cfg.get("load_finetuned", True):
+            checkpoint = cfg.get("finetuned", None)
+            assert (
+                checkpoint is not None
+            ), "Found load_finetuned is True, but finetune_path is None."
+        elif cfg.get("load_pretrained", True):
+            checkpoint = cfg.get("pretrained", None)
+        else:
+            checkpoint = None
+
+        if checkpoint is not None:
+            sources.append(
+                WeightSource(
+                    lambda: [resolve_checkpoint_file(checkpoint)], name=checkpoint
+                )
+            )
+
+        msg = load_weights_into_empty_model(self, sources)
+        self._register_shared_vision_encoder()
+        return msg
+
+    def _register_shared_vision_encoder(self):
+        # built without weights under lazy_init, it can be shared once loaded
+        if self.vision_encoder_key is not None:
+            register_vision_encoder(self.vision_encoder_key, self.visual_encoder)
+
+    @staticmethod
+    def lazy_init_from_config(cfg):
+        """
+        Whether to build the model on the meta device: with lazy_init, and always
+        for a pre-quantized checkpoint, whose weights then go straight into empty
+        quantized layers without materializing the full-precision model first.
+        """
+        quantization_cfg = cfg.get("quantization", None)
+        pre_quantized = quantization_cfg is not None and bool(quantization_cfg.get("checkpoint", None))
+        return cfg.get("lazy_init", False) or pre_quantized
+
+    def quantize_from_config(self, cfg):
+        """
+        Apply weight-only int8/int4 quantization if the model config has a quantization
+        section. A pre-quantized checkpoint (quantization.checkpoint, saved by
+        quantize.py) was already loaded into empty quantized layers by
+        load_lazy_weights_from_config(). Quantizing at load time instead needs the
+        full-precision weights in memory first, so it does not lower peak memory.
+        """
+        quantization_cfg = cfg.get("quantization", None)
+        if quantization_cfg is None:
+            return
+
+        assert self.vision_encoder_key is None or "visual_encoder" not in quantization_cfg.get(
+            "modules", []
+        ), "A shared vision encoder cannot be quantized by one of its models."
+        if not quantization_cfg.get("checkpoint", None):
+            quantize_model(self, quantization_cfg)
+
     def get_optimizer_params(self, weight_decay, lr_scale=1):
         if self.vit_name == "eva_clip_g":
             vit_num_layers = self.visual_encoder.get_num_layer()
@@ -151,42 +364,55 @@ class Blip2Base(BaseModel):
         else:
             return super().get_optimizer_params(weight_decay,lr_scale)
 
-    def _lemmatize(self, answers):
-        def apply(answer):
-            doc = self.lemmatizer(answer)
+    def _predict_answers_from_list(
+        self, samples, answer_list, tokenizer, inference_method="constrained", num_beams=5, length_penalty=0
+    ):
+        """
+        Answer closed-vocabulary questions with decoding restricted to ``answer_list``.
+
+        "constrained" returns the best answer of trie-constrained beam search (greedy
+        if num_beams=1). "rank" keeps the num_beams best constrained answers of every
+        sample and picks the one with the lowest language modeling loss.
+        """
+        trie = get_answer_trie(tokenizer, answer_list)
+        fallback_token_ids = [tokenizer.eos_token_id]
+        if tokenizer.pad_token_id is not None:
+            fallback_token_ids.append(tokenizer.pad_token_id)
+        logits_processor = LogitsProcessorList(
+            [TrieConstrainedLogitsProcessor(trie, fallback_token_ids)]
+        )
 
-            words = []
-            for token in doc:
-                if token.pos_ in ["NOUN", "VERB"]:
-                    words.append(token.lemma_)
-                else:
-                    words.append(token.text)
-            answer = " ".join(words)
+        num_captions = num_beams if inference_method == "rank" else 1
+        output_text = self.generate(
+            samples,
+            num_beams=num_beams,
+            max_length=trie.max_depth,
+            min_length=1,
+            length_penalty=length_penalty,
+            num_captions=num_captions,
+            logits_processor=logits_processor,
+        )
+
+        if inference_method != "rank":
+            return output_text
+
+        candidates = []
+        for i in range(len(output_text) // num_captions):
+            this_candidates = output_text[i * num_captions : (i + 1) * num_captions]
+            candidates.append(list(dict.fromkeys(this_candidates)))
 
-            return answer
+        ranks = self.predict_class(
+            {"image": samples["image"], "prompt": samples["prompt"]}, candidates
+        )
+
+        return [candidates[i][int(ranks[i][0])] for i in range(len(candidates))]
 
-        return [apply(answer) for answer in answers]
+    def _lemmatize(self, answers):
+        return self.lemmatizer(answers)
 
     @property
     def lemmatizer(self):
-        if self._lemmatizer is None:
-            try:
-                import spacy
-
-                self._lemmatizer = spacy.load("en_core_web_sm")
-            except ImportError:
-                logging.error(
-                    """
-                    Please install spacy and en_core_web_sm model to apply lemmatization.
-                    python -m spacy download en_core_web_sm
-                    OR
-                    import spacy.cli
-                    spacy.cli.download("en_core_web_sm")
-                    """
-                )
-                exit(1)
-
-        return self._lemmatizer
+        return get_lemmatizer()
 
 def disabled_train(self, mode=True):
     """Overwrite model.train with this function to make sure train/eval mode
@@ -203,117 +429,173 @@ class LayerNorm(nn.LayerNorm):
         return ret.type(orig_type)
 
 
+def _retrieval_index(index_dir, name, normalize=True):
+    return EmbeddingIndex(os.path.join(index_dir, name) if index_dir else None, normalize=normalize)
+
+
+@torch.no_grad()
+def _weights_fingerprint(model):
+    """
+    Hash of the names, shapes and sums of the model weights, stored with the
+    retrieval indexes so that indexes built with other weights are rebuilt.
+    """
+    fingerprint = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        fingerprint.update("{}:{}:{!r};".format(name, tuple(tensor.shape), tensor.double().sum().item()).encode())
+    return fingerprint.hexdigest()
+
+
+def _reusable(index, num_rows, weights):
+    return index.complete and len(index) == num_rows and index.info.get("weights") == weights
+
+
+@torch.no_grad()
+def _build_retrieval_indexes(model, data_loader, texts, text_ids, text_atts, index_dir, text_bs=256):
+    """
+    Normalized text and image embeddings and the image inputs of the ITM head,
+    reusing complete indexes of index_dir built with the same model weights.
+    """
+    text_index = _retrieval_index(index_dir, "text")
+    image_index = _retrieval_index(index_dir, "image")
+    vit_index = _retrieval_index(index_dir, "vit", normalize=False)
+
+    num_images = len(data_loader.dataset.image)
+    weights = _weights_fingerprint(model) if index_dir else None
+    if _reusable(text_index, len(texts), weights):
+        logging.info("Reusing text embeddings of {}".format(text_index.path))
+    else:
+        text_index.clear()
+        text_index.info["weights"] = weights
+        for i in range(0, len(texts), text_bs):
+            text_input = {
+                "input_ids": text_ids[i : i + text_bs].to(model.device),
+                "attention_mask": text_atts[i : i + text_bs].to(model.device),
+            }
+            text_index.add(model.forward_text(BatchEncoding(text_input)))
+        text_index.finalize()
+
+    if _reusable(image_index, num_images, weights) and _reusable(vit_index, num_images, weights):
+        logging.info("Reusing image embeddings of {}".format(image_index.path))
+    else:
+        image_index.clear()
+        vit_index.clear()
+        image_index.info["weights"] = vit_index.info["weights"] = weights
+        for samples in data_loader:
+            image = samples["image"].to(model.device)
+            image_feat, vit_feat = model.forward_image(image)
+            image_index.add(image_feat)
+            vit_index.add(vit_feat)
+        image_index.finalize()
+        vit_index.finalize()
+
+    return text_index, image_index, vit_index
+
+
+def _gather_topk(scores, indices):
+    """
+    Top-k of all queries from the contiguous query ranges of each rank.
+    """
+    if not dist_utils.is_dist_avail_and_initialized():
+        return scores, indices
+    gathered = [None] * dist_utils.get_world_size()
+    dist.all_gather_object(gathered, (scores, indices))
+    return torch.cat([s for s, _ in gathered]), torch.cat([i for _, i in gathered])
+
+
+def _dense_scores(scores, indices, num_candidates):
+    matrix = torch.full((scores.size(0), num_candidates), -100.0)
+    matrix.scatter_(1, indices, scores)
+    return matrix.numpy()
+
+
 def compute_sim_matrix(model, data_loader, **kwargs):
+    """
+    Image-to-text and text-to-image retrieval scores: the k_test candidates of
+    each query with the most similar embeddings, re-ranked with the ITM head.
+
+    The model gives pooled embeddings with forward_text() and forward_image(),
+    which also returns the ViT features compute_itm() scores against token ids.
+
+    Embeddings go to an EmbeddingIndex (on disk under index_dir, reused by
+    later runs with the same weights once complete, see
+    daiv/models/retrieval.py), top-k is taken chunk by chunk and ITM runs on
+    batches of itm_batch_size query-candidate pairs, so memory does not grow
+    with num_images x num_texts on device.
+
+    Returns dense [num_images, num_texts] and [num_texts, num_images] score
+    matrices on CPU (-100 outside the top-k), or with return_topk the
+    (scores, indices) [num_queries, k_test] of each direction, for galleries
+    too large for dense matrices.
+    """
     k_test = kwargs.pop("k_test")
-
-    metric_logger = MetricLogger(delimiter="  ")
-    header = "Evaluation:"
+    index_dir = kwargs.pop("index_dir", None)
+    chunk_size = kwargs.pop("chunk_size", 8192)
+    itm_batch_size = kwargs.pop("itm_batch_size", 512)
+    return_topk = kwargs.pop("return_topk", False)
 
     logging.info("Computing features for evaluation...")
     start_time = time.time()
 
     texts = data_loader.dataset.text
-    num_text = len(texts)
-    text_bs = 256
-    text_ids = []
-    text_embeds = []
-    text_atts = []
-    for i in range(0, num_text, text_bs):
-        text = texts[i : min(num_text, i + text_bs)]
-        text_input = model.tokenizer(
-            text,
-            padding="max_length",
-            truncation=True,
-            max_length=35,
-            return_tensors="pt",
-        ).to(model.device)
-        text_feat = model.forward_text(text_input)
-        text_embed = F.normalize(model.text_proj(text_feat))
-        text_embeds.append(text_embed)
-        text_ids.append(text_input.input_ids)
-        text_atts.append(text_input.attention_mask)
-
-    text_embeds = torch.cat(text_embeds, dim=0)
-    text_ids = torch.cat(text_ids, dim=0)
-    text_atts = torch.cat(text_atts, dim=0)
-
-    vit_feats = []
-    image_embeds = []
-    for samples in data_loader:
-        image = samples["image"]
-
-        image = image.to(model.device)
-        image_feat, vit_feat = model.forward_image(image)
-        image_embed = model.vision_proj(image_feat)
-        image_embed = F.normalize(image_embed, dim=-1)
-
-        vit_feats.append(vit_feat.cpu())
-        image_embeds.append(image_embed)
-
-    vit_feats = torch.cat(vit_feats, dim=0)
-    image_embeds = torch.cat(image_embeds, dim=0)
-
-    sims_matrix = []
-    for image_embed in image_embeds:
-        sim_q2t = image_embed @ text_embeds.t()
-        sim_i2t, _ = sim_q2t.max(0)
-        sims_matrix.append(sim_i2t)
-    sims_matrix = torch.stack(sims_matrix, dim=0)
-
-    score_matrix_i2t = torch.full(
-        (len(data_loader.dataset.image), len(texts)), -100.0
-    ).to(model.device)
+    num_images = len(data_loader.dataset.image)
+    text_input = model.tokenizer(
+        texts,
+        padding="max_length",
+        truncation=True,
+        max_length=35,
+        return_tensors="pt",
+    )
+    text_ids, text_atts = text_input.input_ids, text_input.attention_mask
+
+    # with an index_dir the main process builds the indexes, the others read them
+    if index_dir is None or dist_utils.is_main_process():
+        indexes = _build_retrieval_indexes(model, data_loader, texts, text_ids, text_atts, index_dir)
+    if dist_utils.is_dist_avail_and_initialized():
+        dist.barrier()
+    if index_dir is not None and not dist_utils.is_main_process():
+        indexes = (
+            _retrieval_index(index_dir, "text"),
+            _retrieval_index(index_dir, "image"),
+            _retrieval_index(index_dir, "vit", normalize=False),
+        )
+    text_index, image_index, vit_index = indexes
 
     num_tasks = dist_utils.get_world_size()
     rank = dist_utils.get_rank()
-    step = sims_matrix.size(0) // num_tasks + 1
-    start = rank * step
-    end = min(sims_matrix.size(0), start + step)
 
-    for i, sims in enumerate(
-        metric_logger.log_every(sims_matrix[start:end], 50, header)
-    ):
-        topk_sim, topk_idx = sims.topk(k=k_test, dim=0)
-        image_inputs = vit_feats[start + i].repeat(k_test, 1, 1).to(model.device)
-        score = model.compute_itm(
-            image_inputs=image_inputs,
-            text_ids=text_ids[topk_idx],
-            text_atts=text_atts[topk_idx],
-        ).float()
-        score_matrix_i2t[start + i, topk_idx] = score + topk_sim
-
-    sims_matrix = sims_matrix.t()
-    score_matrix_t2i = torch.full(
-        (len(texts), len(data_loader.dataset.image)), -100.0
-    ).to(model.device)
-
-    step = sims_matrix.size(0) // num_tasks + 1
-    start = rank * step
-    end = min(sims_matrix.size(0), start + step)
-
-    for i, sims in enumerate(
-        metric_logger.log_every(sims_matrix[start:end], 50, header)
-    ):
-        topk_sim, topk_idx = sims.topk(k=k_test, dim=0)
-        image_inputs = vit_feats[topk_idx.cpu()].to(model.device)
-        score = model.compute_itm(
-            image_inputs=image_inputs,
-            text_ids=text_ids[start + i].repeat(k_test, 1),
-            text_atts=text_atts[start + i].repeat(k_test, 1),
-        ).float()
-        score_matrix_t2i[start + i, topk_idx] = score + topk_sim
-
-    if dist_utils.is_dist_avail_and_initialized():
-        dist.barrier()
-        torch.distributed.all_reduce(
-            score_matrix_i2t, op=torch.distributed.ReduceOp.SUM
+    results = []
+    for queries, gallery, num_queries, queries_are_images in [
+        (image_index, text_index, num_images, True),
+        (text_index, image_index, len(texts), False),
+    ]:
+        step = num_queries // num_tasks + 1
+        start = rank * step
+        end = min(num_queries, start + step)
+
+        scores, indices = chunked_topk(
+            queries, gallery, k_test, device=model.device, start=start, end=end, gallery_chunk_size=chunk_size
+        )
+        scores = rerank_itm(
+            model,
+            scores,
+            indices,
+            vit_index,
+            text_ids,
+            text_atts,
+            queries_are_images=queries_are_images,
+            query_offset=start,
+            batch_size=itm_batch_size,
         )
-        torch.distributed.all_reduce(
-            score_matrix_t2i, op=torch.distributed.ReduceOp.SUM
+        logging.info(
+            "{} retrieval: {} queries re-ranked".format("i2t" if queries_are_images else "t2i", end - start)
         )
+        results.append(_gather_topk(scores, indices))
 
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     logging.info("Evaluation time {}".format(total_time_str))
 
-    return score_matrix_i2t.cpu().numpy(), score_matrix_t2i.cpu().numpy()
+    (i2t_scores, i2t_indices), (t2i_scores, t2i_indices) = results
+    if return_topk:
+        return (i2t_scores.numpy(), i2t_indices.numpy()), (t2i_scores.numpy(), t2i_indices.numpy())
+    return _dense_scores(i2t_scores, i2t_indices, len(texts)), _dense_scores(t2i_scores, t2i_indices, num_images)
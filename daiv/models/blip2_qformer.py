@@ -6,18 +6,48 @@ import torch.nn.functional as F
 import numpy as np
 
 from daiv.common.registry import registry
-from daiv.models.base_model import all_gather_with_grad, concat_all_gather
+from daiv.models.base_model import SharedQueueMixin, all_gather_with_grad, concat_all_gather
 from daiv.models.blip2 import Blip2Base, compute_sim_matrix, disabled_train
 from daiv.models.blip_outputs import BlipOutput, BlipOutputFeatures
 
 from daiv.models.dmformer.mcan.net import Net  # Importing the Net class from net.py
 from daiv.models.dmformer.mcan.net_utils import LayerNorm  # Importing LayerNorm
 from daiv.models.dmformer.dat.deformable_attention_1d import DeformableAttention1D
+from daiv.models.dmformer.mcan.mca import trim_padding
+
+
+def sample_hard_negatives(weights, num_negatives=1, top_k=0):
+    """
+    Indices [bs, num_negatives] of negatives drawn from each row of ``weights``
+    with one batched multinomial. With top_k > 0 only the top_k most likely
+    candidates of each row are considered.
+    """
+    if 0 < top_k < weights.size(1):
+        top_weights, top_idx = weights.topk(top_k, dim=1)
+        return top_idx.gather(1, torch.multinomial(top_weights, num_negatives))
+
+    return torch.multinomial(weights, num_negatives)
+
+
+def gather_negatives(candidates, idx, queue=None):
+    """
+    candidates[idx] for a tensor of indices; indices past the end of
+    candidates select from ``queue`` (earlier batches) instead.
+    """
+    if queue is None:
+        return candidates[idx]
+
+    num_candidates = candidates.size(0)
+    from_batch = candidates[idx.clamp(max=num_candidates - 1)]
+    from_queue = queue[(idx - num_candidates).clamp(min=0)].to(from_batch.dtype)
+    in_batch = (idx < num_candidates).view((-1,) + (1,) * (from_batch.dim() - 1))
+    return torch.where(in_batch, from_batch, from_queue)
+
 
 @registry.register_model("blip2")
 @registry.register_model("blip2_feature_extractor")
 
-class Blip2Qformer(Blip2Base):
+class Blip2Qformer(Blip2Base, SharedQueueMixin):
     """
     BLIP2 first-stage model with MCAN and ViT.
     """
@@ -54,7 +84,17 @@ class Blip2Qformer(Blip2Base):
         cross_attention_freq=2,
         embed_dim=512,
         max_txt_len=100,
+        itm_top_k=0,
+        itm_queue_size=0,
+        mcan_fast=False,
     ):
+        """
+        itm_top_k: draw ITM hard negatives among the top_k most similar candidates only
+            (0 for all candidates).
+        itm_queue_size: when > 0, also draw ITM negatives from a queue of the
+            embeddings of the last itm_queue_size samples (a multiple of the global batch size).
+        mcan_fast: run the MCAN backbone in its performance mode, see MCA_ED.forward_fast.
+        """
         super().__init__()
 
         self.tokenizer = self.init_tokenizer()
@@ -72,6 +112,7 @@ class Blip2Qformer(Blip2Base):
 
         # Initialize MCAN instead of Q-former
         self.MCAN = Net(self.Config, pretrained_emb=None, token_size=len(self.tokenizer), answer_size=embed_dim)  # Adjust arguments as necessary
+        self.MCAN.backbone.fast = mcan_fast
         
         #self.MCAN.resize_token_embeddings(len(self.tokenizer))
 
@@ -89,6 +130,23 @@ class Blip2Qformer(Blip2Base):
 
         self.max_txt_len = max_txt_len
 
+        self.itm_top_k = itm_top_k
+        self.queue_size = itm_queue_size
+        if itm_queue_size > 0:
+            # pooled features to score the queued samples, their token embeddings as negatives;
+            # idx_queue is -1 for empty slots and holds the image ids when they are known
+            num_image_tokens = self.visual_encoder.patch_embed.num_patches + 1
+            for name, shape, fill, dtype in [
+                ("image_queue", (self.Config.FLAT_OUT_SIZE, itm_queue_size), 0, torch.float),
+                ("text_queue", (self.Config.FLAT_OUT_SIZE, itm_queue_size), 0, torch.float),
+                ("idx_queue", (1, itm_queue_size), -1, torch.long),
+                ("queue_ptr", (1,), 0, torch.long),
+                ("image_embeds_queue", (itm_queue_size, num_image_tokens, self.Config.HIDDEN_SIZE), 0, torch.float),
+                ("text_embeds_queue", (itm_queue_size, max_txt_len, self.Config.HIDDEN_SIZE), 0, torch.float),
+                ("text_mask_queue", (itm_queue_size, 1, 1, max_txt_len), True, torch.bool),
+            ]:
+                self.register_buffer(name, torch.full(shape, fill, dtype=dtype), persistent=False)
+
         ##DAT ATTN
         self.dat = DeformableAttention1D(
                             dim = 257,
@@ -142,10 +200,14 @@ class Blip2Qformer(Blip2Base):
         # Using MCAN
 
         ##Encoder-Decoder
-        lang_feat, img_feat = self.MCAN.backbone(text_embeds, image_embeds, lang_feat_mask, img_feat_mask)
+        itc_text_embeds, itc_lang_mask = text_embeds, lang_feat_mask
+        if self.MCAN.backbone.fast:
+            # only pooled features are used here, the max_length padding can go
+            itc_text_embeds, itc_lang_mask = trim_padding(text_embeds, lang_feat_mask)
+        lang_feat, img_feat = self.MCAN.backbone(itc_text_embeds, image_embeds, itc_lang_mask, img_feat_mask)
         ##Flatten
         img_feat = self.MCAN.attflat_img(img_feat, img_feat_mask)
-        lang_feat = self.MCAN.attflat_lang(lang_feat, lang_feat_mask)
+        lang_feat = self.MCAN.attflat_lang(lang_feat, itc_lang_mask)
         ##Normalization
         image_feats = F.normalize(img_feat, dim=-1)
         text_feat = F.normalize(lang_feat, dim=-1)
@@ -217,27 +279,42 @@ class Blip2Qformer(Blip2Base):
                 sim_t2i[:, rank * bs: rank * bs + bs].fill_diagonal_(-10000)
                 sim_i2t[:, rank * bs: rank * bs + bs].fill_diagonal_(-10000)
 
+            if self.queue_size > 0:
+                # queued samples are candidates too, except empty slots and positives
+                queue_mask = (self.idx_queue == -1).expand(bs, -1)
+                if "image_id" in samples.keys():
+                    queue_mask = queue_mask | torch.eq(image_ids, self.idx_queue)
+                sim_t2i = torch.cat([sim_t2i, (text_feat @ self.image_queue).masked_fill(queue_mask, -10000)], dim=1)
+                sim_i2t = torch.cat([sim_i2t, (image_feats @ self.text_queue).masked_fill(queue_mask, -10000)], dim=1)
+
             weights_t2i = F.softmax(sim_t2i, dim=1)
             weights_i2t = F.softmax(sim_i2t, dim=1)
 
-        # Select a negative image for each text
-        image_embeds_neg = []
-        for b in range(bs):
-            neg_idx = torch.multinomial(weights_t2i[b], 1).item()
-            image_embeds_neg.append(image_embeds_world[neg_idx])
-        image_embeds_neg = torch.stack(image_embeds_neg, dim=0)
-        #print(f'image_embeds_neg size: {image_embeds_neg.size()}')
-
-        # Select a negative text for each image
-        text_ids_neg = []
-        text_atts_neg = []
-        for b in range(bs):
-            neg_idx = torch.multinomial(weights_i2t[b], 1).item()
-            text_ids_neg.append(text_input_ids_world[neg_idx])
-            text_atts_neg.append(text_attention_mask_world[neg_idx])
-
-        text_ids_neg = torch.stack(text_ids_neg, dim=0)
-        text_atts_neg = torch.stack(text_atts_neg, dim=0)
+            # one batched draw per direction instead of a multinomial (and a sync) per sample
+            neg_image_idx = sample_hard_negatives(weights_t2i, top_k=self.itm_top_k).squeeze(1)
+            neg_text_idx = sample_hard_negatives(weights_i2t, top_k=self.itm_top_k).squeeze(1)
+
+        # Select a negative image for each text and a negative text for each image
+        use_queue = self.queue_size > 0
+        image_embeds_neg = gather_negatives(
+            image_embeds_world, neg_image_idx, self.image_embeds_queue if use_queue else None
+        )
+        text_ids_neg = gather_negatives(
+            text_input_ids_world, neg_text_idx, self.text_embeds_queue if use_queue else None
+        )
+        text_atts_neg = gather_negatives(
+            text_attention_mask_world, neg_text_idx, self.text_mask_queue if use_queue else None
+        )
+
+        if use_queue:
+            self._enqueue_itm_samples(
+                image_embeds,
+                text_embeds,
+                lang_feat_mask,
+                image_feats,
+                text_feat,
+                image_ids if "image_id" in samples.keys() else None,
+            )
         #print(f'text_ids_neg size: {text_ids_neg.size()}')
         #print(f'text_atts_neg size: {text_atts_neg.size()}')
 
@@ -386,118 +463,108 @@ class Blip2Qformer(Blip2Base):
         captions = self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
         return captions
 
-    def forward_image(self, image):
-        image_embeds = self.ln_vision(self.visual_encoder(image))
-        image_embeds = self.MCAN.img_feat_linear(image_embeds)  # Project image features to the correct size
-        image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(image.device)
+    def _image_inputs(self, vit_embeds):
+        # ViT features -> MCAN image tokens and their mask
+        image_embeds = self.MCAN.img_feat_linear(vit_embeds)
+        img_feat_mask = self.MCAN.make_mask(image_embeds)
+        return self.dat(image_embeds), img_feat_mask
 
-        lang_feat_mask = self.MCAN.make_mask(image_embeds)
+    def _text_inputs(self, input_ids):
+        # token ids -> MCAN text tokens and their mask
+        text_embeds, _ = self.MCAN.lstm(self.MCAN.embedding(input_ids))
+        return text_embeds, self.MCAN.make_mask(input_ids.unsqueeze(2))
 
-        query_output = self.MCAN.backbone(
-            image_embeds,
-            image_embeds,
-            lang_feat_mask,
-            lang_feat_mask
-        )
-        return query_output, image_embeds
+    def forward_image(self, image):
+        """
+        Pooled image features [bs, FLAT_OUT_SIZE] (image_embeds_proj of
+        extract_features() before normalization) and the ViT features
+        [bs, num_patches+1, vision_width] that compute_itm() takes.
+        """
+        with self.maybe_autocast():
+            vit_embeds = self.ln_vision(self.visual_encoder(image))
+        vit_embeds = vit_embeds.float()
+
+        image_embeds, img_feat_mask = self._image_inputs(vit_embeds)
+        _, image_embeds = self.MCAN.backbone(image_embeds, image_embeds, img_feat_mask, img_feat_mask)
+        return self.MCAN.attflat_img(image_embeds, img_feat_mask), vit_embeds
 
     def forward_text(self, text_tokens):
-        text_embeds = self.MCAN.embedding(text_tokens.input_ids.to(self.device))
-        lang_feat_mask = self.MCAN.make_mask(text_tokens.input_ids.unsqueeze(2))
-        text_embeds, _ = self.MCAN.lstm(text_embeds)
-
-        text_output = self.MCAN.backbone(
-            text_embeds,
-            text_embeds,
-            lang_feat_mask,
-            lang_feat_mask
-        )
-        return text_output[:, 0, :]
+        """
+        Pooled text features [bs, FLAT_OUT_SIZE] (text_embeds_proj of
+        extract_features() before normalization) of tokenizer output.
+        """
+        text_embeds, lang_feat_mask = self._text_inputs(text_tokens.input_ids.to(self.device))
+        text_embeds, _ = self.MCAN.backbone(text_embeds, text_embeds, lang_feat_mask, lang_feat_mask)
+        return self.MCAN.attflat_lang(text_embeds, lang_feat_mask)
 
     def compute_itm(self, image_inputs, text_ids, text_atts):
-        image_inputs = self.MCAN.img_feat_linear(image_inputs)  # Project image features to the correct size
-        image_atts = torch.ones(image_inputs.size()[:-1], dtype=torch.long).to(image_inputs.device)
-        text_embeds = self.MCAN.embedding(text_ids.input_ids.to(image_inputs.device))
-        text_embeds, _ = self.MCAN.lstm(text_embeds)
-        lang_feat_mask = self.MCAN.make_mask(text_ids.input_ids.unsqueeze(2))
-
-        output_itm = self.MCAN.backbone(
-            text_embeds,
-            image_inputs,
-            lang_feat_mask,
-            image_atts
-        )
-        vl_embeddings = output_itm[:, :text_embeds.size(1), :]
+        """
+        ITM score of each (ViT features of forward_image(), token ids) pair.
+        Padding is masked from the token ids, as in training; text_atts is
+        kept for the common interface.
+        """
+        image_embeds, img_feat_mask = self._image_inputs(image_inputs)
+        text_embeds, lang_feat_mask = self._text_inputs(text_ids.to(image_inputs.device))
+
+        vl_embeddings, _ = self.MCAN.backbone(text_embeds, image_embeds, lang_feat_mask, img_feat_mask)
         itm_logit = self.itm_head(vl_embeddings)
         itm_logit = itm_logit[:, :, 1].mean(dim=1)
         return itm_logit
 
     @torch.no_grad()
     def extract_features(self, samples, mode="multimodal"):
+        """
+        Features of samples["image"] and / or samples["text_input"].
+
+        mode "image": image_embeds [bs, num_patches+1, H] from the MCAN backbone
+            and the pooled, normalized image_embeds_proj [bs, FLAT_OUT_SIZE].
+        mode "text": text_embeds [bs, seq_len, H] and text_embeds_proj [bs, FLAT_OUT_SIZE].
+        mode "multimodal": multimodal_embeds [bs, seq_len, H], the text tokens
+            co-attended with the image, and multimodal_embeds_proj [bs, FLAT_OUT_SIZE]
+            pooled by attflat_lang and normalized.
+        """
         image = samples.get("image")
         caption = samples.get("text_input")
 
         assert mode in ["image", "text", "multimodal"], "mode must be one of 'image', 'text', 'multimodal'"
 
         image_embeds, text_embeds, multimodal_embeds = None, None, None
-        image_features, text_features = None, None
+        image_features, text_features, multimodal_features = None, None, None
 
-        if mode == "image":
+        if mode in ["image", "multimodal"]:
             assert image is not None, "Image is not provided for mode 'image' or 'multimodal'"
             with self.maybe_autocast():
                 image_embeds_frozen = self.ln_vision(self.visual_encoder(image))
             image_embeds_frozen = image_embeds_frozen.float()
             image_embeds_frozen = self.MCAN.img_feat_linear(image_embeds_frozen)  # Project image features to the correct size
-            image_atts = torch.ones(image_embeds_frozen.size()[:-1], dtype=torch.long).to(self.device)
-            lang_feat_mask = self.MCAN.make_mask(image_embeds_frozen)
+            img_feat_mask = self.MCAN.make_mask(image_embeds_frozen)
+            image_embeds_frozen = self.dat(image_embeds_frozen)
 
-            query_output = self.MCAN.backbone(
-                image_embeds_frozen,
-                image_embeds_frozen,
-                lang_feat_mask,
-                lang_feat_mask
-            )
-            image_embeds = query_output
-            image_features = F.normalize(image_embeds, dim=-1)
-
-        elif mode == "text":
+        if mode in ["text", "multimodal"]:
             assert caption is not None, "text input is None for mode 'text' or 'multimodal'"
-
-            text_tokens = self.tokenizer(caption, return_tensors="pt", padding=True).to(self.device)
-            text_embeds = self.MCAN.embedding(text_tokens.input_ids)
-            text_embeds, _ = self.MCAN.lstm(text_embeds)
+            text_tokens = self.tokenizer(
+                caption, return_tensors="pt", padding=True, truncation=True, max_length=self.max_txt_len
+            ).to(self.device)
+            text_embeds_frozen, _ = self.MCAN.lstm(self.MCAN.embedding(text_tokens.input_ids))
             lang_feat_mask = self.MCAN.make_mask(text_tokens.input_ids.unsqueeze(2))
 
-            text_output = self.MCAN.backbone(
-                text_embeds,
-                text_embeds,
-                lang_feat_mask,
-                lang_feat_mask
+        if mode == "image":
+            _, image_embeds = self.MCAN.backbone(
+                image_embeds_frozen, image_embeds_frozen, img_feat_mask, img_feat_mask
             )
-            text_embeds = text_output
-            text_features = F.normalize(text_embeds, dim=-1)
+            image_features = F.normalize(self.MCAN.attflat_img(image_embeds, img_feat_mask), dim=-1)
 
-        elif mode == "multimodal":
-            with self.maybe_autocast():
-                image_embeds_frozen = self.ln_vision(self.visual_encoder(image))
-            image_embeds_frozen = image_embeds_frozen.float()
-            image_embeds_frozen = self.MCAN.img_feat_linear(image_embeds_frozen)  # Project image features to the correct size
-            image_atts = torch.ones(image_embeds_frozen.size()[:-1], dtype=torch.long).to(self.device)
-            lang_feat_mask = self.MCAN.make_mask(image_embeds_frozen)
-
-            text_tokens = self.tokenizer(caption, return_tensors="pt", padding=True).to(self.device)
-            text_embeds = self.MCAN.embedding(text_tokens.input_ids)
-            text_embeds, _ = self.MCAN.lstm(text_embeds)
-            text_feat_mask = self.MCAN.make_mask(text_tokens.input_ids.unsqueeze(2))
-
-            output = self.MCAN.backbone(
-                text_embeds,
-                image_embeds_frozen,
-                text_feat_mask,
-                lang_feat_mask
+        elif mode == "text":
+            text_embeds, _ = self.MCAN.backbone(
+                text_embeds_frozen, text_embeds_frozen, lang_feat_mask, lang_feat_mask
             )
+            text_features = F.normalize(self.MCAN.attflat_lang(text_embeds, lang_feat_mask), dim=-1)
 
-            multimodal_embeds = output[:, :text_embeds.size(1), :]
+        elif mode == "multimodal":
+            multimodal_embeds, _ = self.MCAN.backbone(
+                text_embeds_frozen, image_embeds_frozen, lang_feat_mask, img_feat_mask
+            )
+            multimodal_features = F.normalize(self.MCAN.attflat_lang(multimodal_embeds, lang_feat_mask), dim=-1)
 
         return BlipOutputFeatures(
             image_embeds=image_embeds,
@@ -505,8 +572,24 @@ class Blip2Qformer(Blip2Base):
             text_embeds=text_embeds,
             text_embeds_proj=text_features,
             multimodal_embeds=multimodal_embeds,
+            multimodal_embeds_proj=multimodal_features,
         )
 
+    @torch.no_grad()
+    def _enqueue_itm_samples(self, image_embeds, text_embeds, text_mask, image_feats, text_feat, image_ids=None):
+        ptr = int(self.queue_ptr)
+
+        image_embeds = concat_all_gather(image_embeds.detach())
+        batch_size = image_embeds.size(0)
+        self.image_embeds_queue[ptr : ptr + batch_size] = image_embeds
+        self.text_embeds_queue[ptr : ptr + batch_size] = concat_all_gather(text_embeds.detach())
+        self.text_mask_queue[ptr : ptr + batch_size] = concat_all_gather(text_mask)
+
+        if image_ids is None:
+            # samples without image ids are never masked as positives
+            image_ids = torch.full((image_feats.size(0), 1), -2, dtype=torch.long, device=image_feats.device)
+        self._dequeue_and_enqueue(image_feats, text_feat, image_ids)
+
     @classmethod
     def from_config(cls, cfg):
         vit_model = cfg.get("vit_model", "eva_clip_g")
@@ -521,6 +604,13 @@ class Blip2Qformer(Blip2Base):
 
         max_txt_len = cfg.get("max_txt_len", 32)
 
+        # ITM hard negatives, see __init__
+        itm_top_k = cfg.get("itm_top_k", 0)
+        itm_queue_size = cfg.get("itm_queue_size", 0)
+
+        # fused, mixed-precision MCAN backbone, see daiv/models/dmformer/mcan/mca.py
+        mcan_fast = cfg.get("mcan_fast", False)
+
         model = cls(
             vit_model=vit_model,
             img_size=img_size,
@@ -531,6 +621,9 @@ class Blip2Qformer(Blip2Base):
             num_query_token=num_query_token,
             cross_attention_freq=cross_attention_freq,
             max_txt_len=max_txt_len,
+            itm_top_k=itm_top_k,
+            itm_queue_size=itm_queue_size,
+            mcan_fast=mcan_fast,
         )
         model.load_checkpoint_from_config(cfg)
 
@@ -539,4 +632,12 @@ class Blip2Qformer(Blip2Base):
     def compute_sim_matrix(self, data_loader, task_cfg):
         k_test = task_cfg.k_test
 
-        return compute_sim_matrix(model=self, data_loader=data_loader, k_test=k_test)
\ No newline at end of file
+        # retrieval_index_dir keeps the embeddings on disk for later runs, see daiv/models/retrieval.py
+        return compute_sim_matrix(
+            model=self,
+            data_loader=data_loader,
+            k_test=k_test,
+            index_dir=task_cfg.get("retrieval_index_dir", None),
+            chunk_size=task_cfg.get("retrieval_chunk_size", 8192),
+            itm_batch_size=task_cfg.get("itm_batch_size", 512),
+        )
\ No newline at end of file
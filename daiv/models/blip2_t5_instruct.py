@@ -57,16 +57,21 @@ class Blip2T5Instruct(Blip2Base):
         apply_lemmatizer=False,
         num_few_shot_examples=0,
         few_shot_prob=0,
+        share_vision_encoder=False,
+        mcan_fast=False,
     ):
         """
         apply_lemmatizer: when set to True, postprocess predict_answers() result with lemmas.
+        mcan_fast: run the MCAN backbone in its performance mode, see MCA_ED.forward_fast.
         """
         super().__init__()
 
         self.tokenizer = self.init_tokenizer(truncation_side="left")
 
+        assert freeze_vit or not share_vision_encoder, "Only a frozen vision encoder can be shared."
         self.visual_encoder, self.ln_vision = self.init_vision_encoder(
-            vit_model, img_size, drop_path_rate, use_grad_checkpoint, vit_precision
+            vit_model, img_size, drop_path_rate, use_grad_checkpoint, vit_precision,
+            shared=share_vision_encoder,
         )
         if freeze_vit:
             for name, param in self.visual_encoder.named_parameters():
@@ -77,6 +82,7 @@ class Blip2T5Instruct(Blip2Base):
 
         # Initialize MCAN
         self.MCAN = Net(self.Config, pretrained_emb=None, token_size=len(self.tokenizer), answer_size=self.Config.HIDDEN_SIZE)
+        self.MCAN.backbone.fast = mcan_fast
 
         self.t5_tokenizer = T5TokenizerFast.from_pretrained(t5_model, truncation_side='left')
         self.t5_output_tokenizer = T5TokenizerFast.from_pretrained(t5_model, truncation_side='right')
@@ -101,7 +107,6 @@ class Blip2T5Instruct(Blip2Base):
         self.prompt = prompt
 
         self._apply_lemmatizer = apply_lemmatizer
-        self._lemmatizer = None
 
         self.num_few_shot_examples = num_few_shot_examples
         self.few_shot_prob = few_shot_prob
@@ -203,13 +208,14 @@ class Blip2T5Instruct(Blip2Base):
     ):
         image = samples["image"]
         with self.maybe_autocast():
-            image_features = self.visual_encoder.get_intermediate_layers(image)[-2]  # Get image features from the second to last layer
+            # one ViT pass for the last and the second to last layer
+            image_embeds, image_features = self.vision_features(image)
             image_features = image_features[:, 1:]  # Remove CLS token
             image_embeds_llm = self.vision_proj(image_features)  # Project to LLM dimension
             image_atts_llm = torch.ones(image_embeds_llm.size()[:-1], dtype=torch.long).to(image.device)
 
             # Generate image_embeds_mcan as in stage1
-            image_embeds_mcan = self.ln_vision(self.visual_encoder(image))
+            image_embeds_mcan = self.ln_vision(image_embeds)
             image_embeds_mcan = self.MCAN.img_feat_linear(image_embeds_mcan)  # Project to MCAN dimension
             image_atts_mcan = self.MCAN.make_mask(image_embeds_mcan).to(image.device)
 
@@ -333,43 +339,6 @@ class Blip2T5Instruct(Blip2Base):
 
         return output_text
 
-    def _lemmatize(self, answers):
-        def apply(answer):
-            doc = self.lemmatizer(answer)
-
-            words = []
-            for token in doc:
-                if token.pos_ in ["NOUN", "VERB"]:
-                    words.append(token.lemma_)
-                else:
-                    words.append(token.text)
-            answer = " ".join(words)
-
-            return answer
-
-        return [apply(answer) for answer in answers]
-
-    @property
-    def lemmatizer(self):
-        if self._lemmatizer is None:
-            try:
-                import spacy
-
-                self._lemmatizer = spacy.load("en_core_web_sm")
-            except ImportError:
-                logging.error(
-                    """
-                    Please install spacy and en_core_web_sm model to apply lemmatization.
-                    python -m spacy download en_core_web_sm
-                    OR
-                    import spacy.cli
-                    spacy.cli.download("en_core_web_sm")
-                    """
-                )
-                exit(1)
-
-        return self._lemmatizer
-
     @classmethod
     def from_config(cls, cfg):
         vit_model = cfg.get("vit_model", "eva_clip_g")
@@ -390,6 +359,12 @@ class Blip2T5Instruct(Blip2Base):
         num_few_shot_examples = cfg.get("num_few_shot_examples", 0)
         few_shot_prob = cfg.get("few_shot_prob", 0.0)
 
+        # reuse the vision encoder of other models of the process, see daiv/models/vision_pool.py
+        share_vision_encoder = cfg.get("share_vision_encoder", False)
+
+        # fused, mixed-precision MCAN backbone, see daiv/models/dmformer/mcan/mca.py
+        mcan_fast = cfg.get("mcan_fast", False)
+
         model = cls(
             vit_model=vit_model,
             img_size=img_size,
@@ -404,6 +379,8 @@ class Blip2T5Instruct(Blip2Base):
             apply_lemmatizer=apply_lemmatizer,
             num_few_shot_examples=num_few_shot_examples,
             few_shot_prob=few_shot_prob,
+            share_vision_encoder=share_vision_encoder,
+            mcan_fast=mcan_fast,
         )
 
         model.load_checkpoint_from_config(cfg)
@@ -57,6 +57,7 @@ class Blip2VicunaInstruct(Blip2Base):
         prompt="",
         max_txt_len=32,
         apply_lemmatizer=False,
+        share_vision_encoder=False,
     ):
         """
         apply_lemmatizer: when set to True, postprocess predict_answers() result with lemmas.
@@ -67,8 +68,10 @@ class Blip2VicunaInstruct(Blip2Base):
 
         self.tokenizer = self.init_tokenizer()
 
+        assert freeze_vit or not share_vision_encoder, "Only a frozen vision encoder can be shared."
         self.visual_encoder, self.ln_vision = self.init_vision_encoder(
-            vit_model, img_size, drop_path_rate, use_grad_checkpoint, vit_precision
+            vit_model, img_size, drop_path_rate, use_grad_checkpoint, vit_precision,
+            shared=share_vision_encoder,
         )
         if freeze_vit:
             for name, param in self.visual_encoder.named_parameters():
@@ -117,7 +120,6 @@ class Blip2VicunaInstruct(Blip2Base):
         self.prompt_length = prompt_tokens.attention_mask.sum(1)
 
         self._apply_lemmatizer = apply_lemmatizer
-        self._lemmatizer = None
 
     def forward(self, samples):
         image = samples["image"]
@@ -229,11 +231,12 @@ class Blip2VicunaInstruct(Blip2Base):
     ):
         image = samples["image"]
         with self.maybe_autocast():
-            image_features = self.visual_encoder.get_intermediate_layers(image)[-2]  # Get image features from the second to last layer
+            # one ViT pass for the last and the second to last layer
+            image_embeds, image_features = self.vision_features(image)
             image_features = image_features[:, 1:]  # Remove CLS token
             
             # Generate image_embeds_mcan as in stage1
-            image_embeds_mcan = self.ln_vision(self.visual_encoder(image))
+            image_embeds_mcan = self.ln_vision(image_embeds)
             image_embeds_mcan = self.MCAN.img_feat_linear(image_embeds_mcan).to(torch.float32)  # Project to MCAN dimension
             image_atts_mcan = self.MCAN.make_mask(image_embeds_mcan).to(image.device)
 
@@ -479,43 +482,6 @@ class Blip2VicunaInstruct(Blip2Base):
 
         return output_text
 
-    def _lemmatize(self, answers):
-        def apply(answer):
-            doc = self.lemmatizer(answer)
-
-            words = []
-            for token in doc:
-                if token.pos_ in ["NOUN", "VERB"]:
-                    words.append(token.lemma_)
-                else:
-                    words.append(token.text)
-            answer = " ".join(words)
-
-            return answer
-
-        return [apply(answer) for answer in answers]
-
-    @property
-    def lemmatizer(self):
-        if self._lemmatizer is None:
-            try:
-                import spacy
-
-                self._lemmatizer = spacy.load("en_core_web_sm")
-            except ImportError:
-                logging.error(
-                    """
-                    Please install spacy and en_core_web_sm model to apply lemmatization.
-                    python -m spacy download en_core_web_sm
-                    OR
-                    import spacy.cli
-                    spacy.cli.download("en_core_web_sm")
-                    """
-                )
-                exit(1)
-
-        return self._lemmatizer
-
     @classmethod
     def from_config(cls, cfg):
         vit_model = cfg.get("vit_model", "eva_clip_g")
@@ -532,6 +498,9 @@ class Blip2VicunaInstruct(Blip2Base):
 
         apply_lemmatizer = cfg.get("apply_lemmatizer", False)
 
+        # reuse the vision encoder of other models of the process, see daiv/models/vision_pool.py
+        share_vision_encoder = cfg.get("share_vision_encoder", False)
+
         model = cls(
             vit_model=vit_model,
             img_size=img_size,
@@ -543,6 +512,7 @@ class Blip2VicunaInstruct(Blip2Base):
             prompt=prompt,
             max_txt_len=max_txt_len,
             apply_lemmatizer=apply_lemmatizer,
+            share_vision_encoder=share_vision_encoder,
         )
         model.load_checkpoint_from_config(cfg)
 
@@ -113,4 +113,5 @@ class BlipOutputFeatures(ModelOutput):
     text_embeds: Optional[torch.FloatTensor] = None
     text_embeds_proj: Optional[torch.FloatTensor] = None
 
-    multimodal_embeds: Optional[torch.FloatTensor] = None
\ No newline at end of file
+    multimodal_embeds: Optional[torch.FloatTensor] = None
+    multimodal_embeds_proj: Optional[torch.FloatTensor] = None
\ No newline at end of file
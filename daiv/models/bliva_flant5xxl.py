@@ -10,13 +10,16 @@ from transformers import T5TokenizerFast
 
 from daiv.common.registry import registry
 from daiv.models.blip2 import Blip2Base, disabled_train
+from daiv.models.lazy_init import WeightSource, hf_checkpoint_files, init_empty_weights
 from daiv.models.modeling_t5 import T5Config, T5ForConditionalGeneration
-from transformers.modeling_outputs import BaseModelOutput
+from daiv.models.token_reducer import build_token_reducer
 
 
 @registry.register_model("bliva_flant5")
 class BLIVAFlanT5(Blip2Base):
 
+    accepts_image_embeddings = True
+
     PRETRAINED_MODEL_CONFIG_DICT = {
         "flant5xxl": "configs/models/bliva_flant5xxl.yaml",
     }
@@ -38,16 +41,25 @@ class BLIVAFlanT5(Blip2Base):
         num_few_shot_examples=0,
         few_shot_prob=0,
         qformer_text_input=True,
+        token_reducer=None,
+        share_vision_encoder=False,
+        lazy_init=False,
     ):
         """
         apply_lemmatizer: when set to True, postprocess predict_answers() result with lemmas.
+        lazy_init: when set to True, skip loading pretrained weights in the constructor.
+            The model is expected to be built under init_empty_weights() and materialized
+            with load_lazy_weights_from_config().
         """
         super().__init__()
 
         self.tokenizer = self.init_tokenizer(truncation_side="left")
 
+        assert freeze_vit or not share_vision_encoder, "Only a frozen vision encoder can be shared."
         self.visual_encoder, self.ln_vision = self.init_vision_encoder(
-            vit_model, img_size, drop_path_rate, use_grad_checkpoint, vit_precision
+            vit_model, img_size, drop_path_rate, use_grad_checkpoint, vit_precision,
+            shared=share_vision_encoder,
+            load_weights=not lazy_init,
         )
         if freeze_vit:
             for name, param in self.visual_encoder.named_parameters():
@@ -57,7 +69,7 @@ class BLIVAFlanT5(Blip2Base):
             logging.info("freeze vision encoder")
 
         self.Qformer, self.query_tokens = self.init_Qformer(
-            num_query_token, self.visual_encoder.num_features
+            num_query_token, self.visual_encoder.num_features, load_weights=not lazy_init
         )
 
         if not qformer_text_input:
@@ -75,9 +87,12 @@ class BLIVAFlanT5(Blip2Base):
 
         t5_config = T5Config.from_pretrained(t5_model)
         t5_config.dense_act_fn = "gelu"
-        self.t5_model = T5ForConditionalGeneration.from_pretrained(
-            t5_model, config=t5_config
-        )
+        if lazy_init:
+            self.t5_model = T5ForConditionalGeneration(t5_config)
+        else:
+            self.t5_model = T5ForConditionalGeneration.from_pretrained(
+                t5_model, config=t5_config
+            )
 
         for name, param in self.t5_model.named_parameters():
             param.requires_grad = False
@@ -92,20 +107,19 @@ class BLIVAFlanT5(Blip2Base):
         self.prompt = prompt
 
         self._apply_lemmatizer = apply_lemmatizer
-        self._lemmatizer = None
 
         self.num_few_shot_examples = num_few_shot_examples
         self.few_shot_prob = few_shot_prob
 
         self.qformer_text_input = qformer_text_input
         self.vision_project = nn.Linear(self.visual_encoder.num_features, self.t5_model.config.hidden_size)
+        self.token_reducer = build_token_reducer(token_reducer, self.visual_encoder.num_features)
         
     def forward(self, samples):
 
         image = samples["image"]
         image_features= self.visual_encoder.get_intermediate_layers(image)[-2] # [batch_size, 257, 1408]
-        image_features = image_features[:, 1:] 
-        add_feature_llm = self.vision_project(image_features) 
+        add_feature_llm = self.project_patch_features(image_features)
         atts_add_feature_llm = torch.ones(add_feature_llm.size()[:-1], dtype=torch.long).to(image.device)
     
         with self.maybe_autocast():
@@ -275,15 +289,21 @@ class BLIVAFlanT5(Blip2Base):
         length_penalty=1.0,
         num_captions=1,
         temperature=1,
+        logits_processor=None,
     ):
         if "prompt" in samples.keys():
             prompt = samples["prompt"]
         else:
             prompt = self.prompt
 
-        image = samples["image"]
-
-        bs = image.size(0)
+        if "inputs_llm" in samples.keys():
+            # image already encoded, e.g. by an exported encoder (see ImageEncoderRuntime) or an ImageSession
+            device = self.device
+            bs = samples["inputs_llm"].size(0)
+        else:
+            image = samples["image"]
+            device = image.device
+            bs = image.size(0)
 
         if isinstance(prompt, str):
             prompt = [prompt] * bs
@@ -308,25 +328,28 @@ class BLIVAFlanT5(Blip2Base):
                 truncation=True,
                 max_length=self.max_txt_len,
                 return_tensors="pt",
-            ).to(image.device)
-            query_atts = torch.ones(query_tokens.size()[:-1], dtype=torch.long).to(image.device)
+            ).to(device)
+            query_atts = torch.ones(query_tokens.size()[:-1], dtype=torch.long).to(device)
             Qformer_atts = torch.cat([query_atts,text_Qformer.attention_mask],dim=1)
 
+        if "inputs_llm" in samples.keys():
+            inputs_t5 = samples["inputs_llm"].to(device)
+            atts_t5 = torch.ones(inputs_t5.size()[:-1], dtype=torch.long).to(device)
+            add_feature_llm = samples["add_feature_llm"].to(device)
+            atts_add_feature_llm = torch.ones(add_feature_llm.size()[:-1], dtype=torch.long).to(device)
         # For video data
-        if image.dim() == 5:
+        elif image.dim() == 5:
             inputs_t5, atts_t5 = [], []
             add_inputs_llm, add_atts_llm = [], []
             for j in range(image.size(2)):
                 this_frame = image[:,:,j,:,:]
                 with self.maybe_autocast():
                     frame_embeds = self.ln_vision(self.visual_encoder(this_frame))
-                    frame_atts = torch.ones(frame_embeds.size()[:-1], dtype=torch.long).to(image.device)
+                    frame_atts = torch.ones(frame_embeds.size()[:-1], dtype=torch.long).to(device)
                     frame_features =self.visual_encoder.get_intermediate_layers(this_frame)[-2]
                     
-                frame_features = frame_features[:, 1:] 
-        
-                add_feature_llm = self.vision_project(frame_features) 
-                atts_add_feature_llm = torch.ones(add_feature_llm.size()[:-1], dtype=torch.long).to(image.device)
+                add_feature_llm = self.project_patch_features(frame_features)
+                atts_add_feature_llm = torch.ones(add_feature_llm.size()[:-1], dtype=torch.long).to(device)
 
                 if self.qformer_text_input:
                     frame_query_output = self.Qformer.bert(
@@ -346,7 +369,7 @@ class BLIVAFlanT5(Blip2Base):
                     )
 
                 frame_inputs_t5 = self.t5_proj(frame_query_output.last_hidden_state[:,:query_tokens.size(1),:])
-                frame_atts_t5 = torch.ones(frame_inputs_t5.size()[:-1], dtype=torch.long).to(image.device)
+                frame_atts_t5 = torch.ones(frame_inputs_t5.size()[:-1], dtype=torch.long).to(device)
                 inputs_t5.append(frame_inputs_t5)
                 atts_t5.append(frame_atts_t5)
                 add_inputs_llm.append(add_feature_llm)
@@ -357,13 +380,13 @@ class BLIVAFlanT5(Blip2Base):
             atts_add_feature_llm = torch.cat(add_atts_llm, dim=1)
         else:
             with self.maybe_autocast():
-                image_embeds = self.ln_vision(self.visual_encoder(image))
-                image_features= self.visual_encoder.get_intermediate_layers(image)[-2] 
-            image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(image.device)
+                # one ViT pass for both
+                image_embeds, image_features = self.vision_features(image)
+                image_embeds = self.ln_vision(image_embeds)
+            image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(device)
             
-            image_features = image_features[:, 1:] 
-            add_feature_llm = self.vision_project(image_features) 
-            atts_add_feature_llm = torch.ones(add_feature_llm.size()[:-1], dtype=torch.long).to(image.device)
+            add_feature_llm = self.project_patch_features(image_features)
+            atts_add_feature_llm = torch.ones(add_feature_llm.size()[:-1], dtype=torch.long).to(device)
             if self.qformer_text_input:
                 query_output = self.Qformer.bert(
                     text_Qformer.input_ids,
@@ -382,13 +405,13 @@ class BLIVAFlanT5(Blip2Base):
                 )
 
             inputs_t5 = self.t5_proj(query_output.last_hidden_state[:,:query_tokens.size(1),:])
-            atts_t5 = torch.ones(inputs_t5.size()[:-1], dtype=torch.long).to(image.device)
+            atts_t5 = torch.ones(inputs_t5.size()[:-1], dtype=torch.long).to(device)
 
         input_tokens = self.t5_tokenizer(
             prompt,
             padding="longest",
             return_tensors="pt"
-        ).to(image.device)
+        ).to(device)
 
         encoder_atts = torch.cat([atts_t5, atts_add_feature_llm,input_tokens.attention_mask], dim=1)
 
@@ -408,6 +431,7 @@ class BLIVAFlanT5(Blip2Base):
                 repetition_penalty=repetition_penalty,
                 length_penalty=length_penalty,
                 num_return_sequences=num_captions,
+                logits_processor=logits_processor,
             )
             output_text = self.t5_tokenizer.batch_decode(
                 outputs, skip_special_tokens=True
@@ -450,13 +474,23 @@ class BLIVAFlanT5(Blip2Base):
 
         samples["prompt"] = text_input
 
-        output_text = self.generate(
-            samples,
-            num_beams=num_beams,
-            max_length=max_len,
-            min_length=min_len,
-            length_penalty=length_penalty
-        )
+        if inference_method in ["constrained", "rank"] and answer_list is not None:
+            output_text = self._predict_answers_from_list(
+                samples,
+                answer_list,
+                self.t5_tokenizer,
+                inference_method=inference_method,
+                num_beams=num_beams,
+                length_penalty=length_penalty,
+            )
+        else:
+            output_text = self.generate(
+                samples,
+                num_beams=num_beams,
+                max_length=max_len,
+                min_length=min_len,
+                length_penalty=length_penalty
+            )
 
         if self._apply_lemmatizer or ("apply_lemmatizer" in samples.keys() and samples["apply_lemmatizer"]):
             output_text = self._lemmatize(output_text)
@@ -571,9 +605,7 @@ class BLIVAFlanT5(Blip2Base):
                     frame_atts = torch.ones(frame_embeds.size()[:-1], dtype=torch.long).to(image.device)
                     frame_features =self.visual_encoder.get_intermediate_layers(this_frame)[-2]
                     
-                frame_features = frame_features[:, 1:] 
-        
-                add_feature_llm = self.vision_project(frame_features) 
+                add_feature_llm = self.project_patch_features(frame_features)
                 atts_add_feature_llm = torch.ones(add_feature_llm.size()[:-1], dtype=torch.long).to(image.device)
                 if self.qformer_text_input:
                     frame_query_output = self.Qformer.bert(
@@ -604,13 +636,13 @@ class BLIVAFlanT5(Blip2Base):
             atts_add_feature_llm = torch.cat(add_atts_llm, dim=1)
         else:
             with self.maybe_autocast():
-                image_embeds = self.ln_vision(self.visual_encoder(image))
-                image_features= self.visual_encoder.get_intermediate_layers(image)[-2]
+                # one ViT pass for both
+                image_embeds, image_features = self.vision_features(image)
+                image_embeds = self.ln_vision(image_embeds)
                 
             image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(image.device)
            
-            image_features = image_features[:, 1:] 
-            add_feature_llm = self.vision_project(image_features) 
+            add_feature_llm = self.project_patch_features(image_features)
             atts_add_feature_llm = torch.ones(add_feature_llm.size()[:-1], dtype=torch.long).to(image.device)
 
             if self.qformer_text_input:
@@ -653,18 +685,19 @@ class BLIVAFlanT5(Blip2Base):
                 attention_mask=encoder_atts,
             )
 
+            # the encoder ran once per sample, the cross-attention keys and values are
+            # projected once per sample as well and shared by all its candidates
+            cross_attention = self.t5_model.project_cross_attention(encoder_outputs[0])
+
             all_losses = []
             for n in range(n_segments):
                 seg_len = n_cands // n_segments
                 if n == (n_segments - 1):
                     seg_len = n_cands - seg_len * (n_segments - 1)
 
-                # this_encoder_outputs = copy.deepcopy(encoder_outputs)
-                this_encoder_outputs = BaseModelOutput(
-                    last_hidden_state=encoder_outputs[0].clone(),
+                past_key_values = self.t5_model.shared_cross_attention_past(
+                    cross_attention, bs * seg_len
                 )
-
-                this_encoder_outputs['last_hidden_state'] = this_encoder_outputs[0].repeat_interleave(seg_len, dim=0)
                 this_encoder_atts = encoder_atts.repeat_interleave(seg_len, dim=0)
 
                 start_i = n * (n_cands // n_segments)
@@ -675,12 +708,14 @@ class BLIVAFlanT5(Blip2Base):
                 this_targets = this_output_tokens_ids.masked_fill(this_output_tokens_ids == self.t5_tokenizer.pad_token_id, -100)
 
                 outputs = self.t5_model(
-                    encoder_outputs=this_encoder_outputs,
+                    encoder_outputs=encoder_outputs,
+                    past_key_values=past_key_values,
                     attention_mask=this_encoder_atts,
                     decoder_attention_mask=this_output_tokens_atts,
                     return_dict=True,
                     labels=this_targets,
                     reduction="none",
+                    use_cache=False,
                 )
                 loss = outputs.loss
 
@@ -714,42 +749,16 @@ class BLIVAFlanT5(Blip2Base):
 
         return output_class_ranks
 
-    def _lemmatize(self, answers):
-        def apply(answer):
-            doc = self.lemmatizer(answer)
-
-            words = []
-            for token in doc:
-                if token.pos_ in ["NOUN", "VERB"]:
-                    words.append(token.lemma_)
-                else:
-                    words.append(token.text)
-            answer = " ".join(words)
-
-            return answer
-
-        return [apply(answer) for answer in answers]
-
-    @property
-    def lemmatizer(self):
-        if self._lemmatizer is None:
-            try:
-                import spacy
-
-                self._lemmatizer = spacy.load("en_core_web_sm")
-            except ImportError:
-                logging.error(
-                    """
-                    Please install spacy and en_core_web_sm model to apply lemmatization.
-                    python -m spacy download en_core_web_sm
-                    OR
-                    import spacy.cli
-                    spacy.cli.download("en_core_web_sm")
-                    """
-                )
-                exit(1)
+    def lazy_weight_sources(self, cfg):
+        t5_model = cfg.get("t5_model")
 
-        return self._lemmatizer
+        return super().lazy_weight_sources(cfg) + [
+            WeightSource(
+                lambda: hf_checkpoint_files(t5_model),
+                prefix="t5_model.",
+                name=t5_model,
+            )
+        ]
 
     @classmethod
     def from_config(cls, cfg):
@@ -774,25 +783,42 @@ class BLIVAFlanT5(Blip2Base):
 
         qformer_text_input = cfg.get("qformer_text_input", True)
 
-        model = cls(
-            vit_model=vit_model,
-            img_size=img_size,
-            drop_path_rate=drop_path_rate,
-            use_grad_checkpoint=use_grad_checkpoint,
-            vit_precision=vit_precision,
-            freeze_vit=freeze_vit,
-            num_query_token=num_query_token,
-            t5_model=t5_model,
-            prompt=prompt,
-            max_txt_len=max_txt_len,
-            max_output_txt_len=max_output_txt_len,
-            apply_lemmatizer=apply_lemmatizer,
-            num_few_shot_examples=num_few_shot_examples,
-            few_shot_prob=few_shot_prob,
-            qformer_text_input=qformer_text_input,
-        )
+        # shorten the patch-token prefix, see daiv/models/token_reducer.py
+        token_reducer = cfg.get("token_reducer", None)
+
+        # reuse the vision encoder of other models of the process, see daiv/models/vision_pool.py
+        share_vision_encoder = cfg.get("share_vision_encoder", False)
+
+        # build on the meta device and stream weights in afterwards
+        lazy_init = cls.lazy_init_from_config(cfg)
+
+        with init_empty_weights(enabled=lazy_init):
+            model = cls(
+                vit_model=vit_model,
+                img_size=img_size,
+                drop_path_rate=drop_path_rate,
+                use_grad_checkpoint=use_grad_checkpoint,
+                vit_precision=vit_precision,
+                freeze_vit=freeze_vit,
+                num_query_token=num_query_token,
+                t5_model=t5_model,
+                prompt=prompt,
+                max_txt_len=max_txt_len,
+                max_output_txt_len=max_output_txt_len,
+                apply_lemmatizer=apply_lemmatizer,
+                num_few_shot_examples=num_few_shot_examples,
+                few_shot_prob=few_shot_prob,
+                qformer_text_input=qformer_text_input,
+                token_reducer=token_reducer,
+                share_vision_encoder=share_vision_encoder,
+                lazy_init=lazy_init,
+            )
 
+        if lazy_init:
+            model.load_lazy_weights_from_config(cfg)
+        else:
+            model.load_checkpoint_from_config(cfg)
 
-        model.load_checkpoint_from_config(cfg)
+        model.quantize_from_config(cfg)
 
         return model
@@ -8,12 +8,18 @@ import torch.nn as nn
 
 import transformers
 
+from daiv.common.profiling import timed_generate, timed_region
 from daiv.common.registry import registry
 from daiv.models.blip2 import Blip2Base, disabled_train
+from daiv.models.lazy_init import WeightSource, hf_checkpoint_files, init_empty_weights
+from daiv.models.speculative import SpeculativeStats, speculative_greedy_decode
+from daiv.models.token_reducer import build_token_reducer
 
 @registry.register_model("bliva_vicuna")
 class BLIVAVicuna(Blip2Base):
 
+    accepts_image_embeddings = True
+
     PRETRAINED_MODEL_CONFIG_DICT = {
         "vicuna7b": "configs/models/bliva_vicuna7b.yaml",
     }
@@ -33,17 +39,28 @@ class BLIVAVicuna(Blip2Base):
         max_output_txt_len=256,
         apply_lemmatizer=False,
         qformer_text_input=True,
+        token_reducer=None,
+        lazy_init=False,
+        share_vision_encoder=False,
     ):
+        """
+        lazy_init: when set to True, skip loading pretrained weights in the constructor.
+            The model is expected to be built under init_empty_weights() and materialized
+            with load_lazy_weights_from_config().
+        """
         super().__init__()
         transformers_version = version.parse(transformers.__version__)
         assert transformers_version >= version.parse("4.28"), "BLIP-2 Vicuna requires transformers>=4.28"        
-        from transformers import LlamaTokenizer
+        from transformers import LlamaConfig, LlamaTokenizer
         from daiv.models.modeling_llama import LlamaForCausalLM
         
         self.tokenizer = self.init_tokenizer(truncation_side="left")
 
+        assert freeze_vit or not share_vision_encoder, "Only a frozen vision encoder can be shared."
         self.visual_encoder, self.ln_vision = self.init_vision_encoder(
-            vit_model, img_size, drop_path_rate, use_grad_checkpoint, vit_precision
+            vit_model, img_size, drop_path_rate, use_grad_checkpoint, vit_precision,
+            shared=share_vision_encoder,
+            load_weights=not lazy_init,
         )
 
         if freeze_vit:
@@ -54,7 +71,7 @@ class BLIVAVicuna(Blip2Base):
             logging.info("freeze vision encoder")
 
         self.Qformer, self.query_tokens = self.init_Qformer(
-            num_query_token, self.visual_encoder.num_features
+            num_query_token, self.visual_encoder.num_features, load_weights=not lazy_init
         )
 
         if not qformer_text_input:
@@ -68,9 +85,14 @@ class BLIVAVicuna(Blip2Base):
         self.Qformer.cls = None
 
         self.llm_tokenizer = LlamaTokenizer.from_pretrained(llm_model, use_fast=False, truncation_side="left")
-        self.llm_model = LlamaForCausalLM.from_pretrained(
-            llm_model, torch_dtype=torch.float16
-        )
+        if lazy_init:
+            self.llm_model = LlamaForCausalLM._from_config(
+                LlamaConfig.from_pretrained(llm_model), torch_dtype=torch.float16
+            )
+        else:
+            self.llm_model = LlamaForCausalLM.from_pretrained(
+                llm_model, torch_dtype=torch.float16
+            )
         self.llm_tokenizer.add_special_tokens({'pad_token': '[PAD]'})
         self.llm_tokenizer.add_special_tokens({'bos_token': '</s>'})
         self.llm_tokenizer.add_special_tokens({'eos_token': '</s>'})
@@ -96,11 +118,48 @@ class BLIVAVicuna(Blip2Base):
         prompt_tokens = self.llm_tokenizer(self.prompt, return_tensors="pt")
         self.prompt_length = prompt_tokens.attention_mask.sum(1)
 
-        self._lemmatizer = None
 
         self.qformer_text_input = qformer_text_input
 
         self.vision_project = nn.Linear(self.visual_encoder.num_features, self.llm_model.config.hidden_size)
+        self.token_reducer = build_token_reducer(token_reducer, self.visual_encoder.num_features)
+
+        self._draft_llm_model = None
+        self.num_draft_tokens = 4
+        self.speculative_stats = SpeculativeStats()
+
+    def init_draft_model(self, draft_llm_model, num_draft_tokens=4):
+        """
+        Load a small causal LM sharing the Vicuna tokenizer, used to speed up greedy
+        generation by speculative decoding.
+        """
+        from transformers import AutoModelForCausalLM
+
+        draft_model = AutoModelForCausalLM.from_pretrained(
+            draft_llm_model, torch_dtype=torch.float16
+        )
+        draft_model.resize_token_embeddings(len(self.llm_tokenizer))
+
+        for name, param in draft_model.named_parameters():
+            param.requires_grad = False
+        draft_model = draft_model.eval()
+        draft_model.train = disabled_train
+
+        # not a submodule: kept out of state_dict() and checkpoints, and of .to()/.float()
+        object.__setattr__(self, "_draft_llm_model", draft_model)
+
+        self.num_draft_tokens = num_draft_tokens
+        logging.info("Loaded draft model {} for speculative decoding".format(draft_llm_model))
+
+    @property
+    def draft_llm_model(self):
+        """
+        The draft model of init_draft_model(), moved to the device of the model when used.
+        """
+        draft_model = self._draft_llm_model
+        if draft_model is not None and draft_model.device != self.device:
+            draft_model.to(self.device)
+        return draft_model
 
     def concat_text_input_output(self, input_ids, input_atts, output_ids, output_atts):
         input_part_targets_len = []
@@ -135,12 +194,13 @@ class BLIVAVicuna(Blip2Base):
 
         image = samples["image"]
 
-        image_features= self.visual_encoder.get_intermediate_layers(image)[-2] # [batch_size, 257, 1408]
-        image_features = image_features[:, 1:] 
-        add_feature_llm = self.vision_project(image_features) 
+        with timed_region("vit_intermediate"):
+            image_features= self.visual_encoder.get_intermediate_layers(image)[-2] # [batch_size, 257, 1408]
+        with timed_region("projection"):
+            add_feature_llm = self.project_patch_features(image_features)
         atts_add_feature_llm = torch.ones(add_feature_llm.size()[:-1], dtype=torch.long).to(image.device)
         
-        with self.maybe_autocast():
+        with timed_region("vit"), self.maybe_autocast():
             image_embeds = self.ln_vision(self.visual_encoder(image))
         image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(image.device)
 
@@ -148,53 +208,58 @@ class BLIVAVicuna(Blip2Base):
 
         query_tokens = self.query_tokens.expand(image_embeds.shape[0], -1, -1)
         if self.qformer_text_input:
-            text_Qformer = self.tokenizer(
-                samples["text_input"],
-                padding='longest',
-                truncation=True,
-                max_length=self.max_txt_len,
-                return_tensors="pt",
-            ).to(image.device)
+            with timed_region("tokenization"):
+                text_Qformer = self.tokenizer(
+                    samples["text_input"],
+                    padding='longest',
+                    truncation=True,
+                    max_length=self.max_txt_len,
+                    return_tensors="pt",
+                ).to(image.device)
             query_atts = torch.ones(query_tokens.size()[:-1], dtype=torch.long).to(image.device)
             Qformer_atts = torch.cat([query_atts, text_Qformer.attention_mask],dim=1)
 
-            query_output = self.Qformer.bert(
-                text_Qformer.input_ids,
-                attention_mask=Qformer_atts,
-                query_embeds=query_tokens,
-                encoder_hidden_states=image_embeds,
-                encoder_attention_mask=image_atts,
-                return_dict=True,
-            )
+            with timed_region("qformer"):
+                query_output = self.Qformer.bert(
+                    text_Qformer.input_ids,
+                    attention_mask=Qformer_atts,
+                    query_embeds=query_tokens,
+                    encoder_hidden_states=image_embeds,
+                    encoder_attention_mask=image_atts,
+                    return_dict=True,
+                )
         else:
-            query_output = self.Qformer.bert(
-                query_embeds=query_tokens,
-                encoder_hidden_states=image_embeds,
-                encoder_attention_mask=image_atts,
-                return_dict=True,
-            )
+            with timed_region("qformer"):
+                query_output = self.Qformer.bert(
+                    query_embeds=query_tokens,
+                    encoder_hidden_states=image_embeds,
+                    encoder_attention_mask=image_atts,
+                    return_dict=True,
+                )
 
-        inputs_llm = self.llm_proj(query_output.last_hidden_state[:,:query_tokens.size(1),:])
+        with timed_region("projection"):
+            inputs_llm = self.llm_proj(query_output.last_hidden_state[:,:query_tokens.size(1),:])
         atts_llm = torch.ones(inputs_llm.size()[:-1], dtype=torch.long).to(image.device)
 
-        self.llm_tokenizer.padding_side = "right"
-        self.llm_tokenizer.truncation_side = 'left'
-        text_input_tokens = self.llm_tokenizer(
-            samples['text_input'],
-            return_tensors="pt",
-            padding="longest",
-            truncation=True,
-            max_length=self.max_txt_len,
-        ).to(image.device)
+        with timed_region("tokenization"):
+            self.llm_tokenizer.padding_side = "right"
+            self.llm_tokenizer.truncation_side = 'left'
+            text_input_tokens = self.llm_tokenizer(
+                samples['text_input'],
+                return_tensors="pt",
+                padding="longest",
+                truncation=True,
+                max_length=self.max_txt_len,
+            ).to(image.device)
 
-        self.llm_tokenizer.truncation_side = 'right'
-        text_output_tokens = self.llm_tokenizer(
-            [t + self.llm_tokenizer.eos_token for t in samples['text_output']],
-            return_tensors="pt",
-            padding="longest",
-            truncation=True,
-            max_length=self.max_output_txt_len,
-        ).to(image.device)
+            self.llm_tokenizer.truncation_side = 'right'
+            text_output_tokens = self.llm_tokenizer(
+                [t + self.llm_tokenizer.eos_token for t in samples['text_output']],
+                return_tensors="pt",
+                padding="longest",
+                truncation=True,
+                max_length=self.max_output_txt_len,
+            ).to(image.device)
 
         llm_tokens, input_part_targets_len = self.concat_text_input_output(
             text_input_tokens.input_ids,
@@ -229,7 +294,7 @@ class BLIVAVicuna(Blip2Base):
         inputs_embeds = torch.cat([inputs_llm, add_feature_llm, inputs_embeds], dim=1)
         attention_mask = torch.cat([atts_llm, atts_add_feature_llm, llm_tokens['attention_mask']], dim=1)
 
-        with self.maybe_autocast():
+        with timed_region("llm"), self.maybe_autocast():
             outputs = self.llm_model(
                 inputs_embeds=inputs_embeds,
                 attention_mask=attention_mask,
@@ -254,6 +319,7 @@ class BLIVAVicuna(Blip2Base):
         length_penalty=1,
         num_captions=1,
         temperature=1,
+        logits_processor=None,
     ):
         self.llm_tokenizer.padding_side = "left"
 
@@ -262,9 +328,14 @@ class BLIVAVicuna(Blip2Base):
         else:
             prompt = samples["text_input"]
 
-        image = samples["image"]
-
-        bs = image.size(0)
+        if "inputs_llm" in samples.keys():
+            # image already encoded, e.g. by an exported encoder (see ImageEncoderRuntime) or an ImageSession
+            device = self.device
+            bs = samples["inputs_llm"].size(0)
+        else:
+            image = samples["image"]
+            device = image.device
+            bs = image.size(0)
 
         # if isinstance(prompt, str):
         #     prompt = [prompt] * bs
@@ -284,18 +355,24 @@ class BLIVAVicuna(Blip2Base):
             # qformer_prompt = prompt
             # qformer_prompt = ['Question: ' + qp.split(' Question: ')[1] for qp in qformer_prompt]
 
-            text_Qformer = self.tokenizer(
-                prompt,
-                padding='longest',
-                truncation=True,
-                max_length=self.max_txt_len,
-                return_tensors="pt",
-            ).to(image.device)
-            query_atts = torch.ones(query_tokens.size()[:-1], dtype=torch.long).to(image.device)
+            with timed_region("tokenization"):
+                text_Qformer = self.tokenizer(
+                    prompt,
+                    padding='longest',
+                    truncation=True,
+                    max_length=self.max_txt_len,
+                    return_tensors="pt",
+                ).to(device)
+            query_atts = torch.ones(query_tokens.size()[:-1], dtype=torch.long).to(device)
             Qformer_atts = torch.cat([query_atts, text_Qformer.attention_mask], dim=1)
 
+        if "inputs_llm" in samples.keys():
+            inputs_llm = samples["inputs_llm"].to(device)
+            atts_llm = torch.ones(inputs_llm.size()[:-1], dtype=torch.long).to(device)
+            add_feature_llm = samples["add_feature_llm"].to(device)
+            atts_add_feature_llm = torch.ones(add_feature_llm.size()[:-1], dtype=torch.long).to(device)
         # For video data
-        if image.dim() == 5:
+        elif image.dim() == 5:
             inputs_llm, atts_llm = [], []
             add_inputs_llm, add_atts_llm = [], []
             for j in range(image.size(2)):
@@ -304,11 +381,9 @@ class BLIVAVicuna(Blip2Base):
                     frame_embeds = self.ln_vision(self.visual_encoder(this_frame))
                     frame_features =self.visual_encoder.get_intermediate_layers(this_frame)[-2]
                     
-                frame_atts = torch.ones(frame_embeds.size()[:-1], dtype=torch.long).to(image.device)
-                frame_features = frame_features[:, 1:] 
-        
-                add_feature_llm = self.vision_project(frame_features) 
-                atts_add_feature_llm = torch.ones(add_feature_llm.size()[:-1], dtype=torch.long).to(image.device)
+                frame_atts = torch.ones(frame_embeds.size()[:-1], dtype=torch.long).to(device)
+                add_feature_llm = self.project_patch_features(frame_features)
+                atts_add_feature_llm = torch.ones(add_feature_llm.size()[:-1], dtype=torch.long).to(device)
         
                 if self.qformer_text_input:
                     frame_query_output = self.Qformer.bert(
@@ -327,7 +402,7 @@ class BLIVAVicuna(Blip2Base):
                         return_dict=True,
                     )
                 frame_inputs_llm = self.llm_proj(frame_query_output.last_hidden_state[:,:query_tokens.size(1),:])
-                frame_atts_llm = torch.ones(frame_inputs_llm.size()[:-1], dtype=torch.long).to(image.device)
+                frame_atts_llm = torch.ones(frame_inputs_llm.size()[:-1], dtype=torch.long).to(device)
                 inputs_llm.append(frame_inputs_llm)
                 atts_llm.append(frame_atts_llm)
                 add_inputs_llm.append(add_feature_llm)
@@ -337,69 +412,142 @@ class BLIVAVicuna(Blip2Base):
             add_feature_llm = torch.cat(add_inputs_llm, dim=1)
             atts_add_feature_llm = torch.cat(add_atts_llm, dim=1)
         else:
-            with self.maybe_autocast():
-                image_embeds = self.ln_vision(self.visual_encoder(image))
+            with timed_region("vit"), self.maybe_autocast():
+                # one ViT pass for both, [batch_size, 257, 1408]
+                image_embeds, image_features = self.vision_features(image)
+                image_embeds = self.ln_vision(image_embeds)
 
-                image_features= self.visual_encoder.get_intermediate_layers(image)[-2] # [batch_size, 257, 1408]
-                
-            image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(image.device)
+            image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(device)
            
-            image_features = image_features[:, 1:] 
-            add_feature_llm = self.vision_project(image_features) 
-            atts_add_feature_llm = torch.ones(add_feature_llm.size()[:-1], dtype=torch.long).to(image.device)
+            with timed_region("projection"):
+                add_feature_llm = self.project_patch_features(image_features)
+            atts_add_feature_llm = torch.ones(add_feature_llm.size()[:-1], dtype=torch.long).to(device)
 
-            if self.qformer_text_input:
-                query_output = self.Qformer.bert(
-                    text_Qformer.input_ids,
-                    attention_mask=Qformer_atts,
-                    query_embeds=query_tokens,
-                    encoder_hidden_states=image_embeds,
-                    encoder_attention_mask=image_atts,
-                    return_dict=True,
-                )
-            else:
-                query_output = self.Qformer.bert(
-                    query_embeds=query_tokens,
-                    encoder_hidden_states=image_embeds,
-                    encoder_attention_mask=image_atts,
-                    return_dict=True,
-                )
+            with timed_region("qformer"):
+                if self.qformer_text_input:
+                    query_output = self.Qformer.bert(
+                        text_Qformer.input_ids,
+                        attention_mask=Qformer_atts,
+                        query_embeds=query_tokens,
+                        encoder_hidden_states=image_embeds,
+                        encoder_attention_mask=image_atts,
+                        return_dict=True,
+                    )
+                else:
+                    query_output = self.Qformer.bert(
+                        query_embeds=query_tokens,
+                        encoder_hidden_states=image_embeds,
+                        encoder_attention_mask=image_atts,
+                        return_dict=True,
+                    )
 
-            inputs_llm = self.llm_proj(query_output.last_hidden_state[:,:query_tokens.size(1),:])
-            atts_llm = torch.ones(inputs_llm.size()[:-1], dtype=torch.long).to(image.device)
+            with timed_region("projection"):
+                inputs_llm = self.llm_proj(query_output.last_hidden_state[:,:query_tokens.size(1),:])
+            atts_llm = torch.ones(inputs_llm.size()[:-1], dtype=torch.long).to(device)
 
-        llm_tokens = self.llm_tokenizer(
-            prompt,
-            padding="longest",
-            return_tensors="pt"
-        ).to(image.device)
+        with timed_region("tokenization"):
+            llm_tokens = self.llm_tokenizer(
+                prompt,
+                padding="longest",
+                return_tensors="pt"
+            ).to(device)
 
         with self.maybe_autocast():
             inputs_embeds = self.llm_model.get_input_embeddings()(llm_tokens.input_ids)
             inputs_embeds = torch.cat([inputs_llm, add_feature_llm, inputs_embeds], dim=1)
             attention_mask = torch.cat([atts_llm, atts_add_feature_llm, llm_tokens['attention_mask']], dim=1)
 
-            outputs = self.llm_model.generate(
-                inputs_embeds=inputs_embeds,
-                attention_mask=attention_mask,
-                do_sample=use_nucleus_sampling,
-                top_p=top_p,
-                temperature=temperature,
-                num_beams=num_beams,
-                max_length=max_length,
-                min_length=min_length,
-                # eos_token_id=self.eos_token_id,
-                repetition_penalty=repetition_penalty,
-                length_penalty=length_penalty,
-                num_return_sequences=num_captions,
-            )
+        use_speculative = (
+            self.draft_llm_model is not None
+            and not use_nucleus_sampling
+            and num_beams == 1
+            and num_captions == 1
+            and bs == 1
+        )
+
+        if use_speculative:
+            with timed_region("llm_speculative"):
+                outputs = self._speculative_generate(
+                    inputs_embeds,
+                    llm_tokens.input_ids,
+                    max_length=max_length,
+                    min_length=min_length,
+                    repetition_penalty=repetition_penalty,
+                    logits_processor=logits_processor,
+                )
+        else:
+            with timed_generate(logits_processor) as logits_processor, self.maybe_autocast():
+                outputs = self.llm_model.generate(
+                    inputs_embeds=inputs_embeds,
+                    attention_mask=attention_mask,
+                    do_sample=use_nucleus_sampling,
+                    top_p=top_p,
+                    temperature=temperature,
+                    num_beams=num_beams,
+                    max_length=max_length,
+                    min_length=min_length,
+                    # eos_token_id=self.eos_token_id,
+                    repetition_penalty=repetition_penalty,
+                    length_penalty=length_penalty,
+                    num_return_sequences=num_captions,
+                    logits_processor=logits_processor,
+                )
 
         outputs[outputs == 0] = 2 # convert output id 0 to 2 (eos_token_id)
-        output_text = self.llm_tokenizer.batch_decode(outputs, skip_special_tokens=True)
+        with timed_region("detokenization"):
+            output_text = self.llm_tokenizer.batch_decode(outputs, skip_special_tokens=True)
         output_text = [text.strip() for text in output_text]
 
         return output_text
 
+    def _speculative_generate(
+        self,
+        inputs_embeds,
+        draft_input_ids,
+        max_length=256,
+        min_length=1,
+        repetition_penalty=1.5,
+        logits_processor=None,
+    ):
+        """
+        Greedy decoding with the draft model proposing tokens from the text prompt.
+        Builds the same logits processors as llm_model.generate() so that outputs
+        match plain greedy decoding.
+        """
+        from transformers import (
+            LogitsProcessorList,
+            MinLengthLogitsProcessor,
+            RepetitionPenaltyLogitsProcessor,
+        )
+
+        eos_token_id = self.llm_tokenizer.eos_token_id
+
+        processors = LogitsProcessorList()
+        if repetition_penalty is not None and repetition_penalty != 1.0:
+            processors.append(RepetitionPenaltyLogitsProcessor(penalty=repetition_penalty))
+        if min_length is not None and min_length > 0:
+            processors.append(MinLengthLogitsProcessor(min_length, eos_token_id))
+        if logits_processor is not None:
+            processors.extend(logits_processor)
+
+        with self.maybe_autocast():
+            outputs = speculative_greedy_decode(
+                self.llm_model,
+                self.draft_llm_model,
+                inputs_embeds,
+                draft_input_ids,
+                max_new_tokens=max_length,
+                eos_token_id=eos_token_id,
+                num_draft_tokens=self.num_draft_tokens,
+                logits_processor=processors,
+                stats=self.speculative_stats,
+            )
+
+        if self.speculative_stats.num_sequences % 100 == 0:
+            logging.info("Speculative decoding: {}".format(self.speculative_stats.summary()))
+
+        return outputs
+
     def predict_answers(
         self,
         samples,
@@ -435,13 +583,23 @@ class BLIVAVicuna(Blip2Base):
 
         samples["prompt"] = text_input
 
-        output_text = self.generate(
-            samples,
-            num_beams=num_beams,
-            max_length=max_len,
-            min_length=min_len,
-            length_penalty=length_penalty
-        )
+        if inference_method in ["constrained", "rank"] and answer_list is not None:
+            output_text = self._predict_answers_from_list(
+                samples,
+                answer_list,
+                self.llm_tokenizer,
+                inference_method=inference_method,
+                num_beams=num_beams,
+                length_penalty=length_penalty,
+            )
+        else:
+            output_text = self.generate(
+                samples,
+                num_beams=num_beams,
+                max_length=max_len,
+                min_length=min_len,
+                length_penalty=length_penalty
+            )
 
         if "apply_lemmatizer" in samples.keys() and samples["apply_lemmatizer"]:
             output_text = self._lemmatize(output_text)
@@ -547,9 +705,7 @@ class BLIVAVicuna(Blip2Base):
                     frame_features =self.visual_encoder.get_intermediate_layers(this_frame)[-2]
                     
                 frame_atts = torch.ones(frame_embeds.size()[:-1], dtype=torch.long).to(image.device)
-                frame_features = frame_features[:, 1:] 
-        
-                add_feature_llm = self.vision_project(frame_features) 
+                add_feature_llm = self.project_patch_features(frame_features)
                 atts_add_feature_llm = torch.ones(add_feature_llm.size()[:-1], dtype=torch.long).to(image.device)
         
                 if self.qformer_text_input:
@@ -580,14 +736,13 @@ class BLIVAVicuna(Blip2Base):
             atts_add_feature_llm = torch.cat(add_atts_llm, dim=1)
         else:
             with self.maybe_autocast():
-                image_embeds = self.ln_vision(self.visual_encoder(image))
+                # one ViT pass for both, [batch_size, 257, 1408]
+                image_embeds, image_features = self.vision_features(image)
+                image_embeds = self.ln_vision(image_embeds)
 
-                image_features= self.visual_encoder.get_intermediate_layers(image)[-2] # [batch_size, 257, 1408]
-                
             image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(image.device)
            
-            image_features = image_features[:, 1:] 
-            add_feature_llm = self.vision_project(image_features) 
+            add_feature_llm = self.project_patch_features(image_features)
             atts_add_feature_llm = torch.ones(add_feature_llm.size()[:-1], dtype=torch.long).to(image.device)
 
             if self.qformer_text_input:
@@ -697,42 +852,16 @@ class BLIVAVicuna(Blip2Base):
 
         return output_class_ranks
 
-    def _lemmatize(self, answers):
-        def apply(answer):
-            doc = self.lemmatizer(answer)
-
-            words = []
-            for token in doc:
-                if token.pos_ in ["NOUN", "VERB"]:
-                    words.append(token.lemma_)
-                else:
-                    words.append(token.text)
-            answer = " ".join(words)
-
-            return answer
-
-        return [apply(answer) for answer in answers]
-
-    @property
-    def lemmatizer(self):
-        if self._lemmatizer is None:
-            try:
-                import spacy
-
-                self._lemmatizer = spacy.load("en_core_web_sm")
-            except ImportError:
-                logging.error(
-                    """
-                    Please install spacy and en_core_web_sm model to apply lemmatization.
-                    python -m spacy download en_core_web_sm
-                    OR
-                    import spacy.cli
-                    spacy.cli.download("en_core_web_sm")
-                    """
-                )
-                exit(1)
+    def lazy_weight_sources(self, cfg):
+        llm_model = cfg.get("llm_model")
 
-        return self._lemmatizer
+        return super().lazy_weight_sources(cfg) + [
+            WeightSource(
+                lambda: hf_checkpoint_files(llm_model),
+                prefix="llm_model.",
+                name=llm_model,
+            )
+        ]
 
     @classmethod
     def from_config(cls, cfg):
@@ -754,22 +883,44 @@ class BLIVAVicuna(Blip2Base):
 
         qformer_text_input = cfg.get("qformer_text_input", True)
 
-        model = cls(
-            vit_model=vit_model,
-            img_size=img_size,
-            drop_path_rate=drop_path_rate,
-            use_grad_checkpoint=use_grad_checkpoint,
-            vit_precision=vit_precision,
-            freeze_vit=freeze_vit,
-            num_query_token=num_query_token,
-            llm_model=llm_model,
-            prompt=prompt,
-            max_txt_len=max_txt_len,
-            max_output_txt_len=max_output_txt_len,
-            apply_lemmatizer=apply_lemmatizer,
-            qformer_text_input=qformer_text_input,
-        )
+        # shorten the patch-token prefix, see daiv/models/token_reducer.py
+        token_reducer = cfg.get("token_reducer", None)
+
+        # build on the meta device and stream weights in afterwards
+        lazy_init = cls.lazy_init_from_config(cfg)
+
+        # reuse the vision encoder of other models of the process, see daiv/models/vision_pool.py
+        share_vision_encoder = cfg.get("share_vision_encoder", False)
+
+        with init_empty_weights(enabled=lazy_init):
+            model = cls(
+                vit_model=vit_model,
+                img_size=img_size,
+                drop_path_rate=drop_path_rate,
+                use_grad_checkpoint=use_grad_checkpoint,
+                vit_precision=vit_precision,
+                freeze_vit=freeze_vit,
+                num_query_token=num_query_token,
+                llm_model=llm_model,
+                prompt=prompt,
+                max_txt_len=max_txt_len,
+                max_output_txt_len=max_output_txt_len,
+                apply_lemmatizer=apply_lemmatizer,
+                qformer_text_input=qformer_text_input,
+                token_reducer=token_reducer,
+                share_vision_encoder=share_vision_encoder,
+                lazy_init=lazy_init,
+            )
+
+        if lazy_init:
+            model.load_lazy_weights_from_config(cfg)
+        else:
+            model.load_checkpoint_from_config(cfg)
+
+        model.quantize_from_config(cfg)
 
-        model.load_checkpoint_from_config(cfg)
+        draft_llm_model = cfg.get("draft_llm_model", "")
+        if draft_llm_model:
+            model.init_draft_model(draft_llm_model, cfg.get("num_draft_tokens", 4))
 
         return model
@@ -1,6 +1,7 @@
 """
 Requires Transformer 4.28 and above, implementation may change according the Llama implementation
 """
+import contextlib
 import logging
 import string
 from packaging import version
@@ -10,6 +11,7 @@ from torch.cuda.amp import autocast as autocast
 import torch.nn as nn
 
 import transformers
+from omegaconf import OmegaConf
 
 from daiv.common.registry import registry
 from daiv.models.blip2 import Blip2Base, disabled_train
@@ -22,6 +24,8 @@ from peft import (
 )
 from peft import PeftModel
 from daiv.models.modeling_llama import LlamaForCausalLM
+from daiv.models.multi_lora import LoRAAdapterPool
+from daiv.models.token_reducer import build_token_reducer
 
 def find_all_linear_names(model):
     cls = torch.nn.Linear
@@ -59,6 +63,8 @@ class BlivaVicunaLoRA(Blip2Base):
         max_output_txt_len=256,
         apply_lemmatizer=False,
         qformer_text_input=True,
+        token_reducer=None,
+        multi_lora=None,
     ):
         super().__init__()
         transformers_version = version.parse(transformers.__version__)
@@ -131,11 +137,11 @@ class BlivaVicunaLoRA(Blip2Base):
         prompt_tokens = self.llm_tokenizer(self.prompt, return_tensors="pt")
         self.prompt_length = prompt_tokens.attention_mask.sum(1)
 
-        self._lemmatizer = None
 
         self.qformer_text_input = qformer_text_input
 
         self.vision_project = nn.Linear(self.visual_encoder.num_features, self.llm_model.config.hidden_size)
+        self.token_reducer = build_token_reducer(token_reducer, self.visual_encoder.num_features)
         
         #lora 
         self.lora_config =  LoraConfig(
@@ -147,9 +153,42 @@ class BlivaVicunaLoRA(Blip2Base):
             task_type="CAUSAL_LM",
         )
         
-        self.llm_model = get_peft_model(self.llm_model, self.lora_config)  
-        self.llm_model.print_trainable_parameters()
-        self.llm_model.train() 
+        if multi_lora:
+            # serving: one base LLM and many adapters selected per sample, see daiv/models/multi_lora.py
+            self.adapter_pool = LoRAAdapterPool(
+                self.llm_model,
+                target_modules=self.lora_config.target_modules,
+                default_scaling=self.lora_config.lora_alpha / self.lora_config.r,
+                **multi_lora,
+            )
+        else:
+            self.adapter_pool = None
+            self.llm_model = get_peft_model(self.llm_model, self.lora_config)  
+            self.llm_model.print_trainable_parameters()
+            self.llm_model.train() 
+
+    def select_adapters(self, adapter):
+        """
+        Apply the LoRA adapters ``adapter`` (a name, or one name per sample) within
+        this context. Only with multi_lora; the single peft adapter is always applied.
+        """
+        if self.adapter_pool is None:
+            return contextlib.nullcontext()
+        return self.adapter_pool.select(adapter)
+
+    def merge_and_unload(self, adapter=None):
+        """
+        Merge a LoRA adapter into the LLM weights and remove the LoRA layers, for
+        single-adapter deployment: ``adapter`` names a multi_lora adapter (required
+        with multi_lora), without multi_lora the peft adapter is merged.
+        """
+        if self.adapter_pool is not None:
+            assert adapter is not None, "Name the multi_lora adapter to merge."
+            self.llm_model = self.adapter_pool.merge_and_unload(adapter)
+            self.adapter_pool = None
+        elif isinstance(self.llm_model, PeftModel):
+            self.llm_model = self.llm_model.merge_and_unload()
+        return self
 
     def concat_text_input_output(self, input_ids, input_atts, output_ids, output_atts):
         input_part_targets_len = []
@@ -185,8 +224,7 @@ class BlivaVicunaLoRA(Blip2Base):
         image = samples["image"]
 
         image_features= self.visual_encoder.get_intermediate_layers(image)[-2] # [batch_size, 257, 1408]
-        image_features = image_features[:, 1:] 
-        add_feature_llm = self.vision_project(image_features) 
+        add_feature_llm = self.project_patch_features(image_features)
         atts_add_feature_llm = torch.ones(add_feature_llm.size()[:-1], dtype=torch.long).to(image.device)
         
         with self.maybe_autocast():
@@ -275,7 +313,7 @@ class BlivaVicunaLoRA(Blip2Base):
         inputs_embeds = torch.cat([inputs_llm, add_feature_llm, inputs_embeds], dim=1)
         attention_mask = torch.cat([atts_llm, atts_add_feature_llm, llm_tokens['attention_mask']], dim=1)
 
-        with self.maybe_autocast():
+        with self.maybe_autocast(), self.select_adapters(samples.get("adapter")):
             outputs = self.llm_model(
                 inputs_embeds=inputs_embeds,
                 attention_mask=attention_mask,
@@ -345,9 +383,7 @@ class BlivaVicunaLoRA(Blip2Base):
                     frame_features =self.visual_encoder.get_intermediate_layers(this_frame)[-2]
                     
                 frame_atts = torch.ones(frame_embeds.size()[:-1], dtype=torch.long).to(image.device)
-                frame_features = frame_features[:, 1:] 
-        
-                add_feature_llm = self.vision_project(frame_features) 
+                add_feature_llm = self.project_patch_features(frame_features)
                 atts_add_feature_llm = torch.ones(add_feature_llm.size()[:-1], dtype=torch.long).to(image.device)
         
                 if self.qformer_text_input:
@@ -384,8 +420,7 @@ class BlivaVicunaLoRA(Blip2Base):
                 
             image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(image.device)
            
-            image_features = image_features[:, 1:] 
-            add_feature_llm = self.vision_project(image_features) 
+            add_feature_llm = self.project_patch_features(image_features)
             atts_add_feature_llm = torch.ones(add_feature_llm.size()[:-1], dtype=torch.long).to(image.device)
 
             if self.qformer_text_input:
@@ -414,7 +449,7 @@ class BlivaVicunaLoRA(Blip2Base):
             return_tensors="pt"
         ).to(image.device)
 
-        with self.maybe_autocast():
+        with self.maybe_autocast(), self.select_adapters(samples.get("adapter")):
             inputs_embeds = self.llm_model.get_input_embeddings()(llm_tokens.input_ids)
             inputs_embeds = torch.cat([inputs_llm, add_feature_llm, inputs_embeds], dim=1)
             attention_mask = torch.cat([atts_llm, atts_add_feature_llm, llm_tokens['attention_mask']], dim=1)
@@ -518,6 +553,10 @@ class BlivaVicunaLoRA(Blip2Base):
                 if 'caption' in samples.keys():
                     this_sample['caption'] = [samples["caption"][i]]
 
+                if 'adapter' in samples.keys():
+                    adapter = samples["adapter"]
+                    this_sample['adapter'] = adapter if isinstance(adapter, str) else [adapter[i]]
+
                 this_result = self._predict_class(this_sample, candidates[i], n_segments)
                 results.append(this_result)
 
@@ -586,9 +625,7 @@ class BlivaVicunaLoRA(Blip2Base):
                     frame_features =self.visual_encoder.get_intermediate_layers(this_frame)[-2]
                     
                 frame_atts = torch.ones(frame_embeds.size()[:-1], dtype=torch.long).to(image.device)
-                frame_features = frame_features[:, 1:] 
-        
-                add_feature_llm = self.vision_project(frame_features) 
+                add_feature_llm = self.project_patch_features(frame_features)
                 atts_add_feature_llm = torch.ones(add_feature_llm.size()[:-1], dtype=torch.long).to(image.device)
         
                 if self.qformer_text_input:
@@ -625,8 +662,7 @@ class BlivaVicunaLoRA(Blip2Base):
                 
             image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(image.device)
            
-            image_features = image_features[:, 1:] 
-            add_feature_llm = self.vision_project(image_features) 
+            add_feature_llm = self.project_patch_features(image_features)
             atts_add_feature_llm = torch.ones(add_feature_llm.size()[:-1], dtype=torch.long).to(image.device)
 
             if self.qformer_text_input:
@@ -666,7 +702,7 @@ class BlivaVicunaLoRA(Blip2Base):
         # self.llm_tokenizer.padding_side = "right"
         self.llm_tokenizer.truncation_side = 'right'
         n_cands = len(candidates)
-        with self.maybe_autocast(dtype=torch.bfloat16):
+        with self.maybe_autocast(dtype=torch.bfloat16), self.select_adapters(samples.get("adapter")):
             all_losses = []
             for n in range(n_segments):
                 seg_len = n_cands // n_segments
@@ -735,43 +771,6 @@ class BlivaVicunaLoRA(Blip2Base):
 
         return output_class_ranks
 
-    def _lemmatize(self, answers):
-        def apply(answer):
-            doc = self.lemmatizer(answer)
-
-            words = []
-            for token in doc:
-                if token.pos_ in ["NOUN", "VERB"]:
-                    words.append(token.lemma_)
-                else:
-                    words.append(token.text)
-            answer = " ".join(words)
-
-            return answer
-
-        return [apply(answer) for answer in answers]
-
-    @property
-    def lemmatizer(self):
-        if self._lemmatizer is None:
-            try:
-                import spacy
-
-                self._lemmatizer = spacy.load("en_core_web_sm")
-            except ImportError:
-                logging.error(
-                    """
-                    Please install spacy and en_core_web_sm model to apply lemmatization.
-                    python -m spacy download en_core_web_sm
-                    OR
-                    import spacy.cli
-                    spacy.cli.download("en_core_web_sm")
-                    """
-                )
-                exit(1)
-
-        return self._lemmatizer
-
     @classmethod
     def from_config(cls, cfg):
         vit_model = cfg.get("vit_model", "eva_clip_g")
@@ -793,6 +792,15 @@ class BlivaVicunaLoRA(Blip2Base):
 
         qformer_text_input = cfg.get("qformer_text_input", True)
 
+        # shorten the patch-token prefix, see daiv/models/token_reducer.py
+        token_reducer = cfg.get("token_reducer", None)
+
+        # serve many LoRA adapters on one LLM, e.g.
+        # multi_lora: {memory_budget_mb: 2048, adapters: {customer_a: /path/to/adapter}}
+        multi_lora = cfg.get("multi_lora", None)
+        if multi_lora is not None:
+            multi_lora = OmegaConf.to_container(multi_lora)
+
         model = cls(
             vit_model=vit_model,
             img_size=img_size,
@@ -808,6 +816,8 @@ class BlivaVicunaLoRA(Blip2Base):
             max_output_txt_len=max_output_txt_len,
             apply_lemmatizer=apply_lemmatizer,
             qformer_text_input=qformer_text_input,
+            token_reducer=token_reducer,
+            multi_lora=multi_lora,
         )
 
         model.load_checkpoint_from_config(cfg)
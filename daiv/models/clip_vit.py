@@ -248,7 +248,10 @@ def interpolate_pos_embed(model, state_dict, interpolation: str = 'bicubic', seq
     state_dict['positional_embedding'] = new_pos_embed
     
     
-def create_clip_vit_L(img_size=224,use_checkpoint=False,precision="fp16"):
+CLIP_VIT_L_URL = "https://storage.googleapis.com/sfr-vision-language-research/LAVIS/models/BLIP2/clip_vit_L.pth"
+
+
+def create_clip_vit_L(img_size=224,use_checkpoint=False,precision="fp16",load_weights=True):
     model = VisionTransformer(
             input_resolution=img_size,
             patch_size=14,
@@ -257,15 +260,16 @@ def create_clip_vit_L(img_size=224,use_checkpoint=False,precision="fp16"):
             heads=16,
             use_grad_checkpointing=use_checkpoint,
         )         
-    url = "https://storage.googleapis.com/sfr-vision-language-research/LAVIS/models/BLIP2/clip_vit_L.pth"
-    cached_file = download_cached_file(
-        url, check_hash=False, progress=True
-    )
-    state_dict = torch.load(cached_file, map_location="cpu")    
-    interpolate_pos_embed(model,state_dict)
-    
-    incompatible_keys = model.load_state_dict(state_dict, strict=False)
-    # print(incompatible_keys)
+    # weights are loaded separately when the model is built with lazy_init
+    if load_weights:
+        cached_file = download_cached_file(
+            CLIP_VIT_L_URL, check_hash=False, progress=True
+        )
+        state_dict = torch.load(cached_file, map_location="cpu")    
+        interpolate_pos_embed(model,state_dict)
+        
+        incompatible_keys = model.load_state_dict(state_dict, strict=False)
+        # print(incompatible_keys)
     
     if precision == "fp16":
         convert_weights_to_fp16(model)
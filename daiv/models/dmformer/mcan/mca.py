@@ -12,6 +12,22 @@ import torch.nn.functional as F
 
 
 
+def _match_weight_dtype(x, weight):
+    # under autocast the matmuls pick their precision, otherwise inputs follow the weights
+    return x if torch.is_autocast_enabled() else x.to(weight.dtype)
+
+
+def trim_padding(x, x_mask):
+    """
+    Drop the trailing positions that are padding (x_mask True) in every row,
+    e.g. of text padded to max_length. Padded keys are ignored by attention and
+    AttFlat, so the outputs at the other positions and pooled outputs do not change.
+    """
+    valid = ~x_mask.view(x_mask.size(0), -1).all(dim=0)
+    length = int(valid.nonzero().max()) + 1 if valid.any() else 1
+    return x[:, :length], x_mask[..., :length]
+
+
 # ------------------------------
 # ---- Multi-Head Attention ----
 # ------------------------------
@@ -68,6 +84,44 @@ class MHAtt(nn.Module):
 
         return atted
 
+    def _heads(self, x):
+        return x.reshape(x.size(0), -1, self.__C.MULTI_HEAD, self.__C.HIDDEN_SIZE_HEAD).transpose(1, 2)
+
+    def forward_fast(self, v, k, q, mask, kv=None):
+        """
+        forward() in the precision of the autocast context. Self-attention
+        (v, k and q the same tensor) uses one fused QKV projection; kv gives
+        precomputed (key, value) heads, see MCA_ED.forward_fast.
+        """
+        if kv is not None:
+            key, value = kv
+            query = self.linear_q(_match_weight_dtype(q, self.linear_q.weight))
+        elif v is k and k is q:
+            weight = torch.cat([self.linear_q.weight, self.linear_k.weight, self.linear_v.weight])
+            bias = torch.cat([self.linear_q.bias, self.linear_k.bias, self.linear_v.bias])
+            query, key, value = F.linear(_match_weight_dtype(q, weight), weight, bias).chunk(3, dim=-1)
+            key, value = self._heads(key), self._heads(value)
+        else:
+            query = self.linear_q(_match_weight_dtype(q, self.linear_q.weight))
+            key = self._heads(self.linear_k(_match_weight_dtype(k, self.linear_k.weight)))
+            value = self._heads(self.linear_v(_match_weight_dtype(v, self.linear_v.weight)))
+        query = self._heads(query)
+
+        if hasattr(F, "scaled_dot_product_attention"):
+            # fused attention kernel (torch >= 2.0), the mask is True for positions to attend
+            atted = F.scaled_dot_product_attention(
+                query,
+                key,
+                value,
+                attn_mask=None if mask is None else ~mask,
+                dropout_p=self.dropout.p if self.training else 0.0,
+            )
+        else:
+            atted = self.att(value, key, query, mask)
+
+        atted = atted.transpose(1, 2).reshape(q.size(0), -1, self.__C.HIDDEN_SIZE)
+        return self.linear_merge(atted)
+
     def att(self, value, key, query, mask):
         d_k = query.size(-1)
 
@@ -133,6 +187,10 @@ class SA(nn.Module):
 
         return x
 
+    def forward_fast(self, x, x_mask):
+        x = self.norm1(x + self.dropout1(self.mhatt.forward_fast(x, x, x, x_mask)))
+        return self.norm2(x + self.dropout2(self.ffn(x)))
+
 
 # -------------------------------
 # ---- Self Guided Attention ----
@@ -171,6 +229,11 @@ class SGA(nn.Module):
 
         return x
 
+    def forward_fast(self, x, y, x_mask, y_mask, y_kv=None):
+        x = self.norm1(x + self.dropout1(self.mhatt1.forward_fast(x, x, x, x_mask)))
+        x = self.norm2(x + self.dropout2(self.mhatt2.forward_fast(y, y, x, y_mask, kv=y_kv)))
+        return self.norm3(x + self.dropout3(self.ffn(x)))
+
 
 # ------------------------------------------------
 # ---- MAC Layers Cascaded by Encoder-Decoder ----
@@ -183,7 +246,13 @@ class MCA_ED(nn.Module):
         self.enc_list = nn.ModuleList([SA(__C) for _ in range(__C.LAYER)])
         self.dec_list = nn.ModuleList([SGA(__C) for _ in range(__C.LAYER)])
 
+        # performance mode, see forward_fast; the weights are the same in both modes
+        self.fast = False
+
     def forward(self, x, y, x_mask, y_mask):
+        if self.fast:
+            return self.forward_fast(x, y, x_mask, y_mask)
+
         # Get hidden vector
         #print("MCA LAYER 통과합니다...")
         for enc in self.enc_list:
@@ -192,4 +261,55 @@ class MCA_ED(nn.Module):
         for dec in self.dec_list:
             y = dec(y, x, y_mask, x_mask)
 
-        return x, y
\ No newline at end of file
+        return x, y
+
+    def encoder_key_values(self, x):
+        """
+        Key and value heads of the encoder output x for the guided attention
+        of every SGA layer, projected with one matmul.
+        """
+        linears = [linear for dec in self.dec_list for linear in (dec.mhatt2.linear_k, dec.mhatt2.linear_v)]
+        weight = torch.cat([linear.weight for linear in linears])
+        bias = torch.cat([linear.bias for linear in linears])
+        projected = F.linear(_match_weight_dtype(x, weight), weight, bias).chunk(len(linears), dim=-1)
+
+        return [
+            (dec.mhatt2._heads(projected[2 * i]), dec.mhatt2._heads(projected[2 * i + 1]))
+            for i, dec in enumerate(self.dec_list)
+        ]
+
+    def forward_fast(self, x, y, x_mask, y_mask):
+        """
+        forward() with fused QKV self-attention, precision following the
+        autocast context and the encoder output projected once for the whole
+        SGA stack. Check it against forward() with check_fast_parity.
+        """
+        for enc in self.enc_list:
+            x = enc.forward_fast(x, x_mask)
+
+        for dec, y_kv in zip(self.dec_list, self.encoder_key_values(x)):
+            y = dec.forward_fast(y, x, y_mask, x_mask, y_kv=y_kv)
+
+        return x, y
+
+
+@torch.no_grad()
+def check_fast_parity(backbone, x, y, x_mask, y_mask):
+    """
+    Max abs difference between forward_fast and forward of each layer of an
+    MCA_ED, both fed the outputs of the previous forward() layer. Returns a
+    list of (layer name, difference); run it under autocast to check mixed precision.
+    """
+    diffs = []
+    for i, enc in enumerate(backbone.enc_list):
+        reference = enc(x, x_mask)
+        diffs.append(("enc.{}".format(i), (enc.forward_fast(x, x_mask).float() - reference.float()).abs().max().item()))
+        x = reference
+
+    for i, (dec, y_kv) in enumerate(zip(backbone.dec_list, backbone.encoder_key_values(x))):
+        reference = dec(y, x, y_mask, x_mask)
+        fast = dec.forward_fast(y, x, y_mask, x_mask, y_kv=y_kv)
+        diffs.append(("dec.{}".format(i), (fast.float() - reference.float()).abs().max().item()))
+        y = reference
+
+    return diffs
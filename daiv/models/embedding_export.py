@@ -0,0 +1,228 @@
+"""
+ Copyright (c) 2023, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+ Bulk export of image, text or multimodal embeddings to an on-disk
+ EmbeddingIndex, e.g. for dedup and search over millions of images.
+"""
+
+import json
+import logging
+import os
+import time
+
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset, Subset
+from torch.utils.data.dataloader import default_collate
+
+from daiv.models.retrieval import EmbeddingIndex
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".webp", ".tif", ".tiff")
+
+# record fields extract_features() needs in each mode
+MODE_FIELDS = {"image": ("image",), "text": ("text",), "multimodal": ("image", "text")}
+
+
+def list_image_files(image_dir):
+    """
+    Records of the images under image_dir, with their relative path as id.
+    """
+    records = []
+    for root, _, files in os.walk(image_dir):
+        for name in files:
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(root, name)
+                records.append({"id": os.path.relpath(path, image_dir), "image": path})
+    return sorted(records, key=lambda record: record["id"])
+
+
+def read_jsonl_records(path, image_root=None):
+    """
+    Records of a JSONL file with one {"id": ..., "image": ..., "text": ...}
+    per line; image and text are optional, image paths are relative to
+    image_root (the directory of the file by default) and the id defaults to
+    the image path, then the line number.
+    """
+    image_root = image_root or os.path.dirname(os.path.abspath(path))
+    records = []
+    with open(path) as f:
+        for line_number, line in enumerate(f):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            record = {"id": str(item.get("id", item.get("image", line_number)))}
+            if "image" in item:
+                record["image"] = os.path.join(image_root, item["image"])
+            if "text" in item:
+                record["text"] = item["text"]
+            records.append(record)
+    return records
+
+
+def dataset_ids(dataset, id_key=None):
+    """
+    Id of each row of a dataset: ``id_key`` of its annotation (e.g. "image" to
+    export each image of a caption dataset once), the row index otherwise.
+    """
+    annotation = getattr(dataset, "annotation", None)
+    if isinstance(annotation, dict):
+        annotation = annotation.get("data")
+    if id_key is None or annotation is None or len(annotation) != len(dataset):
+        return [str(i) for i in range(len(dataset))]
+    return [str(ann.get(id_key, i)) for i, ann in enumerate(annotation)]
+
+
+class ImageTextFileDataset(Dataset):
+    """
+    Images (decoded in the DataLoader workers) and texts of a list of records,
+    only the fields the export ``mode`` needs. Records missing one of them and
+    images that fail to decode are skipped with a warning, so every sample has
+    the same keys.
+    """
+
+    def __init__(self, records, vis_processor=None, text_processor=None, mode="multimodal"):
+        assert mode in MODE_FIELDS, "mode must be one of 'image', 'text', 'multimodal'"
+        self.records = records
+        self.vis_processor = vis_processor
+        self.text_processor = text_processor
+        self.fields = MODE_FIELDS[mode]
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, index):
+        record = self.records[index]
+        missing = [field for field in self.fields if field not in record]
+        if missing:
+            logging.warning("Skipping {}: no {}".format(record["id"], " or ".join(missing)))
+            return None
+
+        sample = {}
+        if "image" in self.fields:
+            try:
+                image = Image.open(record["image"]).convert("RGB")
+            except (OSError, ValueError) as e:
+                logging.warning("Skipping {}: {}".format(record["image"], e))
+                return None
+            sample["image"] = self.vis_processor(image)
+        if "text" in self.fields:
+            sample["text_input"] = self.text_processor(record["text"])
+        return sample
+
+    def collater(self, samples):
+        return default_collate(samples)
+
+
+class _WithIds(Dataset):
+    def __init__(self, dataset, ids):
+        self.dataset = dataset
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        sample = self.dataset[index]
+        return None if sample is None else dict(sample, id=self.ids[index])
+
+
+class _CollateWithIds:
+    def __init__(self, collater):
+        self.collater = collater
+
+    def __call__(self, samples):
+        samples = [sample for sample in samples if sample is not None]
+        if not samples:
+            return None
+        ids = [sample.pop("id") for sample in samples]
+        batch = self.collater(samples)
+        batch["id"] = ids
+        return batch
+
+
+def pooled_embeddings(features, mode):
+    """
+    One embedding per sample from the BlipOutputFeatures of extract_features().
+    """
+    if mode == "image":
+        return features.image_embeds_proj
+    if mode == "text":
+        return features.text_embeds_proj
+    return features.multimodal_embeds_proj
+
+
+@torch.no_grad()
+def export_embeddings(
+    model,
+    dataset,
+    ids,
+    output_dir,
+    mode="image",
+    batch_size=64,
+    num_workers=8,
+    shard_size=16384,
+    log_freq=50,
+):
+    """
+    Stream ``dataset`` through model.extract_features(mode=mode) and write one
+    normalized fp16 embedding per id to an EmbeddingIndex in output_dir.
+
+    Rows are written in shards of ``shard_size``; rerunning after an
+    interruption skips the ids already written, as well as repeated ids.
+    Samples are decoded in ``num_workers`` DataLoader workers.
+    """
+    assert mode in ["image", "text", "multimodal"], "mode must be one of 'image', 'text', 'multimodal'"
+    assert len(ids) == len(dataset), "{} ids for {} samples.".format(len(ids), len(dataset))
+
+    index = EmbeddingIndex(output_dir, shard_size=shard_size)
+    assert index.info.get("mode", mode) == mode, "{} holds {} embeddings, not {}.".format(
+        output_dir, index.info["mode"], mode
+    )
+    index.info["mode"] = mode
+
+    done = set(index.ids())
+    todo, seen = [], set()
+    for i, id_ in enumerate(ids):
+        if id_ not in done and id_ not in seen:
+            todo.append(i)
+            seen.add(id_)
+
+    logging.info(
+        "Exporting {} {} embeddings to {} ({} already exported)".format(len(todo), mode, output_dir, len(done))
+    )
+    if not todo:
+        return index.finalize()
+    index.complete = False
+
+    collater = getattr(dataset, "collater", default_collate)
+    data_loader = DataLoader(
+        Subset(_WithIds(dataset, ids), todo),
+        batch_size=batch_size,
+        num_workers=num_workers,
+        pin_memory=model.device.type == "cuda",
+        collate_fn=_CollateWithIds(collater),
+    )
+
+    start_time = time.time()
+    exported = 0
+    for step, samples in enumerate(data_loader):
+        if samples is None:
+            continue
+        batch_ids = samples.pop("id")
+        if "image" in samples:
+            samples["image"] = samples["image"].to(model.device, non_blocking=True)
+
+        features = model.extract_features(samples, mode=mode)
+        index.add(pooled_embeddings(features, mode), ids=batch_ids)
+        exported += len(batch_ids)
+
+        if step % log_freq == 0:
+            rate = exported / max(time.time() - start_time, 1e-6)
+            logging.info("Exported {}/{} ({:.1f} samples/s)".format(exported, len(todo), rate))
+
+    if exported < len(todo):
+        logging.warning("{} samples were skipped (missing fields or undecodable).".format(len(todo) - exported))
+    return index.finalize()
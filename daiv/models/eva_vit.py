@@ -412,7 +412,10 @@ def convert_weights_to_fp16(model: nn.Module):
     model.apply(_convert_weights_to_fp16)
     
     
-def create_eva_vit_g(img_size=224,drop_path_rate=0.4,use_checkpoint=False,precision="fp16"):
+EVA_VIT_G_URL = "https://storage.googleapis.com/sfr-vision-language-research/LAVIS/models/BLIP2/eva_vit_g.pth"
+
+
+def create_eva_vit_g(img_size=224,drop_path_rate=0.4,use_checkpoint=False,precision="fp16",load_weights=True):
     model = VisionTransformer(
         img_size=img_size,
         patch_size=14,
@@ -426,15 +429,16 @@ def create_eva_vit_g(img_size=224,drop_path_rate=0.4,use_checkpoint=False,precis
         norm_layer=partial(nn.LayerNorm, eps=1e-6),
         use_checkpoint=use_checkpoint,
     )  
-    url = "https://storage.googleapis.com/sfr-vision-language-research/LAVIS/models/BLIP2/eva_vit_g.pth"
-    cached_file = download_cached_file(
-        url, check_hash=False, progress=True
-    )
-    state_dict = torch.load(cached_file, map_location="cpu")    
-    interpolate_pos_embed(model,state_dict)
-    
-    incompatible_keys = model.load_state_dict(state_dict, strict=False)
-#   print(incompatible_keys)
+    # weights are loaded separately when the model is built with lazy_init
+    if load_weights:
+        cached_file = download_cached_file(
+            EVA_VIT_G_URL, check_hash=False, progress=True
+        )
+        state_dict = torch.load(cached_file, map_location="cpu")    
+        interpolate_pos_embed(model,state_dict)
+        
+        incompatible_keys = model.load_state_dict(state_dict, strict=False)
+#       print(incompatible_keys)
     
     if precision == "fp16":
 #         model.to("cuda") 
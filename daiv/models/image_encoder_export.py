@@ -0,0 +1,262 @@
+"""
+ Copyright (c) 2023, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+"""
+
+import json
+import logging
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from daiv.models.blip2 import Blip2Base
+
+
+class ImageEncodingStage(nn.Module):
+    """
+    The image half of BLIVA as a standalone module:
+    ViT -> ln_vision -> Q-Former -> llm_proj (query embeddings) and
+    penultimate ViT layer -> token_reducer -> vision_project (patch embeddings).
+
+    The ViT runs once; its last layer output is the same as visual_encoder(image).
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.visual_encoder = model.visual_encoder
+        self.ln_vision = model.ln_vision
+        self.qformer = model.Qformer.bert
+        self.query_tokens = model.query_tokens
+        self.llm_proj = model.llm_proj if hasattr(model, "llm_proj") else model.t5_proj
+        self.token_reducer = model.token_reducer
+        self.vision_project = model.vision_project
+        self.qformer_text_input = model.qformer_text_input
+
+    def forward(self, image, qformer_input_ids=None, qformer_attention_mask=None):
+        features = self.visual_encoder.get_intermediate_layers(image)
+        image_embeds = self.ln_vision(features[-1])
+        image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long, device=image.device)
+
+        query_tokens = self.query_tokens.expand(image.size(0), -1, -1)
+
+        if self.qformer_text_input:
+            query_atts = torch.ones(query_tokens.size()[:-1], dtype=torch.long, device=image.device)
+            query_output = self.qformer(
+                qformer_input_ids,
+                attention_mask=torch.cat([query_atts, qformer_attention_mask], dim=1),
+                query_embeds=query_tokens,
+                encoder_hidden_states=image_embeds,
+                encoder_attention_mask=image_atts,
+                return_dict=True,
+            )
+        else:
+            query_output = self.qformer(
+                query_embeds=query_tokens,
+                encoder_hidden_states=image_embeds,
+                encoder_attention_mask=image_atts,
+                return_dict=True,
+            )
+
+        inputs_llm = self.llm_proj(query_output.last_hidden_state[:, : query_tokens.size(1), :])
+        patch_features = features[-2][:, 1:]
+        if self.token_reducer is not None:
+            patch_features = self.token_reducer(patch_features)
+        add_feature_llm = self.vision_project(patch_features)
+
+        return inputs_llm, add_feature_llm
+
+
+def _metadata_file(filename):
+    return filename + ".json"
+
+
+def _input_resolution(visual_encoder):
+    # EVA ViT-g keeps image_size, the CLIP ViT-L input_resolution
+    for name in ["image_size", "input_resolution"]:
+        if hasattr(visual_encoder, name):
+            return getattr(visual_encoder, name)
+    raise AttributeError("Can not find the input resolution of {}".format(type(visual_encoder).__name__))
+
+
+def export_image_encoder(
+    model,
+    filename,
+    export_format="torchscript",
+    batch_size=1,
+    dynamic_batch=False,
+    opset_version=14,
+):
+    """
+    Export the image-encoding stage of a BLIVA model for CPU serving.
+
+    The stage is exported in fp32. Q-Former prompts are padded to model.max_txt_len
+    so that the graph has a fixed sequence length; with dynamic_batch the batch
+    dimension is left dynamic (ONNX dynamic axes; TorchScript traces are batch
+    agnostic), otherwise inputs are served in chunks of ``batch_size``.
+    A json file next to the artifact records the settings needed by ImageEncoderRuntime.
+    """
+    assert export_format in ["torchscript", "onnx"], "Unknown export format {}".format(export_format)
+
+    stage = ImageEncodingStage(model).float().cpu().eval()
+
+    image_size = _input_resolution(stage.visual_encoder)
+    image = torch.randn(batch_size, 3, image_size, image_size)
+    input_names = ["image"]
+    inputs = (image,)
+
+    if stage.qformer_text_input:
+        tokenizer = Blip2Base.init_tokenizer(truncation_side="left")
+        text = tokenizer(
+            ["a question"] * batch_size,
+            padding="max_length",
+            truncation=True,
+            max_length=model.max_txt_len,
+            return_tensors="pt",
+        )
+        input_names += ["qformer_input_ids", "qformer_attention_mask"]
+        inputs += (text.input_ids, text.attention_mask)
+
+    output_names = ["inputs_llm", "add_feature_llm"]
+
+    with torch.no_grad():
+        if export_format == "torchscript":
+            traced = torch.jit.trace(stage, inputs, check_trace=False)
+            traced.save(filename)
+        else:
+            dynamic_axes = None
+            if dynamic_batch:
+                dynamic_axes = {name: {0: "batch_size"} for name in input_names + output_names}
+            torch.onnx.export(
+                stage,
+                inputs,
+                filename,
+                input_names=input_names,
+                output_names=output_names,
+                dynamic_axes=dynamic_axes,
+                opset_version=opset_version,
+            )
+
+    metadata = {
+        "format": export_format,
+        "batch_size": batch_size,
+        "dynamic_batch": dynamic_batch,
+        "image_size": image_size,
+        "qformer_text_input": stage.qformer_text_input,
+        "max_txt_len": model.max_txt_len,
+    }
+    with open(_metadata_file(filename), "w") as f:
+        json.dump(metadata, f)
+
+    logging.info("Exported image encoder to {} ({})".format(filename, export_format))
+
+    return stage, inputs
+
+
+class ImageEncoderRuntime:
+    """
+    Run an exported image-encoding stage and hand its outputs to generate().
+
+    Calling the runtime on a batch of samples adds the "inputs_llm" and
+    "add_feature_llm" entries, which BLIVA generate() uses instead of running the
+    vision modules. The Q-Former prompt is samples["prompt"] (or "text_input") as
+    given; ONNX models run with onnxruntime, which is only needed for that format.
+    """
+
+    def __init__(self, filename, num_threads=None):
+        with open(_metadata_file(filename)) as f:
+            self.metadata = json.load(f)
+
+        self.format = self.metadata["format"]
+        self.tokenizer = None
+        if self.metadata["qformer_text_input"]:
+            self.tokenizer = Blip2Base.init_tokenizer(truncation_side="left")
+
+        if self.format == "torchscript":
+            if num_threads is not None:
+                torch.set_num_threads(num_threads)
+            self.module = torch.jit.load(filename, map_location="cpu").eval()
+        else:
+            try:
+                import onnxruntime
+            except ImportError:
+                raise ImportError("onnxruntime is required to run ONNX image encoders.")
+
+            options = onnxruntime.SessionOptions()
+            if num_threads is not None:
+                options.intra_op_num_threads = num_threads
+            self.session = onnxruntime.InferenceSession(
+                filename, options, providers=["CPUExecutionProvider"]
+            )
+
+    def _run(self, inputs):
+        if self.format == "torchscript":
+            with torch.no_grad():
+                return self.module(*inputs)
+
+        names = [i.name for i in self.session.get_inputs()]
+        feeds = {name: x.cpu().numpy() for name, x in zip(names, inputs)}
+        outputs = self.session.run(None, feeds)
+        return tuple(torch.from_numpy(np.asarray(o)) for o in outputs)
+
+    @torch.no_grad()
+    def encode(self, image, prompt=None):
+        """
+        Returns:
+            inputs_llm (torch.Tensor): [bs, num_query_token, llm_hidden]
+            add_feature_llm (torch.Tensor): [bs, num_patches, llm_hidden]
+        """
+        image = image.float().cpu()
+        bs = image.size(0)
+        inputs = [image]
+
+        if self.tokenizer is not None:
+            if isinstance(prompt, str):
+                prompt = [prompt] * bs
+            text = self.tokenizer(
+                prompt,
+                padding="max_length",
+                truncation=True,
+                max_length=self.metadata["max_txt_len"],
+                return_tensors="pt",
+            )
+            inputs += [text.input_ids, text.attention_mask]
+
+        if self.metadata["dynamic_batch"]:
+            return self._run(inputs)
+
+        # fixed-shape graph: run in chunks and pad the last one
+        chunk_size = self.metadata["batch_size"]
+        inputs_llm, add_feature_llm = [], []
+        for start in range(0, bs, chunk_size):
+            chunk = [x[start : start + chunk_size] for x in inputs]
+            num_pad = chunk_size - chunk[0].size(0)
+            if num_pad > 0:
+                chunk = [torch.cat([x, x[-1:].expand(num_pad, *x.shape[1:])]) for x in chunk]
+
+            outputs = self._run(chunk)
+            inputs_llm.append(outputs[0][: chunk_size - num_pad])
+            add_feature_llm.append(outputs[1][: chunk_size - num_pad])
+
+        return torch.cat(inputs_llm), torch.cat(add_feature_llm)
+
+    def __call__(self, samples):
+        prompt = samples["prompt"] if "prompt" in samples.keys() else samples.get("text_input")
+        samples["inputs_llm"], samples["add_feature_llm"] = self.encode(samples["image"], prompt)
+        return samples
+
+
+def check_exported_image_encoder(stage, inputs, filename):
+    """
+    Maximum absolute difference between the eager stage and the exported artifact.
+    """
+    runtime = ImageEncoderRuntime(filename)
+    with torch.no_grad():
+        expected = stage(*inputs)
+    outputs = runtime._run(list(inputs))
+
+    return max(
+        (e.float() - o.float()).abs().max().item() for e, o in zip(expected, outputs)
+    )
@@ -0,0 +1,121 @@
+"""
+ Copyright (c) 2023, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+"""
+
+import torch
+
+
+class ImageSession:
+    """
+    Ask many questions about one image.
+
+    The image is encoded once when the session is created: the ViT runs once,
+    the patch embeddings of the LLM prefix are projected once and the keys and
+    values of every Q-Former cross-attention layer are computed once from the
+    image embeddings. Each batch of prompts then only runs the Q-Former
+    self-attention and feed-forward layers, the query projection and the LLM.
+
+        session = ImageSession(model, image)
+        answers = session.generate(questions, batch_size=16, max_length=30)
+
+    Works with the BLIVA Vicuna and FlanT5 models, which accept precomputed
+    "inputs_llm" and "add_feature_llm" in generate().
+    """
+
+    def __init__(self, model, image):
+        self.model = model
+
+        if image.dim() == 3:
+            image = image.unsqueeze(0)
+        assert image.size(0) == 1, "A session holds a single image, got a batch of {}.".format(
+            image.size(0)
+        )
+        image = image.to(model.device)
+
+        with torch.no_grad():
+            with model.maybe_autocast():
+                features = model.visual_encoder.get_intermediate_layers(image)
+                # same as ln_vision(visual_encoder(image)), without a second ViT pass
+                image_embeds = model.ln_vision(features[-1])
+
+            self.add_feature_llm = model.project_patch_features(features[-2])
+            self.image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long, device=image.device)
+            self.cross_attention_key_values = model.Qformer.bert.project_cross_attention(image_embeds)
+
+        self.image_embeds = image_embeds
+        self.llm_proj = model.llm_proj if hasattr(model, "llm_proj") else model.t5_proj
+        self._inputs_llm = None
+
+    @property
+    def device(self):
+        return self.image_embeds.device
+
+    @torch.no_grad()
+    def encode_prompts(self, prompts):
+        """
+        Query embeddings of the LLM prefix for each prompt, [len(prompts), num_query_token, llm_hidden].
+        Without Q-Former text input they do not depend on the prompt and are computed once.
+        """
+        model = self.model
+        bs = len(prompts)
+
+        if not model.qformer_text_input:
+            if self._inputs_llm is None:
+                self._inputs_llm = self._encode(query_tokens=model.query_tokens)
+            return self._inputs_llm.expand(bs, -1, -1)
+
+        text_Qformer = model.tokenizer(
+            prompts,
+            padding="longest",
+            truncation=True,
+            max_length=model.max_txt_len,
+            return_tensors="pt",
+        ).to(self.device)
+        return self._encode(
+            query_tokens=model.query_tokens.expand(bs, -1, -1),
+            input_ids=text_Qformer.input_ids,
+            text_atts=text_Qformer.attention_mask,
+        )
+
+    def _encode(self, query_tokens, input_ids=None, text_atts=None):
+        attention_mask = None
+        if input_ids is not None:
+            query_atts = torch.ones(query_tokens.size()[:-1], dtype=torch.long, device=self.device)
+            attention_mask = torch.cat([query_atts, text_atts], dim=1)
+
+        # image_embeds and image_atts keep their batch of 1, the cached keys and
+        # values are broadcast over the prompts in the cross-attention
+        query_output = self.model.Qformer.bert(
+            input_ids,
+            attention_mask=attention_mask,
+            query_embeds=query_tokens,
+            encoder_hidden_states=self.image_embeds,
+            encoder_attention_mask=self.image_atts,
+            cross_attention_key_values=self.cross_attention_key_values,
+            return_dict=True,
+        )
+        return self.llm_proj(query_output.last_hidden_state[:, : query_tokens.size(1), :])
+
+    @torch.no_grad()
+    def generate(self, prompts, batch_size=16, **kwargs):
+        """
+        Answer ``prompts`` about the session image, ``batch_size`` prompts per
+        generate() call. Keyword arguments are passed to model.generate().
+        """
+        if isinstance(prompts, str):
+            prompts = [prompts]
+
+        outputs = []
+        for start in range(0, len(prompts), batch_size):
+            chunk = list(prompts[start : start + batch_size])
+            samples = {
+                "prompt": chunk,
+                "inputs_llm": self.encode_prompts(chunk),
+                "add_feature_llm": self.add_feature_llm.expand(len(chunk), -1, -1),
+            }
+            outputs += self.model.generate(samples, **kwargs)
+
+        return outputs
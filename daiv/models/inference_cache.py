@@ -0,0 +1,329 @@
+"""
+ Copyright (c) 2023, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+ Caches for repeated (image, prompt) requests: projected visual embeddings
+ per image and decoded answers per request.
+"""
+
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+
+import torch
+import torch.nn.functional as F
+
+# sample entries that change the prompt in generate()
+_PROMPT_KEYS = ("ocr_tokens", "context")
+
+
+def hash_image(image, method="bytes"):
+    """
+    Hash of a preprocessed image tensor [3, H, W]. "bytes" hashes the pixel
+    values, "perceptual" a 64-bit difference hash of the 9x8 grayscale
+    thumbnail, which also matches re-encoded or slightly resized copies.
+    """
+    if method == "perceptual":
+        gray = image.float().mean(dim=0, keepdim=True)
+        thumb = F.adaptive_avg_pool2d(gray.unsqueeze(0), (8, 9))[0, 0]
+        bits = (thumb[:, 1:] > thumb[:, :-1]).flatten().tolist()
+        return "p{:016x}".format(sum(1 << i for i, bit in enumerate(bits) if bit))
+
+    data = image.detach().cpu().contiguous()
+    digest = hashlib.sha1(data.numpy().tobytes())
+    digest.update(str((tuple(data.shape), str(data.dtype))).encode())
+    return digest.hexdigest()
+
+
+class BoundedCache:
+    """
+    LRU cache holding at most ``max_size``, measured by ``sizeof`` (1 per
+    entry by default), with an optional on-disk tier of ``disk_max_mb`` in
+    ``disk_dir``. Entries evicted from memory stay on disk; the oldest files
+    are removed when the disk tier is full.
+    """
+
+    def __init__(self, max_size, sizeof=None, disk_dir=None, disk_max_mb=1024):
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self.entries = OrderedDict()
+
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_mb * 2 ** 20
+        self.disk_files = OrderedDict()  # path -> bytes, oldest first
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+            paths = [os.path.join(disk_dir, f) for f in os.listdir(disk_dir) if f.endswith(".pt")]
+            for path in sorted(paths, key=os.path.getmtime):
+                self.disk_files[path] = os.path.getsize(path)
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, hashlib.sha1(repr(key).encode()).hexdigest() + ".pt")
+
+    def get(self, key, map_location=None):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+        if self.disk_dir is not None:
+            path = self._path(key)
+            if path in self.disk_files:
+                value = torch.load(path, map_location=map_location)
+                self.disk_files.move_to_end(path)
+                os.utime(path)
+                self.disk_hits += 1
+                self._put(key, value)
+                return value
+
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self._put(key, value)
+        if self.disk_dir is not None:
+            self._write(key, value)
+
+    def _put(self, key, value):
+        if key in self.entries:
+            self.size -= self.sizeof(self.entries.pop(key))
+        self.entries[key] = value
+        self.size += self.sizeof(value)
+
+        while self.size > self.max_size and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= self.sizeof(evicted)
+
+    def _write(self, key, value):
+        path = self._path(key)
+        if isinstance(value, torch.Tensor):
+            value = value.cpu()
+        elif isinstance(value, (tuple, list)):
+            value = type(value)(v.cpu() if isinstance(v, torch.Tensor) else v for v in value)
+        torch.save(value, path)
+
+        self.disk_files.pop(path, None)
+        self.disk_files[path] = os.path.getsize(path)
+        while sum(self.disk_files.values()) > self.disk_max_bytes and len(self.disk_files) > 1:
+            old, _ = self.disk_files.popitem(last=False)
+            if os.path.exists(old):
+                os.remove(old)
+
+    def stats(self):
+        requests = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "size": self.size,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / requests if requests else 0.0,
+        }
+
+
+def _nbytes(value):
+    return sum(t.numel() * t.element_size() for t in value)
+
+
+class InferenceCache:
+    """
+    Two-level cache in front of model.generate(), which predict_answers() and
+    Chat.answer() go through once the cache is attached:
+
+        cache = InferenceCache(model, model_version="bliva_vicuna@2023-09-01")
+        cache.attach()
+
+    Level one maps an image hash to its ln_vision image embeddings and its
+    projected patch embeddings, so a known image skips the ViT (BLIVA models,
+    whose generate() accepts precomputed embeddings). Level two maps (image
+    hash, normalized prompt, generation parameters, model version) to the
+    decoded answers and is only used for deterministic decoding (no nucleus
+    sampling). Set ``model_version`` to something that changes with the
+    weights, e.g. the finetuned checkpoint.
+    """
+
+    def __init__(
+        self,
+        model,
+        model_version=None,
+        embedding_cache_mb=1024,
+        answer_cache_size=100000,
+        disk_dir=None,
+        disk_max_mb=10240,
+        image_hash="bytes",
+    ):
+        self.model = model
+        self.model_version = model_version or type(model).__name__
+        self.image_hash = image_hash
+
+        self.embeddings = BoundedCache(
+            embedding_cache_mb * 2 ** 20,
+            sizeof=_nbytes,
+            disk_dir=os.path.join(disk_dir, "embeddings") if disk_dir else None,
+            disk_max_mb=disk_max_mb,
+        )
+        self.answers = BoundedCache(
+            answer_cache_size,
+            disk_dir=os.path.join(disk_dir, "answers") if disk_dir else None,
+            disk_max_mb=disk_max_mb,
+        )
+
+        self._generate = model.generate
+        self.accepts_embeddings = getattr(model, "accepts_image_embeddings", False)
+
+    def attach(self):
+        """
+        Route model.generate() through the cache.
+        """
+        self.model.generate = self.generate
+        return self.model
+
+    @staticmethod
+    def normalize_prompt(prompt):
+        return " ".join(prompt.split())
+
+    def _answer_key(self, image_hash, prompt, samples, i, params):
+        extras = tuple(repr(samples[k][i]) for k in self._per_sample_keys(samples))
+        return (image_hash, self.normalize_prompt(prompt), extras, params, self.model_version)
+
+    @staticmethod
+    def _per_sample_keys(samples):
+        # a context of "" means no context
+        return [k for k in _PROMPT_KEYS if k in samples.keys() and not isinstance(samples[k], str)]
+
+    @torch.no_grad()
+    def _embed(self, images, hashes):
+        """
+        ln_vision image embeddings and projected patch embeddings of each image,
+        computing the missing ones in one batch.
+        """
+        device = self.model.device
+        keys = [(h, self.model_version) for h in hashes]
+        embeddings = [self.embeddings.get(key, map_location=device) for key in keys]
+        todo = [i for i, e in enumerate(embeddings) if e is None]
+
+        if todo:
+            model = self.model
+            with model.maybe_autocast():
+                image_embeds, image_features = model.vision_features(images[todo].to(device))
+                image_embeds = model.ln_vision(image_embeds)
+            add_feature_llm = model.project_patch_features(image_features)
+
+            for j, i in enumerate(todo):
+                embeddings[i] = (image_embeds[j : j + 1], add_feature_llm[j : j + 1])
+                self.embeddings.put(keys[i], embeddings[i])
+
+        return embeddings
+
+    @torch.no_grad()
+    def _encode_queries(self, image_embeds, prompts):
+        model = self.model
+        device = image_embeds.device
+        image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long, device=device)
+        query_tokens = model.query_tokens.expand(image_embeds.size(0), -1, -1)
+
+        if model.qformer_text_input:
+            text_Qformer = model.tokenizer(
+                prompts,
+                padding="longest",
+                truncation=True,
+                max_length=model.max_txt_len,
+                return_tensors="pt",
+            ).to(device)
+            query_atts = torch.ones(query_tokens.size()[:-1], dtype=torch.long, device=device)
+            query_output = model.Qformer.bert(
+                text_Qformer.input_ids,
+                attention_mask=torch.cat([query_atts, text_Qformer.attention_mask], dim=1),
+                query_embeds=query_tokens,
+                encoder_hidden_states=image_embeds,
+                encoder_attention_mask=image_atts,
+                return_dict=True,
+            )
+        else:
+            query_output = model.Qformer.bert(
+                query_embeds=query_tokens,
+                encoder_hidden_states=image_embeds,
+                encoder_attention_mask=image_atts,
+                return_dict=True,
+            )
+
+        llm_proj = model.llm_proj if hasattr(model, "llm_proj") else model.t5_proj
+        return llm_proj(query_output.last_hidden_state[:, : query_tokens.size(1), :])
+
+    def _run(self, samples, rows, hashes, prompts, kwargs):
+        sub = {k: [samples[k][i] for i in rows] for k in self._per_sample_keys(samples)}
+        sub["prompt"] = [prompts[i] for i in rows]
+
+        if self.accepts_embeddings:
+            embeddings = self._embed(samples["image"][rows], [hashes[i] for i in rows])
+            image_embeds = torch.cat([e[0] for e in embeddings])
+            sub["inputs_llm"] = self._encode_queries(image_embeds, self.preprocess_prompts(sub))
+            sub["add_feature_llm"] = torch.cat([e[1] for e in embeddings])
+        else:
+            sub["image"] = samples["image"][rows]
+
+        return self._generate(sub, **kwargs)
+
+    def preprocess_prompts(self, samples):
+        """
+        The Q-Former prompts generate() would build from samples.
+        """
+        prompts = samples["prompt"]
+        if "ocr_tokens" in samples.keys() and "{}" in prompts[0]:
+            prompts = [p.format(", ".join(samples["ocr_tokens"][i][:30])) for i, p in enumerate(prompts)]
+        if "context" in samples.keys() and samples["context"] != "":
+            prompts = [f'context: {samples["context"][i]}. {prompts[i]}' for i in range(len(prompts))]
+        return prompts
+
+    def generate(self, samples, use_nucleus_sampling=False, num_captions=1, **kwargs):
+        image = samples.get("image")
+        prompts = samples["prompt"] if "prompt" in samples.keys() else samples.get("text_input")
+
+        # video, or requests the cache cannot key
+        if image is None or image.dim() != 4 or prompts is None:
+            return self._generate(
+                samples, use_nucleus_sampling=use_nucleus_sampling, num_captions=num_captions, **kwargs
+            )
+
+        if isinstance(prompts, str):
+            prompts = [prompts] * image.size(0)
+        kwargs = dict(kwargs, use_nucleus_sampling=use_nucleus_sampling, num_captions=num_captions)
+
+        hashes = [hash_image(image[i], self.image_hash) for i in range(image.size(0))]
+
+        deterministic = not use_nucleus_sampling and kwargs.get("logits_processor") is None
+        params = tuple(sorted((k, repr(v)) for k, v in kwargs.items()))
+
+        outputs = [None] * len(prompts)
+        if deterministic:
+            keys = [self._answer_key(hashes[i], prompts[i], samples, i, params) for i in range(len(prompts))]
+            outputs = [self.answers.get(key) for key in keys]
+
+        rows = [i for i, output in enumerate(outputs) if output is None]
+        if rows:
+            generated = self._run(samples, rows, hashes, prompts, kwargs)
+            for j, i in enumerate(rows):
+                outputs[i] = generated[j * num_captions : (j + 1) * num_captions]
+                if deterministic:
+                    self.answers.put(keys[i], outputs[i])
+
+        return [text for output in outputs for text in output]
+
+    def stats(self):
+        return {"embeddings": self.embeddings.stats(), "answers": self.answers.stats()}
+
+    def log_stats(self):
+        for level, stats in self.stats().items():
+            logging.info(
+                "{} cache: {:.1%} hit rate ({} hits, {} disk hits, {} misses, {} entries)".format(
+                    level, stats["hit_rate"], stats["hits"], stats["disk_hits"], stats["misses"], stats["entries"]
+                )
+            )
@@ -0,0 +1,254 @@
+"""
+ Copyright (c) 2023, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+"""
+
+import contextlib
+import json
+import logging
+import os
+
+import torch
+import torch.nn as nn
+from packaging import version
+
+from daiv.common.dist_utils import download_cached_file
+from daiv.common.utils import is_url
+
+
+@contextlib.contextmanager
+def init_empty_weights(enabled=True):
+    """
+    Context manager under which every parameter is created on the meta device.
+
+    Buffers are still allocated normally, since they are usually small and
+    computed at construction time (e.g. rotary frequencies) rather than loaded.
+    """
+    if not enabled:
+        yield
+        return
+
+    old_register_parameter = nn.Module.register_parameter
+
+    def register_empty_parameter(module, name, param):
+        old_register_parameter(module, name, param)
+        if param is not None:
+            param = module._parameters[name]
+            module._parameters[name] = nn.Parameter(
+                param.to(torch.device("meta")), requires_grad=param.requires_grad
+            )
+
+    try:
+        nn.Module.register_parameter = register_empty_parameter
+        yield
+    finally:
+        nn.Module.register_parameter = old_register_parameter
+
+
+def resolve_checkpoint_file(url_or_filename):
+    if is_url(url_or_filename):
+        return download_cached_file(url_or_filename, check_hash=False, progress=True)
+    elif os.path.isfile(url_or_filename):
+        return url_or_filename
+    else:
+        raise RuntimeError("checkpoint url or path is invalid")
+
+
+def load_state_dict_file(filename):
+    """
+    Load a state dict from disk without copying it into anonymous memory when possible.
+
+    safetensors files are opened lazily; torch pickles are memory-mapped on torch>=2.1
+    and fall back to a regular load otherwise.
+    """
+    if filename.endswith(".safetensors"):
+        from safetensors import safe_open
+
+        return _SafetensorsStateDict(safe_open(filename, framework="pt", device="cpu"))
+
+    if version.parse(torch.__version__) >= version.parse("2.1"):
+        try:
+            checkpoint = torch.load(filename, map_location="cpu", mmap=True)
+        except RuntimeError:
+            # legacy (non-zipfile) checkpoints can not be memory-mapped
+            checkpoint = torch.load(filename, map_location="cpu")
+    else:
+        checkpoint = torch.load(filename, map_location="cpu")
+
+    if "model" in checkpoint.keys():
+        checkpoint = checkpoint["model"]
+    return checkpoint
+
+
+class _SafetensorsStateDict:
+    def __init__(self, handle):
+        self.handle = handle
+
+    def keys(self):
+        return self.handle.keys()
+
+    def __getitem__(self, key):
+        return self.handle.get_tensor(key)
+
+
+def hf_checkpoint_files(model_dir):
+    """
+    List the weight files of a local huggingface checkpoint directory, including shards.
+    """
+    if not os.path.isdir(model_dir):
+        raise RuntimeError(
+            "lazy_init requires a local checkpoint directory, got {}".format(model_dir)
+        )
+
+    for index_name in ["model.safetensors.index.json", "pytorch_model.bin.index.json"]:
+        index_file = os.path.join(model_dir, index_name)
+        if os.path.isfile(index_file):
+            with open(index_file, "r") as f:
+                weight_map = json.load(f)["weight_map"]
+            return [os.path.join(model_dir, f) for f in sorted(set(weight_map.values()))]
+
+    for weight_name in ["model.safetensors", "pytorch_model.bin"]:
+        weight_file = os.path.join(model_dir, weight_name)
+        if os.path.isfile(weight_file):
+            return [weight_file]
+
+    raise RuntimeError("No model weights found in {}".format(model_dir))
+
+
+class WeightSource:
+    """
+    One checkpoint (possibly sharded) that provides weights for part of a model.
+
+    Args:
+        files (list or callable): checkpoint files, or a callable returning them. A callable
+            is only resolved when the source is actually needed, so sources that are fully
+            shadowed by later ones are never downloaded or opened.
+        prefix (str): prefix prepended to every checkpoint key to get the model parameter name.
+        transform (callable): optional fn(state_dict) -> state_dict applied after loading a file.
+        name (str): name used for logging.
+    """
+
+    def __init__(self, files, prefix="", transform=None, name=None):
+        self.files = files
+        self.prefix = prefix
+        self.transform = transform
+        self.name = name
+
+    def state_dicts(self):
+        files = self.files() if callable(self.files) else self.files
+        for filename in files:
+            state_dict = load_state_dict_file(filename)
+            if self.transform is not None:
+                state_dict = self.transform(dict(state_dict))
+            yield state_dict
+
+
+def load_weights_into_empty_model(model, sources):
+    """
+    Materialize the meta parameters of ``model`` from a list of weight sources.
+
+    Sources are given in the same order as they would be loaded eagerly, i.e. later
+    sources override earlier ones. They are visited in reverse so that every parameter
+    is read exactly once, from the last source that defines it, and sources with
+    nothing left to provide are skipped. Tensors are cast to the dtype the parameter
+    was declared with, which keeps memory-mapped storage when the dtypes already match.
+
+    Returns:
+        list: names of parameters not found in any source; these are initialized
+            as in the constructor, see _init_missing_parameters().
+    """
+    pending = {name for name, param in model.named_parameters() if param.is_meta}
+
+    for source in reversed(sources):
+        if len(pending) == 0:
+            break
+
+        num_loaded = 0
+        for state_dict in source.state_dicts():
+            for key in list(state_dict.keys()):
+                name = source.prefix + key
+                if name not in pending:
+                    continue
+                _set_parameter(model, name, state_dict[key])
+                pending.discard(name)
+                num_loaded += 1
+            del state_dict
+
+        logging.info(
+            "Loaded {} parameters from {}".format(num_loaded, source.name or source.prefix)
+        )
+
+    missing = sorted(pending)
+    _init_missing_parameters(model, missing)
+    if len(missing) > 0:
+        logging.info("Parameters initialized from scratch {}".format(missing))
+
+    return missing
+
+
+def _set_parameter(model, name, tensor):
+    module_name, _, attr = name.rpartition(".")
+    module = model.get_submodule(module_name)
+    param = module._parameters[attr]
+
+    tensor = _fit_to_shape(tensor, param.shape, name).to(dtype=param.dtype)
+    module._parameters[attr] = nn.Parameter(tensor, requires_grad=param.requires_grad)
+
+
+def _fit_to_shape(tensor, shape, name):
+    if tensor.shape == shape:
+        return tensor
+
+    # rows added by resize_token_embeddings() are not in the original checkpoint
+    if tensor.dim() == len(shape) and tensor.shape[1:] == shape[1:]:
+        logging.info(
+            "Resizing {} from {} to {}".format(name, tuple(tensor.shape), tuple(shape))
+        )
+        resized = torch.empty(shape).normal_(mean=0.0, std=0.02)
+        num_rows = min(shape[0], tensor.shape[0])
+        resized[:num_rows] = tensor[:num_rows]
+        return resized.to(tensor.dtype)
+
+    raise RuntimeError(
+        "size mismatch for {}: checkpoint shape {}, model shape {}".format(
+            name, tuple(tensor.shape), tuple(shape)
+        )
+    )
+
+
+def _init_missing_parameters(model, names):
+    """
+    Materialize the parameters ``names`` and re-run the initializers that can
+    not clobber loaded weights: reset_parameters() of every module whose
+    parameters (submodules included) are all missing, submodules first, then
+    model.init_missing_parameter(name, param) for the other missing parameters
+    (e.g. query_tokens). Raises for a parameter left without an initializer.
+    """
+    for name in names:
+        module_name, _, attr = name.rpartition(".")
+        module = model.get_submodule(module_name)
+        param = module._parameters[attr]
+        module._parameters[attr] = nn.Parameter(
+            torch.zeros(param.shape, dtype=param.dtype),
+            requires_grad=param.requires_grad,
+        )
+
+    missing = set(names)
+    uncovered = set(names)
+    for module_name, module in reversed(list(model.named_modules())):
+        if not hasattr(module, "reset_parameters"):
+            continue
+        prefix = module_name + "." if module_name else ""
+        params = [prefix + name for name, _ in module.named_parameters()]
+        if len(params) > 0 and missing.issuperset(params):
+            module.reset_parameters()
+            uncovered.difference_update(params)
+
+    init_missing_parameter = getattr(model, "init_missing_parameter", None)
+    for name in sorted(uncovered):
+        if init_missing_parameter is None or not init_missing_parameter(name, model.get_parameter(name)):
+            raise RuntimeError(
+                "Missing parameter {} has no initializer, add it to a weight source".format(name)
+            )
@@ -569,10 +569,23 @@ class T5Attention(nn.Module):
             past_key_value[1] if past_key_value is not None else None,
         )
 
+        # cross-attention keys and values may be shared by groups of consecutive rows,
+        # see T5ForConditionalGeneration.shared_cross_attention_past
+        num_groups = key_states.size(0)
+
         # compute scores
-        scores = torch.matmul(
-            query_states, key_states.transpose(3, 2)
-        )  # equivalent of torch.einsum("bnqd,bnkd->bnqk", query_states, key_states), compatible with onnx op>9
+        if num_groups != batch_size:
+            scores = self._ungroup_rows(
+                torch.matmul(
+                    self._group_rows(query_states, num_groups), key_states.transpose(3, 2)
+                ),
+                batch_size,
+                seq_length,
+            )
+        else:
+            scores = torch.matmul(
+                query_states, key_states.transpose(3, 2)
+            )  # equivalent of torch.einsum("bnqd,bnkd->bnqk", query_states, key_states), compatible with onnx op>9
 
         if position_bias is None:
             if not self.has_relative_attention_bias:
@@ -617,9 +630,15 @@ class T5Attention(nn.Module):
         if layer_head_mask is not None:
             attn_weights = attn_weights * layer_head_mask
 
-        attn_output = unshape(
-            torch.matmul(attn_weights, value_states)
-        )  # (batch_size, seq_length, dim)
+        if num_groups != batch_size:
+            attn_output = self._ungroup_rows(
+                torch.matmul(self._group_rows(attn_weights, num_groups), value_states),
+                batch_size,
+                seq_length,
+            )
+        else:
+            attn_output = torch.matmul(attn_weights, value_states)
+        attn_output = unshape(attn_output)  # (batch_size, seq_length, dim)
         attn_output = self.o(attn_output)
 
         present_key_value_state = (
@@ -631,6 +650,26 @@ class T5Attention(nn.Module):
             outputs = outputs + (attn_weights,)
         return outputs
 
+    @staticmethod
+    def _group_rows(states, num_groups):
+        """(num_groups * group_size, n_heads, q, d) -> (num_groups, n_heads, group_size * q, d)"""
+        _, n_heads, q, d = states.shape
+        return (
+            states.view(num_groups, -1, n_heads, q, d)
+            .transpose(1, 2)
+            .reshape(num_groups, n_heads, -1, d)
+        )
+
+    @staticmethod
+    def _ungroup_rows(states, batch_size, seq_length):
+        """(num_groups, n_heads, group_size * q, d) -> (num_groups * group_size, n_heads, q, d)"""
+        num_groups, n_heads, _, d = states.shape
+        return (
+            states.view(num_groups, n_heads, -1, seq_length, d)
+            .transpose(1, 2)
+            .reshape(batch_size, n_heads, seq_length, d)
+        )
+
 class T5LayerSelfAttention(nn.Module):
     def __init__(self, config, has_relative_attention_bias=False):
         super().__init__()
@@ -1921,6 +1960,52 @@ class T5ForConditionalGeneration(T5PreTrainedModel):
             encoder_attentions=encoder_outputs.attentions,
         )
 
+    def project_cross_attention(self, encoder_hidden_states):
+        """
+        Cross-attention keys and values of every decoder layer, projected once
+        per row of ``encoder_hidden_states``. See shared_cross_attention_past().
+        """
+        num_rows = encoder_hidden_states.size(0)
+
+        cross_attention = []
+        for block in self.decoder.block:
+            attention = block.layer[1].EncDecAttention
+
+            def shape(states):
+                return states.view(
+                    num_rows, -1, attention.n_heads, attention.key_value_proj_dim
+                ).transpose(1, 2)
+
+            cross_attention.append(
+                (
+                    shape(attention.k(encoder_hidden_states)),
+                    shape(attention.v(encoder_hidden_states)),
+                )
+            )
+
+        return tuple(cross_attention)
+
+    @staticmethod
+    def shared_cross_attention_past(cross_attention, batch_size):
+        """
+        Decoder past_key_values for decoding ``batch_size`` sequences with the
+        keys and values of project_cross_attention(), each encoder row being
+        shared by ``batch_size // num_rows`` consecutive sequences.
+
+        The keys and values are not expanded, T5Attention folds the rows sharing
+        them into its query length. Self-attention states are empty, so the
+        decoder inputs are decoded from the first position.
+        """
+        num_rows = cross_attention[0][0].size(0)
+        assert batch_size % num_rows == 0, "batch_size must be a multiple of the encoder batch size."
+
+        past_key_values = []
+        for key_states, value_states in cross_attention:
+            empty = key_states.new_zeros(batch_size, key_states.size(1), 0, key_states.size(3))
+            past_key_values.append((empty, empty, key_states, value_states))
+
+        return tuple(past_key_values)
+
     def prepare_inputs_for_generation(
         self,
         input_ids,
@@ -0,0 +1,303 @@
+"""
+ Copyright (c) 2023, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+ Serving many LoRA adapters on one base LLM: every row of a batch can use a
+ different adapter, applied with gathered low-rank matmuls in the same forward.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import re
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+# base_model.model.<module>.lora_A[.<adapter name>].weight, optionally prefixed by
+# llm_model. in BLIVA checkpoints
+_LORA_KEY = re.compile(r"^(?:llm_model\.)?(?:base_model\.model\.)?(.+)\.lora_([AB])(?:\.[^.]+)?\.weight$")
+
+
+class MultiLoRALinear(nn.Linear):
+    """
+    nn.Linear with a bank of ``num_slots`` LoRA adapters of rank up to
+    ``max_rank``. The adapter of each batch row is given by
+    ``pool.adapter_ids`` (-1 for the base weights only); adapters of a lower
+    rank are zero-padded, which does not change their output.
+
+    The base weight and bias are shared with the wrapped layer, so the state
+    dict keys are those of the plain LLM. The bank is not saved with it.
+    """
+
+    @classmethod
+    def from_linear(cls, linear, pool, num_slots, max_rank):
+        layer = cls.__new__(cls)
+        nn.Module.__init__(layer)
+        layer.in_features = linear.in_features
+        layer.out_features = linear.out_features
+        layer.weight = linear.weight
+        layer.bias = linear.bias
+        layer.pool = pool
+
+        factory = {"dtype": linear.weight.dtype, "device": linear.weight.device}
+        layer.register_buffer(
+            "lora_A", torch.zeros(num_slots, max_rank, linear.in_features, **factory), persistent=False
+        )
+        layer.register_buffer(
+            "lora_B", torch.zeros(num_slots, linear.out_features, max_rank, **factory), persistent=False
+        )
+        layer.register_buffer(
+            "lora_scaling", torch.zeros(num_slots, **factory), persistent=False
+        )
+        return layer
+
+    def forward(self, x):
+        output = F.linear(x, self.weight, self.bias)
+
+        adapter_ids = self.pool.adapter_ids
+        if adapter_ids is None:
+            return output
+
+        adapter_ids = adapter_ids.to(x.device)
+        if adapter_ids.size(0) != x.size(0):
+            # rows expanded by generate(), e.g. beams or num_return_sequences
+            adapter_ids = adapter_ids.repeat_interleave(x.size(0) // adapter_ids.size(0))
+
+        slots = adapter_ids.clamp(min=0)
+        scaling = self.lora_scaling[slots] * (adapter_ids >= 0).to(self.lora_scaling.dtype)
+
+        # [bs, seq, in] x [bs, in, r] x [bs, r, out]
+        hidden = torch.bmm(x.to(self.lora_A.dtype), self.lora_A[slots].transpose(1, 2))
+        delta = torch.bmm(hidden, self.lora_B[slots].transpose(1, 2))
+
+        return output + (delta * scaling[:, None, None]).to(output.dtype)
+
+    def merge(self, slot):
+        """
+        The adapter of ``slot`` added to the base weight, as a plain nn.Linear.
+        """
+        linear = nn.Linear(self.in_features, self.out_features, bias=self.bias is not None, device="meta")
+        delta = self.lora_B[slot].float() @ self.lora_A[slot].float() * self.lora_scaling[slot].float()
+        linear.weight = nn.Parameter(
+            (self.weight.data.float() + delta).to(self.weight.dtype), requires_grad=self.weight.requires_grad
+        )
+        linear.bias = self.bias
+        return linear
+
+    def unload(self):
+        linear = nn.Linear(self.in_features, self.out_features, bias=self.bias is not None, device="meta")
+        linear.weight = self.weight
+        linear.bias = self.bias
+        return linear
+
+
+def read_lora_adapter(path, default_scaling=None):
+    """
+    Read a LoRA adapter saved by peft (a directory with adapter_config.json and
+    adapter_model.bin or .safetensors) or a BLIVA LoRA checkpoint.
+
+    Returns the A and B weights per LLM module name and the LoRA scaling
+    (lora_alpha / r), which BLIVA checkpoints do not record: default_scaling
+    is used for them.
+    """
+    scaling = default_scaling
+    if os.path.isdir(path):
+        with open(os.path.join(path, "adapter_config.json")) as f:
+            config = json.load(f)
+        scaling = config["lora_alpha"] / config["r"]
+
+        weights = os.path.join(path, "adapter_model.safetensors")
+        if os.path.isfile(weights):
+            from safetensors.torch import load_file
+
+            state_dict = load_file(weights)
+        else:
+            state_dict = torch.load(os.path.join(path, "adapter_model.bin"), map_location="cpu")
+    else:
+        state_dict = torch.load(path, map_location="cpu")
+        if "model" in state_dict.keys():
+            state_dict = state_dict["model"]
+
+    assert scaling is not None, "The LoRA scaling of {} is unknown.".format(path)
+
+    weights = {}
+    for key, value in state_dict.items():
+        match = _LORA_KEY.match(key)
+        if match is not None:
+            module, which = match.groups()
+            weights.setdefault(module, {})[which] = value
+
+    assert weights, "No LoRA weights found in {}.".format(path)
+    return weights, scaling
+
+
+class LoRAAdapterPool:
+    """
+    One base LLM, many LoRA adapters.
+
+    The target linear layers of ``llm_model`` are replaced by MultiLoRALinear
+    layers holding ``num_slots`` adapters. Without num_slots, the number of
+    slots is what fits in ``memory_budget_mb``. Adapters are registered by name
+    and path, hot-loaded into a slot when a batch uses them and evicted in LRU
+    order when the slots are full.
+
+        pool = LoRAAdapterPool(llm_model, ["q_proj", "v_proj"], memory_budget_mb=2048,
+                               adapters={"customer_a": "/path/to/adapter"})
+        with pool.select(["customer_a", None, "customer_a"]):
+            outputs = llm_model.generate(...)
+    """
+
+    def __init__(
+        self,
+        llm_model,
+        target_modules,
+        max_rank=64,
+        num_slots=None,
+        memory_budget_mb=1024,
+        default_scaling=None,
+        adapters=None,
+    ):
+        self.llm_model = llm_model
+        self.max_rank = max_rank
+        self.default_scaling = default_scaling
+        self.adapter_paths = dict(adapters or {})
+        self.adapter_ids = None
+
+        targets = [
+            (name, module)
+            for name, module in llm_model.named_modules()
+            if isinstance(module, nn.Linear)
+            and name.split(".")[-1] in target_modules
+            and name.split(".")[-1] != "lm_head"
+        ]
+        assert targets, "None of the modules {} found in the LLM.".format(target_modules)
+
+        if num_slots is None:
+            slot_bytes = sum(
+                max_rank * (m.in_features + m.out_features) * m.weight.element_size() for _, m in targets
+            )
+            num_slots = int(memory_budget_mb * 2 ** 20 // slot_bytes)
+            assert num_slots > 0, "memory_budget_mb={} does not fit one adapter of rank {} ({:.1f} MB).".format(
+                memory_budget_mb, max_rank, slot_bytes / 2 ** 20
+            )
+        self.num_slots = num_slots
+
+        self.layers = OrderedDict()
+        for name, module in targets:
+            layer = MultiLoRALinear.from_linear(module, self, num_slots, max_rank)
+            self._set_module(name, layer)
+            self.layers[name] = layer
+
+        # adapter name -> slot, least recently used first
+        self.slots = OrderedDict()
+
+        logging.info(
+            "LoRA adapter pool: {} slots of rank {} on {} layers".format(num_slots, max_rank, len(self.layers))
+        )
+
+    def _set_module(self, name, module):
+        parent_name, _, attr = name.rpartition(".")
+        parent = self.llm_model.get_submodule(parent_name) if parent_name else self.llm_model
+        setattr(parent, attr, module)
+
+    def register(self, name, path):
+        self.adapter_paths[name] = path
+        if name in self.slots:
+            # reload the new weights on next use
+            self.evict(name)
+
+    def evict(self, name):
+        slot = self.slots.pop(name)
+        for layer in self.layers.values():
+            layer.lora_scaling[slot] = 0
+
+    def load(self, name, keep=()):
+        """
+        The slot of adapter ``name``, loading it if needed. Adapters in
+        ``keep`` are not evicted to make room for it.
+        """
+        if name in self.slots:
+            self.slots.move_to_end(name)
+            return self.slots[name]
+
+        assert name in self.adapter_paths, "Unknown LoRA adapter {}.".format(name)
+
+        used = set(self.slots.values())
+        free = [slot for slot in range(self.num_slots) if slot not in used]
+        if free:
+            slot = free[0]
+        else:
+            victim = next((n for n in self.slots if n not in keep), None)
+            assert victim is not None, "More adapters in one batch than the {} slots.".format(self.num_slots)
+            slot = self.slots[victim]
+            self.evict(victim)
+            logging.info("Evicted LoRA adapter {}".format(victim))
+
+        weights, scaling = read_lora_adapter(self.adapter_paths[name], self.default_scaling)
+
+        unused = set(weights) - set(self.layers)
+        if unused:
+            logging.warning("LoRA adapter {} has weights for {} unknown modules.".format(name, len(unused)))
+
+        with torch.no_grad():
+            for module_name, layer in self.layers.items():
+                layer.lora_A[slot].zero_()
+                layer.lora_B[slot].zero_()
+                layer.lora_scaling[slot] = 0
+                if module_name not in weights:
+                    continue
+
+                A, B = weights[module_name]["A"], weights[module_name]["B"]
+                rank = A.size(0)
+                assert rank <= self.max_rank, "LoRA adapter {} has rank {} > max_rank {}.".format(
+                    name, rank, self.max_rank
+                )
+                layer.lora_A[slot, :rank].copy_(A)
+                layer.lora_B[slot, :, :rank].copy_(B)
+                layer.lora_scaling[slot] = scaling
+
+        self.slots[name] = slot
+        logging.info("Loaded LoRA adapter {} in slot {}".format(name, slot))
+        return slot
+
+    def adapter_ids_for(self, names):
+        """
+        Slot per row for a list of adapter names, -1 for rows without adapter (None).
+        """
+        keep = set(n for n in names if n is not None)
+        return torch.tensor([-1 if n is None else self.load(n, keep=keep) for n in names], dtype=torch.long)
+
+    @contextlib.contextmanager
+    def select(self, names):
+        """
+        Apply the adapters ``names`` (one per batch row, or one name for all
+        rows) to the forward passes within this context.
+        """
+        if names is None or isinstance(names, str):
+            names = [names]
+
+        self.adapter_ids = self.adapter_ids_for(list(names))
+        try:
+            yield self.adapter_ids
+        finally:
+            self.adapter_ids = None
+
+    def merge_and_unload(self, name=None):
+        """
+        Merge adapter ``name`` into the base weights (or just drop the adapter
+        layers without name) and put plain nn.Linear layers back.
+        """
+        slot = self.load(name) if name is not None else None
+        with torch.no_grad():
+            for module_name, layer in self.layers.items():
+                self._set_module(module_name, layer.unload() if slot is None else layer.merge(slot))
+
+        self.layers = OrderedDict()
+        self.slots = OrderedDict()
+        return self.llm_model
@@ -14,6 +14,7 @@ from transformers import T5TokenizerFast
 from daiv.common.registry import registry
 from daiv.models.blip2 import Blip2Base, disabled_train
 from daiv.models.modeling_t5 import T5Config, T5ForConditionalGeneration
+from daiv.models.token_reducer import build_token_reducer
 from transformers.modeling_outputs import BaseModelOutput
 
 
@@ -41,6 +42,7 @@ class PretrainBlivaT5(Blip2Base):
         num_few_shot_examples=0,
         few_shot_prob=0,
         qformer_text_input=True,
+        token_reducer=None,
     ):
         super().__init__()
 
@@ -74,13 +76,13 @@ class PretrainBlivaT5(Blip2Base):
         self.prompt = prompt
 
         self._apply_lemmatizer = apply_lemmatizer
-        self._lemmatizer = None
 
         self.num_few_shot_examples = num_few_shot_examples
         self.few_shot_prob = few_shot_prob
 
         self.qformer_text_input = qformer_text_input
         self.vision_project = nn.Linear(self.visual_encoder.num_features, self.t5_model.config.hidden_size)
+        self.token_reducer = build_token_reducer(token_reducer, self.visual_encoder.num_features)
 
     def forward(self, samples):
         # print('-----------------')
@@ -90,8 +92,7 @@ class PretrainBlivaT5(Blip2Base):
 
         image = samples["image"]
         image_features= self.visual_encoder.get_intermediate_layers(image)[-2] # [batch_size, 257, 1408]
-        image_features = image_features[:, 1:] 
-        add_feature_llm = self.vision_project(image_features) 
+        add_feature_llm = self.project_patch_features(image_features)
         atts_add_feature_llm = torch.ones(add_feature_llm.size()[:-1], dtype=torch.long).to(image.device)
         
         fs_embeds, fs_atts = None, None
@@ -161,6 +162,9 @@ class PretrainBlivaT5(Blip2Base):
 
         qformer_text_input = cfg.get("qformer_text_input", True)
 
+        # shorten the patch-token prefix, see daiv/models/token_reducer.py
+        token_reducer = cfg.get("token_reducer", None)
+
         model = cls(
             vit_model=vit_model,
             img_size=img_size,
@@ -177,6 +181,7 @@ class PretrainBlivaT5(Blip2Base):
             num_few_shot_examples=num_few_shot_examples,
             few_shot_prob=few_shot_prob,
             qformer_text_input=qformer_text_input,
+            token_reducer=token_reducer,
         )
 
         model.load_checkpoint_from_config(cfg)
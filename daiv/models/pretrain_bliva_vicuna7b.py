@@ -13,6 +13,7 @@ import transformers
 
 from daiv.common.registry import registry
 from daiv.models.blip2 import Blip2Base, disabled_train
+from daiv.models.token_reducer import build_token_reducer
 
 
 @registry.register_model("pretrain_bliva_vicuna")
@@ -37,6 +38,7 @@ class PretrainBLIVAVicuna(Blip2Base):
         max_output_txt_len=256,
         apply_lemmatizer=False,
         qformer_text_input=True,
+        token_reducer=None,
     ):
         super().__init__()
         transformers_version = version.parse(transformers.__version__)
@@ -82,11 +84,11 @@ class PretrainBLIVAVicuna(Blip2Base):
         prompt_tokens = self.llm_tokenizer(self.prompt, return_tensors="pt")
         self.prompt_length = prompt_tokens.attention_mask.sum(1)
 
-        self._lemmatizer = None
 
         self.qformer_text_input = qformer_text_input
         
         self.vision_project = nn.Linear(self.visual_encoder.num_features, self.llm_model.config.hidden_size)
+        self.token_reducer = build_token_reducer(token_reducer, self.visual_encoder.num_features)
 
         
     def concat_text_input_output(self, input_ids, input_atts, output_ids, output_atts):
@@ -118,8 +120,7 @@ class PretrainBLIVAVicuna(Blip2Base):
         image = samples["image"]
         
         image_features= self.visual_encoder.get_intermediate_layers(image)[-2] # [batch_size, 257, 1408]
-        image_features = image_features[:, 1:] 
-        add_feature_llm = self.vision_project(image_features) 
+        add_feature_llm = self.project_patch_features(image_features)
         atts_add_feature_llm = torch.ones(add_feature_llm.size()[:-1], dtype=torch.long).to(image.device)
         
         self.llm_tokenizer.padding_side = "right"
@@ -179,43 +180,6 @@ class PretrainBLIVAVicuna(Blip2Base):
         return {"loss": loss}
 
 
-    def _lemmatize(self, answers):
-        def apply(answer):
-            doc = self.lemmatizer(answer)
-
-            words = []
-            for token in doc:
-                if token.pos_ in ["NOUN", "VERB"]:
-                    words.append(token.lemma_)
-                else:
-                    words.append(token.text)
-            answer = " ".join(words)
-
-            return answer
-
-        return [apply(answer) for answer in answers]
-
-    @property
-    def lemmatizer(self):
-        if self._lemmatizer is None:
-            try:
-                import spacy
-
-                self._lemmatizer = spacy.load("en_core_web_sm")
-            except ImportError:
-                logging.error(
-                    """
-                    Please install spacy and en_core_web_sm model to apply lemmatization.
-                    python -m spacy download en_core_web_sm
-                    OR
-                    import spacy.cli
-                    spacy.cli.download("en_core_web_sm")
-                    """
-                )
-                exit(1)
-
-        return self._lemmatizer
-
     @classmethod
     def from_config(cls, cfg):
         vit_model = cfg.get("vit_model", "eva_clip_g")
@@ -236,6 +200,9 @@ class PretrainBLIVAVicuna(Blip2Base):
 
         qformer_text_input = cfg.get("qformer_text_input", True)
 
+        # shorten the patch-token prefix, see daiv/models/token_reducer.py
+        token_reducer = cfg.get("token_reducer", None)
+
         model = cls(
             vit_model=vit_model,
             img_size=img_size,
@@ -250,6 +217,7 @@ class PretrainBLIVAVicuna(Blip2Base):
             max_output_txt_len=max_output_txt_len,
             apply_lemmatizer=apply_lemmatizer,
             qformer_text_input=qformer_text_input,
+            token_reducer=token_reducer,
         )
 
         model.load_checkpoint_from_config(cfg)
@@ -0,0 +1,303 @@
+"""
+ Copyright (c) 2023, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+"""
+
+import logging
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def quantize_weight(weight, bits=8, group_size=-1):
+    """
+    Symmetric weight-only quantization.
+
+    Args:
+        weight (torch.Tensor): [out_features, in_features] weight.
+        bits (int): 8 or 4. int4 values are packed two per byte.
+        group_size (int): number of input channels sharing one scale.
+            -1 uses one scale per output channel.
+
+    Returns:
+        qweight (torch.Tensor): int8 [out, in] or uint8 [out, in // 2] for int4.
+        scales (torch.Tensor): fp16 [out, in // group_size].
+    """
+    assert bits in [4, 8], "Only int8 and int4 weight quantization are supported."
+    out_features, in_features = weight.shape
+    group_size = in_features if group_size <= 0 else group_size
+    assert (
+        in_features % group_size == 0
+    ), "in_features {} is not divisible by group_size {}".format(in_features, group_size)
+
+    qmax = 2 ** (bits - 1) - 1
+    weight = weight.float().reshape(out_features, in_features // group_size, group_size)
+    scales = weight.abs().amax(dim=-1, keepdim=True).clamp(min=1e-8) / qmax
+    qweight = torch.clamp(torch.round(weight / scales), -qmax - 1, qmax).to(torch.int8)
+    qweight = qweight.reshape(out_features, in_features)
+
+    if bits == 4:
+        qweight = pack_int4(qweight)
+
+    return qweight, scales.squeeze(-1).half()
+
+
+def dequantize_weight(qweight, scales, bits=8):
+    if bits == 4:
+        qweight = unpack_int4(qweight)
+
+    out_features, in_features = qweight.shape
+    num_groups = scales.size(-1)
+    weight = qweight.to(scales.dtype).reshape(out_features, num_groups, -1)
+    weight = weight * scales.unsqueeze(-1)
+    return weight.reshape(out_features, in_features)
+
+
+def pack_int4(qweight):
+    assert qweight.size(-1) % 2 == 0, "int4 packing requires an even number of input channels."
+    qweight = (qweight + 8).to(torch.uint8)
+    return qweight[:, 0::2] | (qweight[:, 1::2] << 4)
+
+
+def unpack_int4(packed):
+    low = (packed & 0x0F).to(torch.int8) - 8
+    high = (packed >> 4).to(torch.int8) - 8
+    return torch.stack([low, high], dim=-1).reshape(packed.size(0), -1)
+
+
+def _int8_cpu_kernel_available():
+    return torch.backends.quantized.engine != "none"
+
+
+class QuantizedLinear(nn.Module):
+    """
+    Drop-in replacement of nn.Linear holding int8/int4 weights.
+
+    On CPU, per-channel int8 layers run the int8 GEMM of torch's dynamic
+    quantized linear (activations are quantized per call) on a weight packed
+    once and cached. Other layers (GPU, int4, grouped scales, or inputs that
+    need gradients) dequantize the weight once per call, directly in the input
+    dtype. Quantized tensors are stored as frozen parameters so that they are
+    saved, cast and moved with the rest of the model (integer tensors are left
+    untouched by model.half()/model.float()).
+    """
+
+    def __init__(self, in_features, out_features, bias=True, bits=8, group_size=-1, device=None):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = in_features if group_size <= 0 else group_size
+
+        packed_features = in_features // 2 if bits == 4 else in_features
+        qdtype = torch.uint8 if bits == 4 else torch.int8
+
+        self.qweight = nn.Parameter(
+            torch.empty(out_features, packed_features, dtype=qdtype, device=device),
+            requires_grad=False,
+        )
+        self.scales = nn.Parameter(
+            torch.empty(out_features, in_features // self.group_size, dtype=torch.float16, device=device),
+            requires_grad=False,
+        )
+        if bias:
+            self.bias = nn.Parameter(torch.empty(out_features, device=device), requires_grad=False)
+        else:
+            self.register_parameter("bias", None)
+
+        # (weight version, packed weight) of the CPU int8 kernel
+        self._packed = None
+
+    @classmethod
+    def from_linear(cls, linear, bits=8, group_size=-1):
+        qlinear = cls(
+            linear.in_features,
+            linear.out_features,
+            bias=linear.bias is not None,
+            bits=bits,
+            group_size=group_size,
+            device=torch.device("meta"),
+        )
+        qweight, scales = quantize_weight(linear.weight.data, bits, qlinear.group_size)
+        qlinear.qweight = nn.Parameter(qweight, requires_grad=False)
+        qlinear.scales = nn.Parameter(scales, requires_grad=False)
+        if linear.bias is not None:
+            qlinear.bias = nn.Parameter(linear.bias.data, requires_grad=False)
+        return qlinear
+
+    @property
+    def weight(self):
+        # some modules (e.g. EVA attention) read the weight of a linear layer directly;
+        # this materializes the full-precision matrix, forward() does not need it
+        return dequantize_weight(self.qweight, self.scales, self.bits)
+
+    def _use_int8_kernel(self, x):
+        return (
+            x.device.type == "cpu"
+            and self.bits == 8
+            and self.scales.size(1) == 1
+            and not (torch.is_grad_enabled() and x.requires_grad)
+            and _int8_cpu_kernel_available()
+        )
+
+    def _packed_weight(self):
+        key = (self.qweight.data_ptr(), self.qweight._version, self.scales._version)
+        if self._packed is None or self._packed[0] != key:
+            scales = self.scales.data.squeeze(1).double()
+            weight = torch._make_per_channel_quantized_tensor(
+                self.qweight.data, scales, torch.zeros(scales.shape, dtype=torch.long), 0
+            )
+            bias = self.bias.data.float() if self.bias is not None else None
+            self._packed = (key, torch.ops.quantized.linear_prepack(weight, bias))
+        return self._packed[1]
+
+    def forward(self, x):
+        if self._use_int8_kernel(x):
+            # fbgemm expects activations in a reduced 7-bit range to avoid overflow
+            reduce_range = torch.backends.quantized.engine == "fbgemm"
+            output = torch.ops.quantized.linear_dynamic(
+                x.float().reshape(-1, self.in_features), self._packed_weight(), reduce_range
+            )
+            return output.reshape(x.shape[:-1] + (self.out_features,)).to(x.dtype)
+
+        weight = dequantize_weight(self.qweight, self.scales.to(x.dtype), self.bits)
+        bias = self.bias.to(x.dtype) if self.bias is not None else None
+        return F.linear(x, weight, bias)
+
+    def extra_repr(self):
+        return "in_features={}, out_features={}, bias={}, bits={}, group_size={}".format(
+            self.in_features, self.out_features, self.bias is not None, self.bits, self.group_size
+        )
+
+
+def quantize_linear_layers(module, bits=8, group_size=-1, skip_modules=("lm_head",)):
+    """
+    Recursively replace nn.Linear layers of ``module`` by QuantizedLinear.
+
+    Layers whose name is in ``skip_modules`` or whose input size is not divisible
+    by the group size are kept in full precision.
+
+    Returns:
+        int: number of replaced layers.
+    """
+    num_quantized = 0
+    for name, child in module.named_children():
+        if name in skip_modules:
+            continue
+        if isinstance(child, nn.Linear):
+            group = child.in_features if group_size <= 0 else group_size
+            if child.in_features % group != 0 or (bits == 4 and group % 2 != 0):
+                logging.info("Skip quantizing {} with in_features {}".format(name, child.in_features))
+                continue
+            setattr(module, name, QuantizedLinear.from_linear(child, bits, group_size))
+            num_quantized += 1
+        else:
+            num_quantized += quantize_linear_layers(child, bits, group_size, skip_modules)
+    return num_quantized
+
+
+def default_quantization_modules(model):
+    """
+    The language model of a BLIVA model: llm_model (Vicuna) or t5_model (FlanT5).
+    """
+    return [name for name in ("llm_model", "t5_model") if isinstance(getattr(model, name, None), nn.Module)]
+
+
+def quantize_model(model, quantization_cfg):
+    """
+    Apply weight-only quantization to the submodules listed in the model config, e.g.
+
+        quantization:
+          bits: 8
+          group_size: 128
+          modules: ["llm_model", "visual_encoder"]
+          skip_modules: ["lm_head"]
+
+    Without modules the language model is quantized. Quantizing a model whose
+    weights are still on the meta device creates empty quantized layers, which
+    is used to load pre-quantized checkpoints.
+    """
+    bits = quantization_cfg.get("bits", 8)
+    group_size = quantization_cfg.get("group_size", -1)
+    modules = quantization_cfg.get("modules", None) or default_quantization_modules(model)
+    skip_modules = tuple(quantization_cfg.get("skip_modules", ["lm_head"]))
+
+    total_quantized = 0
+    for module_name in modules:
+        module = getattr(model, module_name, None)
+        if module is None:
+            logging.warning("Module {} not found, skip quantization.".format(module_name))
+            continue
+
+        num_quantized = quantize_linear_layers(module, bits, group_size, skip_modules)
+        total_quantized += num_quantized
+        logging.info(
+            "Quantized {} linear layers in {} to int{} (group_size={})".format(
+                num_quantized, module_name, bits, group_size
+            )
+        )
+
+    if total_quantized == 0:
+        raise RuntimeError("No linear layer was quantized in modules {}.".format(list(modules)))
+
+    return model
+
+
+def save_quantized_checkpoint(model, filename, quantization_cfg):
+    """
+    Save a quantized model in the same layout as runner checkpoints, together with
+    the quantization config needed to rebuild the quantized layers.
+    """
+    save_obj = {
+        "model": model.state_dict(),
+        "quantization": dict(quantization_cfg),
+    }
+    torch.save(save_obj, filename)
+    logging.info("Saved quantized checkpoint to {}".format(filename))
+
+
+@torch.no_grad()
+def quantization_report(model, quantized_model, data_loader, num_batches=10, **generate_kwargs):
+    """
+    Compare a quantized model against its full-precision counterpart.
+
+    Reports mean generation latency of both models, the speedup, the fraction of
+    samples for which the generated text matches exactly, and the model sizes.
+    """
+    fp_time, q_time = 0.0, 0.0
+    num_samples, num_match = 0, 0
+
+    for i, samples in enumerate(data_loader):
+        if i >= num_batches:
+            break
+
+        start = time.time()
+        fp_outputs = model.generate(samples, **generate_kwargs)
+        fp_time += time.time() - start
+
+        start = time.time()
+        q_outputs = quantized_model.generate(samples, **generate_kwargs)
+        q_time += time.time() - start
+
+        num_samples += len(fp_outputs)
+        num_match += sum([a == b for a, b in zip(fp_outputs, q_outputs)])
+
+    def model_size(m):
+        return sum(p.numel() * p.element_size() for p in m.parameters()) / 1024 ** 3
+
+    num_samples = max(num_samples, 1)
+    report = {
+        "fp_latency": fp_time / num_samples,
+        "quantized_latency": q_time / num_samples,
+        "speedup": fp_time / max(q_time, 1e-8),
+        "exact_match": num_match / num_samples,
+        "fp_size_gb": model_size(model),
+        "quantized_size_gb": model_size(quantized_model),
+    }
+    logging.info("Quantization report: {}".format(report))
+
+    return report
@@ -0,0 +1,314 @@
+"""
+ Copyright (c) 2023, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+ Image-text retrieval over galleries that do not fit in device memory:
+ embeddings in an (on-disk) index, chunked top-k and ITM re-ranking in large
+ batches of query-candidate pairs.
+"""
+
+import json
+import os
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+class EmbeddingIndex:
+    """
+    Embeddings [N, ...] stored in fp16 shards of up to ``shard_size`` rows.
+
+    With a ``path`` the shards are saved as ``shard_00000.npy``, ... listed in
+    ``index.json`` and read back memory-mapped, so an index built once can be
+    reopened by later runs; without one they are kept in CPU memory. With
+    ``normalize`` rows are L2-normalized along the last dimension when added.
+
+    Rows can be added with ids (saved next to their shard as
+    ``shard_00000.ids.json``), e.g. to resume an interrupted export or to map
+    search results back to images. ``info`` holds free-form metadata.
+
+        index = EmbeddingIndex("/tmp/coco_text")
+        for batch in batches:
+            index.add(model_embeddings(batch), ids=batch_ids(batch))
+        index.finalize()
+    """
+
+    def __init__(self, path=None, normalize=True, shard_size=8192):
+        self.path = path
+        self.normalize = normalize
+        self.shard_size = shard_size
+
+        self.shards = []  # tensors in memory, file names on disk
+        self.counts = []
+        self.id_shards = []  # per shard: id lists in memory, file names on disk, or None
+        self.info = {}
+        self.complete = False
+        self._pending = []
+        self._pending_ids = []
+        self._arrays = {}
+        self._ids = None
+
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            if os.path.isfile(self._meta_path):
+                with open(self._meta_path) as f:
+                    meta = json.load(f)
+                self.shards = [shard["file"] for shard in meta["shards"]]
+                self.counts = [shard["count"] for shard in meta["shards"]]
+                self.id_shards = [shard.get("ids") for shard in meta["shards"]]
+                self.info = meta.get("info", {})
+                self.complete = meta["complete"]
+
+    @property
+    def _meta_path(self):
+        return os.path.join(self.path, "index.json")
+
+    def __len__(self):
+        return sum(self.counts)
+
+    def add(self, embeddings, ids=None):
+        embeddings = embeddings.detach()
+        if self.normalize:
+            embeddings = F.normalize(embeddings.float(), dim=-1)
+        self._pending.append(embeddings.to("cpu", torch.float16))
+
+        if ids is not None:
+            assert len(ids) == embeddings.size(0), "{} ids for {} embeddings.".format(len(ids), embeddings.size(0))
+            self._pending_ids += list(ids)
+
+        if sum(e.size(0) for e in self._pending) >= self.shard_size:
+            self.flush()
+
+    def clear(self):
+        """
+        Drop all rows, e.g. to rebuild an incomplete index.
+        """
+        self.shards, self.counts, self.id_shards = [], [], []
+        self._pending, self._pending_ids, self._arrays, self._ids = [], [], {}, None
+        self.complete = False
+        self._save_meta()
+
+    def flush(self):
+        if not self._pending:
+            return
+        shard = torch.cat(self._pending)
+        ids = self._pending_ids or None
+        assert ids is None or len(ids) == shard.size(0), "Either all or none of the rows of a shard have ids."
+        self._pending, self._pending_ids, self._ids = [], [], None
+
+        if self.path is None:
+            self.shards.append(shard)
+            self.id_shards.append(ids)
+        else:
+            # the shard files are complete before index.json lists them
+            name = "shard_{:05d}".format(len(self.shards))
+            self._write(name + ".npy", lambda f: np.save(f, shard.numpy()))
+            self.shards.append(name + ".npy")
+            if ids is not None:
+                self._write(name + ".ids.json", lambda f: f.write(json.dumps(ids).encode()))
+            self.id_shards.append(name + ".ids.json" if ids is not None else None)
+        self.counts.append(shard.size(0))
+        self._save_meta()
+
+    def _write(self, name, write):
+        tmp = os.path.join(self.path, name + ".tmp")
+        with open(tmp, "wb") as f:
+            write(f)
+        os.replace(tmp, os.path.join(self.path, name))
+
+    def finalize(self):
+        """
+        Write the pending rows and mark the index complete.
+        """
+        self.flush()
+        self.complete = True
+        self._save_meta()
+        return self
+
+    def _save_meta(self):
+        if self.path is None:
+            return
+        meta = {
+            "complete": self.complete,
+            "info": self.info,
+            "shards": [
+                {"file": f, "count": c, "ids": i} for f, c, i in zip(self.shards, self.counts, self.id_shards)
+            ],
+        }
+        self._write("index.json", lambda f: f.write(json.dumps(meta).encode()))
+
+    def _shard(self, i):
+        if self.path is None:
+            return self.shards[i]
+        if i not in self._arrays:
+            self._arrays[i] = np.load(os.path.join(self.path, self.shards[i]), mmap_mode="r")
+        return self._arrays[i]
+
+    def ids(self):
+        """
+        Ids of all rows (None for rows added without ids).
+        """
+        if self._ids is None:
+            self._ids = []
+            for ids, count in zip(self.id_shards, self.counts):
+                if ids is not None and self.path is not None:
+                    with open(os.path.join(self.path, ids)) as f:
+                        ids = json.load(f)
+                self._ids += ids if ids is not None else [None] * count
+        return self._ids
+
+    def rows_of(self, ids):
+        """
+        Row index of each of ``ids``.
+        """
+        rows = {id_: row for row, id_ in enumerate(self.ids())}
+        return torch.tensor([rows[id_] for id_ in ids], dtype=torch.long)
+
+    @staticmethod
+    def _tensor(array):
+        return array if isinstance(array, torch.Tensor) else torch.from_numpy(np.ascontiguousarray(array))
+
+    def chunks(self, chunk_size):
+        """
+        (start row, embeddings) of consecutive chunks of at most chunk_size rows.
+        """
+        assert not self._pending, "flush() the index before reading it."
+        offset = 0
+        for i, count in enumerate(self.counts):
+            shard = self._shard(i)
+            for start in range(0, count, chunk_size):
+                yield offset + start, self._tensor(shard[start : start + chunk_size])
+            offset += count
+
+    def get(self, rows):
+        """
+        Embeddings of the given row indices, in that order.
+        """
+        assert not self._pending, "flush() the index before reading it."
+        rows = torch.as_tensor(rows, dtype=torch.long).cpu()
+        offsets = torch.tensor([0] + self.counts).cumsum(0)
+        shard_ids = torch.searchsorted(offsets, rows, right=True) - 1
+
+        output = None
+        for i in shard_ids.unique().tolist():
+            positions = (shard_ids == i).nonzero().squeeze(1)
+            local = (rows[positions] - offsets[i]).numpy()
+            values = self._tensor(self._shard(i)[local])
+            if output is None:
+                output = values.new_empty((rows.size(0),) + tuple(values.shape[1:]))
+            output[positions] = values
+        return output
+
+
+def iter_chunks(embeddings, chunk_size, start=0, end=None):
+    """
+    (start row, embeddings) of the chunks of rows start to end of a tensor or EmbeddingIndex.
+    """
+    end = len(embeddings) if end is None else end
+    if isinstance(embeddings, EmbeddingIndex) and start == 0 and end == len(embeddings):
+        yield from embeddings.chunks(chunk_size)
+        return
+
+    for chunk_start in range(start, end, chunk_size):
+        rows = torch.arange(chunk_start, min(end, chunk_start + chunk_size))
+        yield chunk_start, take_rows(embeddings, rows)
+
+
+def take_rows(embeddings, rows):
+    if isinstance(embeddings, EmbeddingIndex):
+        return embeddings.get(rows)
+    return embeddings[rows]
+
+
+def max_similarity(queries, gallery):
+    """
+    Similarity [Nq, Ng] of normalized embeddings [N, D] or [N, num_tokens, D];
+    multi-token embeddings (e.g. Q-Former queries) score their best token.
+    """
+    queries = queries if queries.dim() == 3 else queries.unsqueeze(1)
+    gallery = gallery if gallery.dim() == 3 else gallery.unsqueeze(1)
+    sim = queries.flatten(0, 1) @ gallery.flatten(0, 1).t()
+    return sim.view(queries.size(0), queries.size(1), gallery.size(0), gallery.size(1)).amax(dim=(1, 3))
+
+
+@torch.no_grad()
+def chunked_topk(
+    queries,
+    gallery,
+    k,
+    device=None,
+    start=0,
+    end=None,
+    query_chunk_size=256,
+    gallery_chunk_size=8192,
+):
+    """
+    Scores and indices [end - start, k] (on CPU) of the k most similar gallery
+    rows of queries start to end by max_similarity. queries and gallery are
+    tensors or EmbeddingIndex; one chunk of each is on device at a time.
+    """
+    k = min(k, len(gallery))
+    all_scores, all_indices = [torch.empty(0, k)], [torch.empty(0, k, dtype=torch.long)]
+    for _, query in iter_chunks(queries, query_chunk_size, start, end):
+        query = query.to(device)
+        # fp16 matmuls are slow or missing on CPU
+        query = query.half() if query.is_cuda else query.float()
+
+        scores = indices = None
+        for gallery_start, chunk in iter_chunks(gallery, gallery_chunk_size):
+            sim = max_similarity(query, chunk.to(query.device, query.dtype)).float()
+            chunk_scores, chunk_indices = sim.topk(min(k, sim.size(1)), dim=1)
+            chunk_indices += gallery_start
+
+            if scores is not None:
+                chunk_scores = torch.cat([scores, chunk_scores], dim=1)
+                chunk_indices = torch.cat([indices, chunk_indices], dim=1)
+                chunk_scores, best = chunk_scores.topk(min(k, chunk_scores.size(1)), dim=1)
+                chunk_indices = chunk_indices.gather(1, best)
+            scores, indices = chunk_scores, chunk_indices
+
+        all_scores.append(scores.cpu())
+        all_indices.append(indices.cpu())
+
+    return torch.cat(all_scores), torch.cat(all_indices)
+
+
+@torch.no_grad()
+def rerank_itm(
+    model,
+    topk_scores,
+    topk_indices,
+    image_inputs,
+    text_ids,
+    text_atts,
+    queries_are_images,
+    query_offset=0,
+    batch_size=512,
+):
+    """
+    ITM score plus similarity of each (query, candidate) pair of the top-k,
+    computed ``batch_size`` pairs at a time across queries. Query i is row
+    query_offset + i of image_inputs (a tensor or EmbeddingIndex) if
+    queries_are_images, otherwise of text_ids / text_atts.
+    """
+    num_queries, k = topk_indices.shape
+    query_rows = torch.arange(num_queries).repeat_interleave(k) + query_offset
+    candidates = topk_indices.flatten()
+    image_rows, text_rows = (query_rows, candidates) if queries_are_images else (candidates, query_rows)
+
+    scores = torch.empty(num_queries * k)
+    for start in range(0, scores.size(0), batch_size):
+        pairs = slice(start, start + batch_size)
+        images = take_rows(image_inputs, image_rows[pairs]).to(model.device).float()
+        with model.maybe_autocast():
+            score = model.compute_itm(
+                image_inputs=images,
+                text_ids=text_ids[text_rows[pairs]].to(model.device),
+                text_atts=text_atts[text_rows[pairs]].to(model.device),
+            )
+        scores[pairs] = score.float().cpu()
+
+    return scores.view(num_queries, k) + topk_scores
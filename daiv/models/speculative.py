@@ -0,0 +1,184 @@
+"""
+ Copyright (c) 2023, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+"""
+
+import torch
+from transformers import LogitsProcessorList
+
+
+class SpeculativeStats:
+    """
+    Running counters of speculative decoding.
+
+    acceptance_rate is the fraction of draft tokens accepted by the target model;
+    tokens_per_target_call is the average number of tokens committed per target forward.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.num_drafted = 0
+        self.num_accepted = 0
+        self.num_target_calls = 0
+        self.num_tokens = 0
+        self.num_sequences = 0
+
+    @property
+    def acceptance_rate(self):
+        return self.num_accepted / max(self.num_drafted, 1)
+
+    @property
+    def tokens_per_target_call(self):
+        return self.num_tokens / max(self.num_target_calls, 1)
+
+    def summary(self):
+        return {
+            "num_drafted": self.num_drafted,
+            "num_accepted": self.num_accepted,
+            "num_target_calls": self.num_target_calls,
+            "num_tokens": self.num_tokens,
+            "num_sequences": self.num_sequences,
+            "acceptance_rate": self.acceptance_rate,
+            "tokens_per_target_call": self.tokens_per_target_call,
+        }
+
+
+def _crop_past_key_values(past_key_values, length):
+    return tuple(
+        tuple(state[:, :, :length] for state in layer_past)
+        for layer_past in past_key_values
+    )
+
+
+@torch.no_grad()
+def speculative_greedy_decode(
+    target_model,
+    draft_model,
+    inputs_embeds,
+    draft_input_ids,
+    max_new_tokens,
+    eos_token_id,
+    num_draft_tokens=4,
+    logits_processor=None,
+    stats=None,
+):
+    """
+    Greedy decoding of ``target_model`` accelerated by a small draft model.
+
+    The draft model proposes ``num_draft_tokens`` tokens from its own (text-only)
+    prefix, and the target model scores all of them in one forward pass on top of
+    its KV cache. The longest prefix of the proposal that matches the target's greedy
+    choices is kept, followed by the target's own next token, so the output is the
+    same as plain greedy decoding with the same logits processors. Only batch size 1
+    is supported.
+
+    Args:
+        target_model: causal LM called with inputs_embeds, e.g. LlamaForCausalLM.
+        draft_model: causal LM sharing the target tokenizer.
+        inputs_embeds (torch.Tensor): [1, prefix_len, hidden] target prefix.
+        draft_input_ids (torch.LongTensor): [1, draft_prefix_len] draft prefix.
+        logits_processor (LogitsProcessorList): applied to the scores of every
+            position, with the tokens generated so far as input ids.
+        stats (SpeculativeStats): optional counters to update.
+
+    Returns:
+        torch.LongTensor: [1, num_generated] generated token ids.
+    """
+    assert inputs_embeds.size(0) == 1, "Speculative decoding only supports batch size 1."
+
+    device = inputs_embeds.device
+    if logits_processor is None:
+        logits_processor = LogitsProcessorList()
+    if stats is None:
+        stats = SpeculativeStats()
+
+    def greedy_token(generated, logits):
+        input_ids = torch.tensor([generated], dtype=torch.long, device=device)
+        scores = logits_processor(input_ids, logits.unsqueeze(0))
+        return int(scores.argmax(dim=-1))
+
+    def run(model, past_key_values, past_length, token_ids):
+        return model(
+            input_ids=torch.tensor([token_ids], dtype=torch.long, device=device),
+            attention_mask=torch.ones(1, past_length + len(token_ids), dtype=torch.long, device=device),
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True,
+        )
+
+    # prefill both models
+    outputs = target_model(
+        inputs_embeds=inputs_embeds,
+        attention_mask=torch.ones(inputs_embeds.size()[:-1], dtype=torch.long, device=device),
+        use_cache=True,
+        return_dict=True,
+    )
+    target_past = outputs.past_key_values
+    generated = [greedy_token([], outputs.logits[0, -1])]
+    stats.num_target_calls += 1
+
+    draft_outputs = draft_model(input_ids=draft_input_ids, use_cache=True, return_dict=True)
+    draft_past = draft_outputs.past_key_values
+    draft_prefix_len = draft_input_ids.size(1)
+    draft_len = draft_prefix_len
+    # number of generated tokens already in the draft cache
+    draft_cached = 0
+
+    # the target cache always holds the prefix and all generated tokens but the last one
+    target_len = inputs_embeds.size(1)
+
+    while len(generated) < max_new_tokens and generated[-1] != eos_token_id:
+        num_draft = min(num_draft_tokens, max_new_tokens - len(generated))
+
+        # draft proposes num_draft tokens greedily
+        drafted = []
+        feed = generated[draft_cached:]
+        for _ in range(num_draft):
+            draft_outputs = run(draft_model, draft_past, draft_len, feed)
+            draft_past = draft_outputs.past_key_values
+            draft_len += len(feed)
+
+            token = greedy_token(generated + drafted, draft_outputs.logits[0, -1])
+            drafted.append(token)
+            if token == eos_token_id:
+                break
+            feed = [token]
+
+        # target verifies the last committed token and all drafted tokens at once
+        verify = [generated[-1]] + drafted
+        outputs = run(target_model, target_past, target_len, verify)
+        stats.num_target_calls += 1
+
+        new_tokens = []
+        num_accepted = 0
+        for j in range(len(verify)):
+            token = greedy_token(generated + new_tokens, outputs.logits[0, j])
+            new_tokens.append(token)
+            if j < len(drafted) and token == drafted[j] and token != eos_token_id:
+                num_accepted += 1
+                continue
+            break
+
+        new_tokens = new_tokens[: max_new_tokens - len(generated)]
+
+        stats.num_drafted += len(drafted)
+        stats.num_accepted += num_accepted
+
+        # drop cache entries of rejected draft tokens
+        num_cached_drafts = min(num_accepted, len(drafted) - 1)
+        draft_cached = len(generated) + num_cached_drafts
+        draft_len = draft_prefix_len + draft_cached
+        draft_past = _crop_past_key_values(draft_past, draft_len)
+
+        generated += new_tokens
+        target_len = inputs_embeds.size(1) + len(generated) - 1
+        target_past = _crop_past_key_values(outputs.past_key_values, target_len)
+
+    stats.num_tokens += len(generated)
+    stats.num_sequences += 1
+
+    return torch.tensor([generated], dtype=torch.long, device=device)
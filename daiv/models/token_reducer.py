@@ -0,0 +1,161 @@
+"""
+ Copyright (c) 2023, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+ Visual token reducers, applied to the ViT patch features before vision_project
+ to shorten the LLM prefix (32 queries + 256 patches by default).
+"""
+
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class PoolTokenReducer(nn.Module):
+    """
+    Average pooling of the patch grid to ``num_tokens`` tokens. Square targets
+    pool the 2d grid (e.g. 16x16 -> 8x8), other targets pool the sequence.
+    """
+
+    def __init__(self, num_tokens):
+        super().__init__()
+        self.num_tokens = num_tokens
+
+    def forward(self, x):
+        bs, n, dim = x.shape
+        if n <= self.num_tokens:
+            return x
+
+        side, target_side = math.isqrt(n), math.isqrt(self.num_tokens)
+        if side * side == n and target_side * target_side == self.num_tokens:
+            x = x.transpose(1, 2).reshape(bs, dim, side, side)
+            x = F.adaptive_avg_pool2d(x, target_side)
+        else:
+            x = F.adaptive_avg_pool1d(x.transpose(1, 2), self.num_tokens)
+
+        return x.flatten(2).transpose(1, 2)
+
+
+class MergeTokenReducer(nn.Module):
+    """
+    Similarity-based token merging (bipartite soft matching, as in ToMe):
+    alternate tokens are matched to their most similar counterpart and the
+    closest pairs are averaged, weighted by how many patches each token
+    already holds, until ``num_tokens`` remain. Token order is not kept.
+    """
+
+    def __init__(self, num_tokens):
+        super().__init__()
+        self.num_tokens = num_tokens
+
+    @staticmethod
+    def _merge(x, size, r):
+        # x holds feature sums, size the number of patches merged into each token
+        metric = F.normalize(x / size, dim=-1)
+        scores = metric[:, ::2] @ metric[:, 1::2].transpose(1, 2)
+
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True).unsqueeze(-1)
+        unm_idx, src_idx = edge_idx[:, r:], edge_idx[:, :r]
+        dst_idx = node_idx.unsqueeze(-1).gather(1, src_idx)
+
+        def merge(t):
+            src, dst = t[:, ::2], t[:, 1::2]
+            d = t.size(-1)
+            unm = src.gather(1, unm_idx.expand(-1, -1, d))
+            src = src.gather(1, src_idx.expand(-1, -1, d))
+            dst = dst.scatter_add(1, dst_idx.expand(-1, -1, d), src)
+            return torch.cat([unm, dst], dim=1)
+
+        return merge(x), merge(size)
+
+    def forward(self, x):
+        n = x.size(1)
+        if n <= self.num_tokens:
+            return x
+
+        size = torch.ones_like(x[..., :1])
+        while n > self.num_tokens:
+            r = min(n - self.num_tokens, n // 2)
+            x, size = self._merge(x, size, r)
+            n = x.size(1)
+
+        return x / size
+
+
+class DeformableTokenReducer(nn.Module):
+    """
+    Learned compressor: a residual DeformableAttention1D block (from
+    dmformer/dat) mixes the patch tokens before they are pooled to
+    ``num_tokens``. The output projection starts at zero, so an untrained
+    reducer is equivalent to PoolTokenReducer.
+    """
+
+    def __init__(
+        self,
+        dim,
+        num_tokens,
+        heads=8,
+        dim_head=64,
+        downsample_factor=4,
+        offset_kernel_size=6,
+    ):
+        super().__init__()
+        from daiv.models.dmformer.dat.deformable_attention_1d import DeformableAttention1D
+
+        self.norm = nn.LayerNorm(dim)
+        self.attn = DeformableAttention1D(
+            dim=dim,
+            heads=heads,
+            dim_head=dim_head,
+            downsample_factor=downsample_factor,
+            offset_kernel_size=offset_kernel_size,
+        )
+        self.pool = PoolTokenReducer(num_tokens)
+        self.num_tokens = num_tokens
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # only the zero output projection, the submodules have their own initializers;
+        # also re-run by lazy_init after to_out.reset_parameters()
+        nn.init.zeros_(self.attn.to_out.weight)
+        nn.init.zeros_(self.attn.to_out.bias)
+
+    def forward(self, x):
+        x = x + self.attn(self.norm(x).transpose(1, 2)).transpose(1, 2)
+        return self.pool(x)
+
+
+TOKEN_REDUCERS = {
+    "pool": PoolTokenReducer,
+    "merge": MergeTokenReducer,
+    "deformable": DeformableTokenReducer,
+}
+
+
+def build_token_reducer(cfg, dim):
+    """
+    Build the reducer described by a model config entry, e.g.
+
+        token_reducer:
+          type: "pool"       # pool, merge or deformable
+          num_tokens: 64
+
+    Extra keys are passed to the reducer. Returns None when cfg is empty.
+    """
+    if not cfg:
+        return None
+
+    cfg = dict(cfg)
+    reducer_type = cfg.pop("type", "pool")
+    assert reducer_type in TOKEN_REDUCERS, "Unknown token reducer {}, expected one of {}.".format(
+        reducer_type, list(TOKEN_REDUCERS)
+    )
+
+    if reducer_type == "deformable":
+        return DeformableTokenReducer(dim=dim, **cfg)
+    return TOKEN_REDUCERS[reducer_type](**cfg)
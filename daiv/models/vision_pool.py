@@ -0,0 +1,105 @@
+"""
+ Copyright (c) 2023, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+
+ Frozen vision encoders shared by the models of one process, e.g. the
+ Vicuna and FlanT5 variants served side by side.
+"""
+
+import logging
+import weakref
+
+import torch
+
+# (vit_model, img_size, precision, checkpoint) -> encoder, dropped once no model holds it
+_vision_encoders = weakref.WeakValueDictionary()
+_feature_caches = weakref.WeakKeyDictionary()
+
+
+class VisionFeatureCache:
+    """
+    Last and penultimate layer outputs for the latest ``size`` images seen by a
+    shared vision encoder. Models asking for the features of an equal image
+    tensor under the same autocast setting reuse the first ViT pass.
+    """
+
+    def __init__(self, size=4):
+        self.size = size
+        self.entries = []  # (image, autocast, features), most recent last
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, image, autocast):
+        for i, (cached, cached_autocast, features) in enumerate(self.entries):
+            if (
+                cached_autocast == autocast
+                and cached.shape == image.shape
+                and cached.dtype == image.dtype
+                and cached.device == image.device
+                and torch.equal(cached, image)
+            ):
+                self.entries.append(self.entries.pop(i))
+                self.hits += 1
+                return features
+
+        self.misses += 1
+        return None
+
+    def add(self, image, autocast, features):
+        self.entries.append((image.detach().clone(), autocast, features))
+        if len(self.entries) > self.size:
+            self.entries.pop(0)
+
+
+def get_vision_encoder(key, build, register=True):
+    """
+    The vision encoder of ``key``: the pooled one if another model built it,
+    otherwise ``build()``, pooled when ``register`` is set. Encoders built
+    without weights (lazy_init) are registered once loaded.
+    """
+    encoder = _vision_encoders.get(key)
+    if encoder is not None:
+        logging.info("Share vision encoder {}".format(key))
+        return encoder
+
+    encoder = build()
+    if register:
+        register_vision_encoder(key, encoder)
+    return encoder
+
+
+def register_vision_encoder(key, encoder, cache_size=4):
+    if key in _vision_encoders:
+        return
+    _vision_encoders[key] = encoder
+    _feature_caches[encoder] = VisionFeatureCache(cache_size)
+
+
+def get_feature_cache(encoder):
+    """
+    The feature cache of a pooled encoder, None for an encoder of its own.
+    """
+    return _feature_caches.get(encoder)
+
+
+def extract_vision_features(visual_encoder, image):
+    """
+    Last and penultimate layer outputs of ``image`` from a single ViT pass;
+    the last one equals visual_encoder(image). Pooled encoders reuse the
+    features of recent images when gradients are disabled.
+    """
+    cache = get_feature_cache(visual_encoder)
+    if cache is None or torch.is_grad_enabled():
+        features = visual_encoder.get_intermediate_layers(image)
+        return features[-1], features[-2]
+
+    autocast = (torch.is_autocast_enabled(), torch.get_autocast_gpu_dtype())
+    features = cache.get(image, autocast)
+    if features is None:
+        layers = visual_encoder.get_intermediate_layers(image)
+        features = (layers[-1], layers[-2])
+        cache.add(image, autocast, features)
+    return features
@@ -7,15 +7,34 @@
 
 from daiv.processors.base_processor import BaseProcessor
 
-from daiv.processors.blip_processors import (
-    BlipImageTrainProcessor,
-    Blip2ImageTrainProcessor,
-    BlipImageEvalProcessor,
-    BlipCaptionProcessor,
+from daiv.common.registry import lazy_getattr, registry
+
+_BLIP_PROCESSORS = "daiv.processors.blip_processors"
+_CLIP_PROCESSORS = "daiv.processors.clip_processors"
+
+# processor modules are imported when a processor is first used, see Registry.register_lazy
+_PROCESSOR_MODULES = {
+    "blip_caption": _BLIP_PROCESSORS,
+    "blip_question": _BLIP_PROCESSORS,
+    "blip_image_train": _BLIP_PROCESSORS,
+    "blip_image_eval": _BLIP_PROCESSORS,
+    "blip2_image_train": _BLIP_PROCESSORS,
+    "clip_image_train": _CLIP_PROCESSORS,
+    "clip_image_eval": _CLIP_PROCESSORS,
+}
+for _name, _module in _PROCESSOR_MODULES.items():
+    registry.register_lazy("processor", _name, _module)
+
+__getattr__ = lazy_getattr(
+    __name__,
+    {
+        "BlipImageTrainProcessor": _BLIP_PROCESSORS,
+        "Blip2ImageTrainProcessor": _BLIP_PROCESSORS,
+        "BlipImageEvalProcessor": _BLIP_PROCESSORS,
+        "BlipCaptionProcessor": _BLIP_PROCESSORS,
+        "ClipImageTrainProcessor": _CLIP_PROCESSORS,
+    },
 )
-from daiv.processors.clip_processors import ClipImageTrainProcessor
-
-from daiv.common.registry import registry
 
 __all__ = [
     "BaseProcessor",
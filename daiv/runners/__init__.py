@@ -5,7 +5,16 @@
  For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
 """
 
-from daiv.runners.runner_base import RunnerBase
-from daiv.runners.runner_iter import RunnerIter
+from daiv.common.registry import lazy_getattr, registry
+
+registry.register_lazy("runner", "runner_base", "daiv.runners.runner_base")
+registry.register_lazy("runner", "runner_iter", "daiv.runners.runner_iter")
+registry.register_lazy("lr_scheduler", "linear_warmup_step_lr", "daiv.common.optims")
+registry.register_lazy("lr_scheduler", "linear_warmup_cosine_lr", "daiv.common.optims")
+
+__getattr__ = lazy_getattr(
+    __name__,
+    {"RunnerBase": "daiv.runners.runner_base", "RunnerIter": "daiv.runners.runner_iter"},
+)
 
 __all__ = ["RunnerBase", "RunnerIter"]
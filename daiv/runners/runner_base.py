@@ -5,6 +5,7 @@
  For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
 """
 
+import contextlib
 import datetime
 import json
 import logging
@@ -15,6 +16,7 @@ from pathlib import Path
 import torch
 import torch.distributed as dist
 import webdataset as wds
+from packaging import version
 from daiv.common.dist_utils import (
     download_cached_file,
     get_rank,
@@ -23,16 +25,23 @@ from daiv.common.dist_utils import (
     main_process,
     is_dist_avail_and_initialized,
 )
+from daiv.common.eval_journal import EvalJournal
+from daiv.common.metrics import AsyncMetricWriter, build_metric_sinks
+from daiv.common.profiling import build_profiler, stage_timer
 from daiv.common.registry import registry
-from daiv.common.utils import is_url
+from daiv.common.utils import get_rng_state, is_url, set_rng_state
 from daiv.datasets.data_utils import concat_datasets, reorg_datasets_by_split
 from daiv.datasets.datasets.dataloader_utils import (
     IterLoader,
+    LengthGroupedBatchSampler,
     MultiIterLoader,
     PrefetchLoader,
+    ResumableSampler,
+    dataset_annotations,
+    estimate_prompt_lengths,
 )
 from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.utils.data import DataLoader, DistributedSampler
+from torch.utils.data import DataLoader, DistributedSampler, Subset
 from torch.utils.data.dataset import ChainDataset
 from tqdm.auto import tqdm
 
@@ -60,6 +69,10 @@ class RunnerBase:
         self._scaler = None
         self._dataloaders = None
         self._lr_sched = None
+        self._metric_writer = None
+        self._profiler = None
+        self._gathered_state = None
+        self._gathered_resume_states = None
 
         self.start_epoch = 0
 
@@ -89,15 +102,153 @@ class RunnerBase:
 
         # distributed training wrapper
         if self.use_distributed:
-                if self._wrapped_model is None:
+                if self._wrapped_model is None and self.sharding == "fsdp":
+                    self._wrapped_model = self._wrap_fsdp(self._model)
+                elif self._wrapped_model is None:
                     self._wrapped_model = DDP(
-                        self._model, device_ids=[self.config.run_cfg.gpu], find_unused_parameters=True
+                        self._model,
+                        device_ids=[self.config.run_cfg.gpu] if self.cuda_enabled else None,
+                        find_unused_parameters=True,
+                        bucket_cap_mb=self.config.run_cfg.get("ddp_bucket_cap_mb", 25),
+                        gradient_as_bucket_view=self.config.run_cfg.get(
+                            "ddp_gradient_as_bucket_view", False
+                        ),
                     )
+                    self._register_comm_hook(self._wrapped_model)
         else:
                 self._wrapped_model = self._model
 
         return self._wrapped_model
 
+    @property
+    def sharding(self):
+        """
+        Distributed training mode from run_cfg.sharding:
+        "ddp" (replicated, default), "zero" (DDP with optimizer states sharded by
+        ZeroRedundancyOptimizer) or "fsdp" (parameters, gradients and optimizer
+        states sharded by FullyShardedDataParallel).
+        """
+        sharding = self.config.run_cfg.get("sharding", "ddp")
+        assert sharding in ["ddp", "zero", "fsdp"], "Unknown sharding mode {}".format(sharding)
+        if sharding == "fsdp" and version.parse(torch.__version__) < version.parse("2.1"):
+            # use_orig_params, optim_state_dict() and the argument order of optim_state_dict_to_load()
+            raise RuntimeError(
+                "sharding fsdp requires torch>=2.1, found {}; use sharding zero instead".format(
+                    torch.__version__
+                )
+            )
+        return sharding
+
+    def _wrap_fsdp(self, model):
+        """
+        Wrap the model with FSDP. Subtrees without trainable parameters (e.g. the
+        frozen ViT, or the frozen layers of a LoRA LLM) are left unsharded.
+
+        FSDP flattens the parameters of a unit into one tensor, which needs a
+        single dtype. Where trainable parts mix dtypes, units follow the dtype
+        boundaries: each largest single-dtype subtree is a unit (e.g. the fp32
+        LoRA A/B of an fp16 LLM), and so is each mixed module with parameters of
+        its own (the fp16 base weight of a LoRA layer). Single-dtype subtrees are
+        further split into units of at least run_cfg.fsdp_min_num_params parameters.
+        """
+        import functools
+
+        from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
+        from torch.distributed.fsdp.wrap import size_based_auto_wrap_policy
+
+        ignored_modules = []
+
+        def find_frozen(module):
+            params = list(module.parameters())
+            if len(params) > 0 and not any(p.requires_grad for p in params):
+                ignored_modules.append(module)
+            else:
+                for child in module.children():
+                    find_frozen(child)
+
+        for child in model.children():
+            find_frozen(child)
+        ignored = {id(p) for module in ignored_modules for p in module.parameters()}
+
+        def dtypes(module, recurse=True):
+            return {p.dtype for p in module.parameters(recurse=recurse) if id(p) not in ignored}
+
+        dtype_units = set()
+
+        def find_dtype_units(module):
+            for child in module.children():
+                child_dtypes = dtypes(child)
+                if len(child_dtypes) == 1:
+                    dtype_units.add(child)
+                elif len(child_dtypes) > 1:
+                    own_dtypes = dtypes(child, recurse=False)
+                    assert len(own_dtypes) <= 1, "FSDP can not flatten the parameters of {} of dtypes {}".format(
+                        type(child).__name__, own_dtypes
+                    )
+                    if own_dtypes:
+                        dtype_units.add(child)
+                    find_dtype_units(child)
+
+        if len(dtypes(model)) > 1:
+            find_dtype_units(model)
+
+        size_policy = functools.partial(
+            size_based_auto_wrap_policy,
+            min_num_params=int(self.config.run_cfg.get("fsdp_min_num_params", 1e8)),
+        )
+
+        def auto_wrap_policy(module, recurse, *args, **kwargs):
+            if recurse:
+                return True
+            if module in dtype_units:
+                return True
+            return len(dtypes(module)) == 1 and size_policy(module, recurse, *args, **kwargs)
+
+        logging.info(
+            "FSDP: {} frozen submodules left unsharded, {} units split by dtype".format(
+                len(ignored_modules), len(dtype_units)
+            )
+        )
+
+        return FSDP(
+            model,
+            auto_wrap_policy=auto_wrap_policy,
+            ignored_modules=ignored_modules,
+            device_id=self.config.run_cfg.gpu if self.cuda_enabled else None,
+            use_orig_params=True,
+        )
+
+    def _register_comm_hook(self, ddp_model):
+        """
+        Register a DDP gradient compression hook from run_cfg.ddp_comm_hook:
+        "fp16" / "bf16" (compress buckets before all-reduce) or "powersgd"
+        (low-rank compression, rank from run_cfg.powersgd_rank).
+        """
+        comm_hook = self.config.run_cfg.get("ddp_comm_hook", None)
+        if comm_hook is None:
+            return
+
+        from torch.distributed.algorithms.ddp_comm_hooks import (
+            default_hooks,
+            powerSGD_hook,
+        )
+
+        if comm_hook == "fp16":
+            ddp_model.register_comm_hook(None, default_hooks.fp16_compress_hook)
+        elif comm_hook == "bf16":
+            ddp_model.register_comm_hook(None, default_hooks.bf16_compress_hook)
+        elif comm_hook == "powersgd":
+            state = powerSGD_hook.PowerSGDState(
+                process_group=None,
+                matrix_approximation_rank=self.config.run_cfg.get("powersgd_rank", 1),
+                start_powerSGD_iter=self.config.run_cfg.get("powersgd_start_iter", 1000),
+            )
+            ddp_model.register_comm_hook(state, powerSGD_hook.powerSGD_hook)
+        else:
+            raise ValueError("Unknown ddp_comm_hook {}".format(comm_hook))
+
+        logging.info("Registered DDP communication hook {}".format(comm_hook))
+
     @property
     def optimizer(self):
         # TODO make optimizer class and configurations
@@ -121,12 +272,23 @@ class RunnerBase:
                 {"params": p_non_wd, "weight_decay": 0},
             ]
             beta2 = self.config.run_cfg.get("beta2", 0.999)
-            self._optimizer = torch.optim.AdamW(
-                optim_params,
-                lr=float(self.config.run_cfg.init_lr),
-                weight_decay=float(self.config.run_cfg.weight_decay),
-                betas=(0.9, beta2),
-            )
+            if self.use_distributed and self.sharding == "zero":
+                from torch.distributed.optim import ZeroRedundancyOptimizer
+
+                self._optimizer = ZeroRedundancyOptimizer(
+                    optim_params,
+                    optimizer_class=torch.optim.AdamW,
+                    lr=float(self.config.run_cfg.init_lr),
+                    weight_decay=float(self.config.run_cfg.weight_decay),
+                    betas=(0.9, beta2),
+                )
+            else:
+                self._optimizer = torch.optim.AdamW(
+                    optim_params,
+                    lr=float(self.config.run_cfg.init_lr),
+                    weight_decay=float(self.config.run_cfg.weight_decay),
+                    betas=(0.9, beta2),
+                )
 
         return self._optimizer
 
@@ -135,7 +297,11 @@ class RunnerBase:
         amp = self.config.run_cfg.get("amp", False)
 
         if amp:
-            if self._scaler is None:
+            if self._scaler is None and self.use_distributed and self.sharding == "fsdp":
+                from torch.distributed.fsdp.sharded_grad_scaler import ShardedGradScaler
+
+                self._scaler = ShardedGradScaler()
+            elif self._scaler is None:
                 self._scaler = torch.cuda.amp.GradScaler()
 
         return self._scaler
@@ -298,6 +464,63 @@ class RunnerBase:
     def accum_grad_iters(self):
         return int(self.config.run_cfg.get("accum_grad_iters", 1))
 
+    @property
+    def metric_writer(self):
+        """
+        Background writer of training metrics, on the main process only.
+        Sinks are configured by run_cfg.metric_sinks (stdout, file, wandb).
+        """
+        if self._metric_writer is None and is_main_process():
+            sink_names = self.config.run_cfg.get("metric_sinks", ["file", "wandb"])
+            sinks = build_metric_sinks(
+                sink_names,
+                self.output_dir,
+                wandb_project=self.config.run_cfg.get("wandb_project", "bliva"),
+            )
+            self._metric_writer = AsyncMetricWriter(sinks)
+
+        return self._metric_writer
+
+    def close_metric_writer(self):
+        if self._metric_writer is not None:
+            self._metric_writer.close()
+            self._metric_writer = None
+
+    def setup_stage_timer(self):
+        run_cfg = self.config.run_cfg
+        if run_cfg.get("profile_stages", False):
+            stage_timer().enable(sync=run_cfg.get("profile_sync", True))
+
+    def setup_profiling(self):
+        """
+        Enable per-stage timing (run_cfg.profile_stages) and start the
+        torch.profiler described by run_cfg.profiler, if any.
+        """
+        self.setup_stage_timer()
+
+        profiler_cfg = self.config.run_cfg.get("profiler", None)
+        if profiler_cfg is not None and self._profiler is None:
+            self._profiler = build_profiler(profiler_cfg, self.output_dir)
+            self._profiler.start()
+
+    def stop_profiler(self):
+        if self._profiler is not None:
+            self._profiler.stop()
+            self._profiler = None
+
+    def log_stage_report(self, split_name):
+        """
+        Log the per-stage timing breakdown collected so far and start a new one.
+        """
+        timer = stage_timer()
+        if not timer.enabled:
+            return
+
+        report = timer.log_report("Stage timing ({}):".format(split_name))
+        if len(report) > 0 and is_main_process():
+            self.log_stats({"stage_timing": report}, split_name)
+        timer.reset()
+
     @property
     def valid_splits(self):
         valid_splits = self.config.run_cfg.get("valid_splits", [])
@@ -333,6 +556,14 @@ class RunnerBase:
     def use_dist_eval_sampler(self):
         return self.config.run_cfg.get("use_dist_eval_sampler", True)
 
+    @property
+    def length_grouped_eval(self):
+        """
+        Sort evaluation samples by prompt length into padding-minimal batches
+        balanced across ranks; results are put back in dataset order.
+        """
+        return self.config.run_cfg.get("length_grouped_eval", False)
+
     @property
     def resume_ckpt_path(self):
         return self.config.run_cfg.get("resume_ckpt_path", None)
@@ -371,6 +602,7 @@ class RunnerBase:
         best_epoch = 0
 
         self.log_config()
+        self.setup_profiling()
 
         # resume from checkpoint if specified
         if not self.evaluate_only and self.resume_ckpt_path is not None:
@@ -382,6 +614,7 @@ class RunnerBase:
                 logging.info("Start training")
                 train_stats = self.train_epoch(cur_epoch)
                 self.log_stats(split_name="train", stats=train_stats)
+                self.gather_checkpoint_state()
 
             # evaluation phase
             if len(self.valid_splits) > 0:
@@ -411,11 +644,17 @@ class RunnerBase:
                 if not self.evaluate_only:
                     self._save_checkpoint(cur_epoch, is_best=False)
 
+            self.clear_gathered_state()
+
             if self.evaluate_only:
                 break
             if is_dist_avail_and_initialized():
                 dist.barrier()
 
+        self.close_metric_writer()
+        self.stop_profiler()
+        self.log_stage_report("train")
+
         # testing phase
         test_epoch = "best" if len(self.valid_splits) > 0 else cur_epoch
         self.evaluate(cur_epoch=test_epoch, skip_reload=self.evaluate_only)
@@ -438,11 +677,14 @@ class RunnerBase:
     def evaluate(self, cur_epoch="best", skip_reload=False):
         test_logs = dict()
 
+        self.setup_stage_timer()
+
         if len(self.test_splits) > 0:
             for split_name in self.test_splits:
                 test_logs[split_name] = self.eval_epoch(
                     split_name=split_name, cur_epoch=cur_epoch, skip_reload=skip_reload
                 )
+                self.log_stage_report(split_name)
 
             return test_logs
 
@@ -460,6 +702,8 @@ class RunnerBase:
             cuda_enabled=self.cuda_enabled,
             log_freq=self.log_freq,
             accum_grad_iters=self.accum_grad_iters,
+            metric_writer=self.metric_writer,
+            profiler=self._profiler,
         )
 
     @torch.no_grad()
@@ -493,7 +737,13 @@ class RunnerBase:
             model=model,
             dataset=self.datasets[split_name],
         )
-        results = self.task.evaluation(model, data_loader)
+
+        journal = self._eval_journal(split_name, cur_epoch)
+        if journal is None:
+            with self.full_params_context():
+                results = self.task.evaluation(model, data_loader)
+        else:
+            results = self._journaled_evaluation(model, split_name, journal)
 
         if results is not None:
             return self.task.after_evaluation(
@@ -503,12 +753,214 @@ class RunnerBase:
             )
 
 
+    def _eval_journal(self, split_name, cur_epoch):
+        """
+        Per-rank result journal of an evaluation, when run_cfg.eval_journal_dir is
+        set. Journals are kept per split and epoch under that directory, which has
+        to stay the same across restarts.
+        """
+        journal_dir = self.config.run_cfg.get("eval_journal_dir", None)
+        if journal_dir is None:
+            return None
+
+        return EvalJournal(
+            os.path.join(journal_dir, "{}_{}".format(split_name, cur_epoch)),
+            rank=get_rank(),
+            id_key=self.config.run_cfg.get("eval_journal_key", "question_id"),
+        )
+
+    def _journaled_evaluation(self, model, split_name, journal):
+        """
+        Evaluate the samples not yet in the journal, then return all journaled
+        results in dataset order on the main process (none on the other ranks).
+        """
+        dataset = self.datasets[split_name]
+        annotation = dataset_annotations(dataset)
+
+        done_ids = journal.done_ids()
+        # every rank has to see the same journals before any of them appends
+        if is_dist_avail_and_initialized():
+            dist.barrier()
+
+        if annotation is None or journal.id_key not in annotation[0]:
+            logging.warning(
+                "Samples of {} have no {}, evaluate all of them.".format(split_name, journal.id_key)
+            )
+            remaining = list(range(len(dataset)))
+        else:
+            remaining = [
+                i for i, ann in enumerate(annotation) if str(ann[journal.id_key]) not in done_ids
+            ]
+        logging.info(
+            "{} of {} samples of {} left to evaluate.".format(len(remaining), len(dataset), split_name)
+        )
+
+        if len(remaining) > 0:
+            data_loader = self.create_loaders(
+                datasets=[Subset(dataset, remaining)],
+                num_workers=self.config.run_cfg.num_workers,
+                batch_sizes=[self.config.run_cfg.batch_size_eval],
+                is_trains=[False],
+                collate_fns=[getattr(dataset, "collater", None)],
+            )[0]
+            with self.full_params_context():
+                self.task.evaluation(model, data_loader, journal=journal)
+        elif is_dist_avail_and_initialized():
+            dist.barrier()
+
+        if is_main_process():
+            return journal.collect(annotation)
+        return []
+
+    def gather_checkpoint_state(self):
+        """
+        Gather sharded model and optimizer states to the main process, so that
+        checkpoints hold full states loadable with any world size. The model state
+        loads in any sharding mode; the optimizer state only in the mode it was
+        saved with (FSDP keys it by parameter name, ZeRO and DDP by index).
+        This is a collective call and has to run on all ranks before _save_checkpoint().
+
+        The per-rank data positions and RNG states needed for an exact resume are
+        gathered as well.
+        """
+        self._gathered_resume_states = self.gather_resume_states()
+
+        if not self.use_distributed or self.sharding == "ddp":
+            return
+
+        if self.sharding == "zero":
+            self.optimizer.consolidate_state_dict(to=0)
+            return
+
+        from torch.distributed.fsdp import FullStateDictConfig, StateDictType
+        from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
+
+        with FSDP.state_dict_type(
+            self.model,
+            StateDictType.FULL_STATE_DICT,
+            FullStateDictConfig(offload_to_cpu=True, rank0_only=True),
+        ):
+            model_state = self.model.state_dict()
+            optimizer_state = FSDP.optim_state_dict(self.model, self.optimizer)
+
+        self._gathered_state = (model_state, optimizer_state)
+
+    def gather_resume_states(self):
+        """
+        Collect the RNG states and train loader position of every rank.
+        """
+        train_loader = self.train_loader
+        resume_state = {
+            "rng": get_rng_state(),
+            "dataloader": train_loader.state_dict()
+            if hasattr(train_loader, "state_dict")
+            else None,
+        }
+
+        if not is_dist_avail_and_initialized():
+            return [resume_state]
+
+        resume_states = [None] * get_world_size()
+        dist.all_gather_object(resume_states, resume_state)
+        return resume_states
+
+    def load_resume_state(self, resume_states):
+        """
+        Restore the RNG states and fast-forward the train loader of this rank.
+        """
+        if len(resume_states) != get_world_size():
+            logging.warning(
+                "Checkpoint was saved with {} ranks, skip restoring data positions.".format(
+                    len(resume_states)
+                )
+            )
+            return
+
+        resume_state = resume_states[get_rank()]
+        set_rng_state(resume_state["rng"])
+
+        if resume_state["dataloader"] is not None:
+            self.train_loader.load_state_dict(resume_state["dataloader"])
+
+    def clear_gathered_state(self):
+        self._gathered_state = None
+        self._gathered_resume_states = None
+
+    def checkpoint_state_dicts(self):
+        """
+        Full model and optimizer state dicts to save on the main process.
+        """
+        if self._gathered_state is not None:
+            return self._gathered_state
+
+        model_no_ddp = self.unwrap_dist_model(self.model)
+        return model_no_ddp.state_dict(), self.optimizer.state_dict()
+
+    def load_checkpoint_state_dicts(self, checkpoint):
+        """
+        Load full model and optimizer states, resharding them if needed.
+        """
+        if self.use_distributed and self.sharding == "fsdp":
+            from torch.distributed.fsdp import FullStateDictConfig, StateDictType
+            from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
+
+            with FSDP.state_dict_type(
+                self.model,
+                StateDictType.FULL_STATE_DICT,
+                FullStateDictConfig(rank0_only=False),
+            ):
+                self.model.load_state_dict(checkpoint["model"])
+                optimizer_state = FSDP.optim_state_dict_to_load(
+                    self.model, self.optimizer, checkpoint["optimizer"]
+                )
+            self.optimizer.load_state_dict(optimizer_state)
+        else:
+            self.unwrap_dist_model(self.model).load_state_dict(checkpoint["model"])
+            self.optimizer.load_state_dict(checkpoint["optimizer"])
+
+    def full_params_context(self):
+        """
+        Gather FSDP-sharded parameters for code paths other than forward(),
+        e.g. generate() during evaluation.
+        """
+        if self.use_distributed and self.sharding == "fsdp":
+            from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
+
+            return FSDP.summon_full_params(self.model, writeback=False)
+
+        return contextlib.nullcontext()
+
     def unwrap_dist_model(self, model):
         if self.use_distributed:
             return model.module
         else:
             return model
 
+    def _length_grouped_batch_sampler(self, dataset, batch_size):
+        """
+        Padding-minimal evaluation batches, cost-balanced across ranks. Prompt
+        lengths are counted with the language model tokenizer when available.
+        """
+        model = self._model
+        tokenizer = None
+        for name in ["llm_tokenizer", "t5_tokenizer", "tokenizer"]:
+            tokenizer = getattr(model, name, None)
+            if tokenizer is not None:
+                break
+
+        if self.use_distributed and self.use_dist_eval_sampler:
+            num_replicas, rank = get_world_size(), get_rank()
+        else:
+            num_replicas, rank = 1, 0
+
+        return LengthGroupedBatchSampler(
+            estimate_prompt_lengths(dataset, tokenizer=tokenizer),
+            batch_size=batch_size,
+            num_replicas=num_replicas,
+            rank=rank,
+            cost_offset=self.config.run_cfg.get("eval_cost_offset", 32),
+        )
+
     def create_loaders(
         self,
         datasets,
@@ -553,17 +1005,39 @@ class RunnerBase:
                 else:
                     sampler = None
 
-                loader = DataLoader(
-                    dataset,
-                    batch_size=bsz,
-                    num_workers=num_workers,
-                    pin_memory=True,
-                    sampler=sampler,
-                    shuffle=sampler is None and is_train,
-                    collate_fn=collate_fn,
-                    drop_last=True if is_train else False,
-                )
-                loader = PrefetchLoader(loader)
+                if is_train:
+                    if sampler is None:
+                        # seeded shuffling, so that the data order can be restored on resume
+                        sampler = DistributedSampler(
+                            dataset,
+                            shuffle=True,
+                            num_replicas=1,
+                            rank=0,
+                            seed=self.config.run_cfg.get("seed", 0),
+                        )
+                    sampler = ResumableSampler(sampler)
+
+                if not is_train and self.length_grouped_eval:
+                    loader = DataLoader(
+                        dataset,
+                        batch_sampler=self._length_grouped_batch_sampler(dataset, bsz),
+                        num_workers=num_workers,
+                        pin_memory=True,
+                        collate_fn=collate_fn,
+                    )
+                else:
+                    loader = DataLoader(
+                        dataset,
+                        batch_size=bsz,
+                        num_workers=num_workers,
+                        pin_memory=True,
+                        sampler=sampler,
+                        shuffle=sampler is None and is_train,
+                        collate_fn=collate_fn,
+                        drop_last=True if is_train else False,
+                    )
+                if self.cuda_enabled:
+                    loader = PrefetchLoader(loader)
 
                 if is_train:
                     loader = IterLoader(loader, use_distributed=self.use_distributed)
@@ -599,18 +1073,17 @@ class RunnerBase:
         Save the checkpoint at the current epoch.
         """
         #hack save all the weights
-        model_no_ddp = self.unwrap_dist_model(self.model)
         # param_grad_dic = {
         #     k: v.requires_grad for (k, v) in model_no_ddp.named_parameters()
         # }
-        state_dict = model_no_ddp.state_dict()
+        state_dict, optimizer_state_dict = self.checkpoint_state_dicts()
         # for k in list(state_dict.keys()):
         #     if k in param_grad_dic.keys() and not param_grad_dic[k]:
         #         # delete parameters that do not require gradient
         #         del state_dict[k]
         save_obj = {
             "model": state_dict,
-            "optimizer": self.optimizer.state_dict(),
+            "optimizer": optimizer_state_dict,
             "config": self.config.to_dict(),
             "scaler": self.scaler.state_dict() if self.scaler else None,
             "epoch": cur_epoch,
@@ -657,11 +1130,9 @@ class RunnerBase:
         else:
             raise RuntimeError("checkpoint url or path is invalid")
 
-        state_dict = checkpoint["model"]
+        self.load_checkpoint_state_dicts(checkpoint)
         model = self.unwrap_dist_model(self.model)
-        model.load_state_dict(state_dict)
 
-        self.optimizer.load_state_dict(checkpoint["optimizer"])
         if self.scaler and "scaler" in checkpoint:
             self.scaler.load_state_dict(checkpoint["scaler"])
 
@@ -75,16 +75,21 @@ class RunnerIter(RunnerBase):
         best_iters = 0
 
         self.log_config()
+        self.setup_profiling()
 
         # resume from checkpoint if specified
         if not self.evaluate_only and self.resume_ckpt_path is not None:
             print("Resume from checkpoint: {}".format(self.resume_ckpt_path))
             self._load_checkpoint(self.resume_ckpt_path)
 
+        # a mid-epoch checkpoint resumes inside its inner epoch
+        first_start_iters = self.start_iters - self.start_iters % self.iters_per_inner_epoch
+
         for start_iters in range(
-            self.start_iters, self.max_iters, self.iters_per_inner_epoch
+            first_start_iters, self.max_iters, self.iters_per_inner_epoch
         ):
             end_iters = start_iters + self.iters_per_inner_epoch
+            start_step = max(self.start_iters - start_iters, 0)
 
             # training phase
             if not self.evaluate_only:
@@ -94,8 +99,9 @@ class RunnerIter(RunnerBase):
                     )
                 )
 
-                train_stats = self.train_iters(self.cur_epoch, start_iters)
+                train_stats = self.train_iters(self.cur_epoch, start_iters, start_step)
                 self.log_stats(split_name="train", stats=train_stats)
+                self.gather_checkpoint_state()
 
             # evaluation phase
             if len(self.valid_splits) > 0:
@@ -125,11 +131,17 @@ class RunnerIter(RunnerBase):
                 if not self.evaluate_only:
                     self._save_checkpoint(end_iters, is_best=False)
 
+            self.clear_gathered_state()
+
             if self.evaluate_only:
                 break
             if is_dist_avail_and_initialized():
                 dist.barrier()
         
+        self.close_metric_writer()
+        self.stop_profiler()
+        self.log_stage_report("train")
+
         # testing phase
         self.evaluate(cur_epoch=self.cur_epoch)
 
@@ -137,13 +149,36 @@ class RunnerIter(RunnerBase):
         total_time_str = str(datetime.timedelta(seconds=int(total_time)))
         logging.info("Training time {}".format(total_time_str))
 
-    def train_iters(self, epoch, start_iters):
+    @property
+    def checkpoint_freq(self):
+        """
+        Save a resumable checkpoint every #checkpoint_freq iterations inside an
+        inner epoch (0 to disable). Checkpoints are taken after optimizer steps,
+        so checkpoint_freq has to be a multiple of accum_grad_iters.
+        """
+        checkpoint_freq = int(self.config.run_cfg.get("checkpoint_freq", 0))
+        assert checkpoint_freq % self.accum_grad_iters == 0, (
+            "checkpoint_freq ({}) must be a multiple of accum_grad_iters ({}), "
+            "otherwise no mid-epoch checkpoint is saved.".format(checkpoint_freq, self.accum_grad_iters)
+        )
+        return checkpoint_freq
+
+    def _save_mid_epoch_checkpoint(self, cur_iters):
+        # called on all ranks
+        self.gather_checkpoint_state()
+        self._save_checkpoint(cur_iters, is_latest=True)
+        self.clear_gathered_state()
+
+    def train_iters(self, epoch, start_iters, start_step=0):
         # train by iterations
         self.model.train()
 
         return self.task.train_iters(
             epoch=epoch,
             start_iters=start_iters,
+            start_step=start_step,
+            checkpoint_fn=lambda step: self._save_mid_epoch_checkpoint(start_iters + step),
+            checkpoint_freq=self.checkpoint_freq,
             iters_per_inner_epoch=self.iters_per_inner_epoch,
             model=self.model,
             data_loader=self.train_loader,
@@ -153,21 +188,28 @@ class RunnerIter(RunnerBase):
             cuda_enabled=self.cuda_enabled,
             log_freq=self.log_freq,
             accum_grad_iters=self.accum_grad_iters,
+            metric_writer=self.metric_writer,
+            profiler=self._profiler,
         )
 
     @main_process
-    def _save_checkpoint(self, cur_iters, is_best=False):
+    def _save_checkpoint(self, cur_iters, is_best=False, is_latest=False):
+        state_dict, optimizer_state_dict = self.checkpoint_state_dicts()
         save_obj = {
-            "model": self.unwrap_dist_model(self.model).state_dict(),
-            "optimizer": self.optimizer.state_dict(),
+            "model": state_dict,
+            "optimizer": optimizer_state_dict,
             "config": self.config.to_dict(),
             "scaler": self.scaler.state_dict() if self.scaler else None,
             "iters": cur_iters,
+            "resume_states": self._gathered_resume_states,
         }
-        save_to = os.path.join(
-            self.output_dir,
-            "checkpoint_{}.pth".format("best" if is_best else cur_iters),
-        )
+        if is_best:
+            name = "best"
+        elif is_latest:
+            name = "latest"
+        else:
+            name = cur_iters
+        save_to = os.path.join(self.output_dir, "checkpoint_{}.pth".format(name))
         logging.info("Saving checkpoint at iters {} to {}.".format(cur_iters, save_to))
         torch.save(save_obj, save_to)
         
@@ -186,14 +228,14 @@ class RunnerIter(RunnerBase):
         else:
             raise RuntimeError("checkpoint url or path is invalid")
 
-        state_dict = checkpoint["model"]
-        self.unwrap_dist_model(self.model).load_state_dict(state_dict)
-
-        self.optimizer.load_state_dict(checkpoint["optimizer"])
+        self.load_checkpoint_state_dicts(checkpoint)
         if self.scaler and "scaler" in checkpoint:
             self.scaler.load_state_dict(checkpoint["scaler"])
 
-        self.start_iters = checkpoint["iters"] + 1
+        # "iters" is the number of finished iterations
+        self.start_iters = checkpoint["iters"]
+        if checkpoint.get("resume_states") is not None:
+            self.load_resume_state(checkpoint["resume_states"])
         logging.info("Resume checkpoint from {}".format(url_or_filename))
 
     @property
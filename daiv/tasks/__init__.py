@@ -5,10 +5,27 @@
  For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
 """
 
-from daiv.common.registry import registry
-from daiv.tasks.base_task import BaseTask
-from daiv.tasks.image_text_pretrain import ImageTextPretrainTask
-from daiv.tasks.vqa import VQATask
+from daiv.common.registry import lazy_getattr, registry
+
+# task modules are imported when a task is first used, see Registry.register_lazy
+_TASK_MODULES = {
+    "image_text_pretrain": "daiv.tasks.image_text_pretrain",
+    "vqa": "daiv.tasks.vqa",
+    "aok_vqa": "daiv.tasks.vqa",
+    "gqa": "daiv.tasks.vqa",
+    "discrn_qa": "daiv.tasks.vqa",
+}
+for _name, _module in _TASK_MODULES.items():
+    registry.register_lazy("task", _name, _module)
+
+__getattr__ = lazy_getattr(
+    __name__,
+    {
+        "BaseTask": "daiv.tasks.base_task",
+        "ImageTextPretrainTask": "daiv.tasks.image_text_pretrain",
+        "VQATask": "daiv.tasks.vqa",
+    },
+)
 
 
 def setup_task(cfg):
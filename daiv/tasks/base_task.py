@@ -5,16 +5,22 @@
  For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
 """
 
+import contextlib
 import logging
 import os
+from concurrent.futures import Future
 
 import torch
 import torch.distributed as dist
 from daiv.common.dist_utils import get_rank, get_world_size, is_main_process, is_dist_avail_and_initialized
 from daiv.common.logger import MetricLogger, SmoothedValue
+from daiv.common.metrics import DeviceMetricAccumulator
 from daiv.common.registry import registry
 from daiv.datasets.data_utils import prepare_sample
-import wandb
+from daiv.datasets.datasets.dataloader_utils import LengthGroupedBatchSampler
+
+# dataset index of a result, set by length-grouped evaluation
+EVAL_INDEX_KEY = "_eval_index"
 
 
 class BaseTask:
@@ -83,25 +89,77 @@ class BaseTask:
     def inference_step(self):
         raise NotImplementedError
 
-    def evaluation(self, model, data_loader, cuda_enabled=True):
+    def evaluation(self, model, data_loader, cuda_enabled=True, journal=None):
+        """
+        Run valid_step() over data_loader. Results of every batch are appended to
+        ``journal`` (an EvalJournal) as soon as they are computed. valid_step()
+        may return a Future of its results to overlap post-processing with the
+        next batch.
+        """
         metric_logger = MetricLogger(delimiter="  ")
         header = "Evaluation"
         # TODO make it configurable
         print_freq = 10
 
         results = []
+        pending = None
+
+        def collect(eval_output):
+            results.extend(eval_output)
+
+            if journal is not None:
+                journal.write(eval_output)
 
         for samples in metric_logger.log_every(data_loader, print_freq, header):
             samples = prepare_sample(samples, cuda_enabled=cuda_enabled)
 
             eval_output = self.valid_step(model=model, samples=samples)
-            results.extend(eval_output)
+
+            # valid_step() may return a future (e.g. answers lemmatized in a worker
+            # process), it is resolved once the next batch has run
+            if pending is not None:
+                collect(pending.result())
+                pending = None
+
+            if isinstance(eval_output, Future):
+                pending = eval_output
+            else:
+                collect(eval_output)
+
+        if pending is not None:
+            collect(pending.result())
+
+        if journal is not None:
+            journal.close()
+
+        results = self._tag_dataset_order(results, data_loader)
 
         if is_dist_avail_and_initialized():
             dist.barrier()
 
         return results
 
+    @staticmethod
+    def _tag_dataset_order(results, data_loader):
+        """
+        With length-grouped evaluation batches, record the dataset index of every
+        result under EVAL_INDEX_KEY, so that save_result() can restore the dataset
+        order across ranks.
+        """
+        loader = getattr(data_loader, "loader", data_loader)
+        batch_sampler = getattr(loader, "batch_sampler", None)
+        if not isinstance(batch_sampler, LengthGroupedBatchSampler):
+            return results
+
+        indices = batch_sampler.indices
+        if len(indices) != len(results) or not all(isinstance(r, dict) for r in results):
+            logging.warning("Results do not match the evaluation samples one to one, keep batch order.")
+            return results
+
+        for index, res in zip(indices, results):
+            res[EVAL_INDEX_KEY] = index
+        return sorted(results, key=lambda res: res[EVAL_INDEX_KEY])
+
     def train_epoch(
         self,
         epoch,
@@ -113,6 +171,8 @@ class BaseTask:
         cuda_enabled=False,
         log_freq=50,
         accum_grad_iters=1,
+        metric_writer=None,
+        profiler=None,
     ):
         return self._train_inner_loop(
             epoch=epoch,
@@ -125,6 +185,8 @@ class BaseTask:
             log_freq=log_freq,
             cuda_enabled=cuda_enabled,
             accum_grad_iters=accum_grad_iters,
+            metric_writer=metric_writer,
+            profiler=profiler,
         )
         
     def train_iters(
@@ -140,10 +202,18 @@ class BaseTask:
         cuda_enabled=False,
         log_freq=50,
         accum_grad_iters=1,
+        metric_writer=None,
+        start_step=0,
+        checkpoint_fn=None,
+        checkpoint_freq=0,
+        profiler=None,
     ):
         return self._train_inner_loop(
             epoch=epoch,
             start_iters=start_iters,
+            start_step=start_step,
+            checkpoint_fn=checkpoint_fn,
+            checkpoint_freq=checkpoint_freq,
             iters_per_epoch=iters_per_inner_epoch,
             model=model,
             data_loader=data_loader,
@@ -153,6 +223,8 @@ class BaseTask:
             log_freq=log_freq,
             cuda_enabled=cuda_enabled,
             accum_grad_iters=accum_grad_iters,
+            metric_writer=metric_writer,
+            profiler=profiler,
         )
 
     def _train_inner_loop(
@@ -168,12 +240,27 @@ class BaseTask:
         log_freq=50,
         cuda_enabled=False,
         accum_grad_iters=1,
+        metric_writer=None,
+        start_step=0,
+        checkpoint_fn=None,
+        checkpoint_freq=0,
+        profiler=None,
     ):
         """
         An inner training loop compatible with both epoch-based and iter-based training.
 
         When using epoch-based, training stops after one epoch; when using iter-based,
         training stops after #iters_per_epoch iterations.
+
+        Losses are accumulated on device and averaged across ranks every log_freq
+        iterations only; the averaged records are handed to ``metric_writer``
+        (an AsyncMetricWriter, main process only) instead of being logged per step.
+
+        A resumed inner epoch starts at iteration ``start_step``. ``checkpoint_fn(step)``
+        is called on all ranks after every optimizer step that completes a multiple of
+        ``checkpoint_freq`` iterations, to save mid-epoch checkpoints.
+
+        ``profiler`` (a torch.profiler.profile) is stepped once per iteration.
         """
         use_amp = scaler is not None
 
@@ -184,6 +271,7 @@ class BaseTask:
         metric_logger = MetricLogger(delimiter="  ")
         metric_logger.add_meter("lr", SmoothedValue(window_size=1, fmt="{value:.6f}"))
         metric_logger.add_meter("loss", SmoothedValue(window_size=1, fmt="{value:.4f}"))
+        loss_accumulator = DeviceMetricAccumulator()
 
         # if iter-based runner, schedule lr based on inner epoch.
         logging.info(
@@ -200,7 +288,7 @@ class BaseTask:
             inner_epoch = start_iters // iters_per_epoch
             header = header + "; inner epoch [{}]".format(inner_epoch)
 
-        for i in metric_logger.log_every(range(iters_per_epoch), log_freq, header):
+        for i in metric_logger.log_every(range(start_step, iters_per_epoch), log_freq, header):
             # if using iter-based runner, we stop after iters_per_epoch iterations.
             
             if i >= iters_per_epoch:
@@ -216,27 +304,32 @@ class BaseTask:
                     "iters": i,
                 }
             )
-            
-            logging.info(str({
-                    "epoch": inner_epoch,
-                    "num_iters_per_epoch": iters_per_epoch,
-                    "iters": i,
-                }))
 
             lr_scheduler.step(cur_epoch=inner_epoch, cur_step=i)
 
-            with torch.cuda.amp.autocast(enabled=use_amp):
-                loss, loss_dict = self.train_step(model=model, samples=samples)
-                loss /= accum_grad_iters #TODO: not affect loss_dict values for logging
+            # update gradients every accum_grad_iters iterations
+            is_update_step = (i + 1) % accum_grad_iters == 0
 
-            # after_train_step()
-            if use_amp:
-                scaler.scale(loss).backward()
+            # skip the DDP gradient all-reduce on micro-steps that do not update
+            if not is_update_step and hasattr(model, "no_sync"):
+                sync_context = model.no_sync()
             else:
-                loss.backward()
+                sync_context = contextlib.nullcontext()
 
-            # update gradients every accum_grad_iters iterations
-            if (i + 1) % accum_grad_iters == 0:
+            with sync_context:
+                with torch.cuda.amp.autocast(enabled=use_amp):
+                    loss, loss_dict = self.train_step(model=model, samples=samples)
+
+                # scale once for accumulation, loss_dict keeps the unscaled values
+                loss = loss / accum_grad_iters
+
+                # after_train_step()
+                if use_amp:
+                    scaler.scale(loss).backward()
+                else:
+                    loss.backward()
+
+            if is_update_step:
                 if use_amp:
                     scaler.step(optimizer)
                     scaler.update()                     
@@ -244,32 +337,31 @@ class BaseTask:
                     optimizer.step()
                 optimizer.zero_grad()
 
-            # if is_dist_avail_and_initialized():
-            #     # if dist.get_rank() == 0:
-            #     #     loss_clone = loss.clone().detach().requires_grad_(False)
-            #     #     dist.all_reduce(loss_clone) 
-            #     #     loss_clone.div_(dist.get_world_size())  
-                    
-            #     #     wandb.log({"loss": loss_clone.item()})
-                    
-            #     #     logging.info(str({'step_loss':  str(loss_clone.cpu().detach().numpy())}))
-                
-            if is_dist_avail_and_initialized():
-                loss_clone = loss.clone().detach().requires_grad_(False)
-                dist.all_reduce(loss_clone) 
-                loss_clone.div_(dist.get_world_size())  
-
-                if dist.get_rank() == 0: 
-                    wandb.log({"loss": loss_clone.item()})
-                    logging.info(str({'step_loss':  str(loss_clone.cpu().detach().numpy())}))
+                if (
+                    checkpoint_fn is not None
+                    and checkpoint_freq > 0
+                    and (i + 1) % checkpoint_freq == 0
+                    and i + 1 < iters_per_epoch
+                ):
+                    checkpoint_fn(i + 1)
 
-            else:
-                wandb.log({"loss": loss.item()})
-                logging.info(str({'step_loss':  str(loss.cpu().detach().numpy())}))
-            
-            
-            metric_logger.update(**loss_dict)
-            metric_logger.update(lr=optimizer.param_groups[0]["lr"])
+            loss_accumulator.update(**loss_dict)
+
+            # reduce on the iterations printed by metric_logger.log_every
+            if (i - start_step) % log_freq == 0 or i == iters_per_epoch - 1:
+                loss_stats = loss_accumulator.reduce()
+                lr = optimizer.param_groups[0]["lr"]
+
+                metric_logger.update(**loss_stats)
+                metric_logger.update(lr=lr)
+
+                if metric_writer is not None:
+                    metric_writer.write(
+                        {"epoch": inner_epoch, "iters": i, "lr": lr, **loss_stats}
+                    )
+
+            if profiler is not None:
+                profiler.step()
 
         # after train_epoch()
         # gather the stats from all processes
@@ -306,6 +398,17 @@ class BaseTask:
                 res = json.load(open(result_file, "r"))
                 result += res
 
+            tagged = [isinstance(res, dict) and EVAL_INDEX_KEY in res for res in result]
+            if len(result) > 0 and all(tagged):
+                # length-grouped evaluation, back to dataset order
+                result = sorted(result, key=lambda res: res[EVAL_INDEX_KEY])
+            elif any(tagged):
+                # a rank fell back to batch order, see _tag_dataset_order()
+                logging.warning("Results of some ranks are not tagged with their dataset order, keeping rank order.")
+            for res in result:
+                if isinstance(res, dict):
+                    res.pop(EVAL_INDEX_KEY, None)
+
             if remove_duplicate:
                 result_new = []
                 id_list = []
@@ -14,5 +14,5 @@ class ImageTextPretrainTask(BaseTask):
     def __init__(self):
         super().__init__()
 
-    def evaluation(self, model, data_loader, cuda_enabled=True):
+    def evaluation(self, model, data_loader, cuda_enabled=True, journal=None):
         pass
@@ -11,6 +11,7 @@ import os
 import torch
 from tqdm import tqdm
 
+from daiv.common.lemmatizer import Lemmatizer, get_lemmatizer, map_future, set_lemmatizer
 from daiv.common.utils import is_convertible_to_int
 import daiv.common.dist_utils as dist_utils
 from daiv.common.registry import registry
@@ -28,7 +29,7 @@ class VQATask(BaseTask):
         min_len,
         evaluate,
         num_ans_candidates,
-        inference_method="rank",
+        inference_method="generate",
         prompt="",
         sample_id_key = "",
         ques_files=dict(),
@@ -66,7 +67,8 @@ class VQATask(BaseTask):
 
         evaluate = run_cfg.get("evaluate", False)
 
-        inference_method = run_cfg.get("inference_method", "rank")
+        # "generate" for open-ended answers, "constrained" or "rank" to decode from answer_list
+        inference_method = run_cfg.get("inference_method", "generate")
         num_ans_candidates = run_cfg.get("num_ans_candidates", 128)
 
         prompt = run_cfg.get("prompt", "")
@@ -77,6 +79,15 @@ class VQATask(BaseTask):
         anno_files = run_cfg.get("anno_files", dict())
         valid_splits = run_cfg.get("valid_splits", ["val"])
 
+        # answer lemmatization (apply_lemmatizer): with workers > 0 a batch is
+        # lemmatized in a worker process while the next batch is generated
+        set_lemmatizer(
+            Lemmatizer(
+                batch_size=run_cfg.get("lemmatizer_batch_size", 256),
+                cache_size=run_cfg.get("lemmatizer_cache_size", 65536),
+                num_workers=run_cfg.get("lemmatizer_workers", 0),
+            )
+        )
 
         return cls(
             num_beams=num_beams,
@@ -130,19 +141,32 @@ class VQATask(BaseTask):
         return datasets
 
     def valid_step(self, model, samples):
-        answers = model.predict_answers(
-            samples=samples,
-            answer_list=self.answer_list,
-            # inference_method=self.inference_method,
-            # num_beams=self.num_beams,
-            # max_len=self.max_len,
-            # min_len=self.min_len,
-            num_ans_candidates=self.num_ans_candidates,
-            prompt=self.prompt,
-        )
-        pred_qa_pairs = []
+        lemmatizer = get_lemmatizer()
+        with lemmatizer.deferred() as deferred:
+            answers = model.predict_answers(
+                samples=samples,
+                answer_list=self.answer_list,
+                inference_method=self.inference_method,
+                # num_beams=self.num_beams,
+                # max_len=self.max_len,
+                # min_len=self.min_len,
+                num_ans_candidates=self.num_ans_candidates,
+                prompt=self.prompt,
+            )
 
         question_id = samples["question_id"]
+        if deferred.requested:
+            # resolved by evaluation() after the next batch is generated
+            return map_future(
+                lemmatizer.submit(answers),
+                lambda lemmas: self._pred_qa_pairs(lemmas, question_id),
+            )
+
+        return self._pred_qa_pairs(answers, question_id)
+
+    def _pred_qa_pairs(self, answers, question_id):
+        pred_qa_pairs = []
+
         for answer, ques_id in zip(answers, question_id):
             ques_id = int(ques_id.item()) if isinstance(ques_id, torch.Tensor) else ques_id
             if ques_id != int and is_convertible_to_int(ques_id):
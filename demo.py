@@ -12,10 +12,6 @@ from daiv.common.dist_utils import get_rank
 from daiv.common.registry import registry
 from daiv.conversation.conversation import Chat, CONV_VISION, CONV_DIRECT
 
-# imports modules for registration
-
-from daiv.models import *
-from daiv.processors import *
 from daiv.models import load_model_and_preprocess
 from evaluate import disable_torch_init
 
@@ -0,0 +1,139 @@
+"""
+ Copyright (c) 2022, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+
+import daiv.tasks as tasks
+from daiv.common.config import Config
+from daiv.common.dist_utils import init_distributed_mode, is_main_process
+from daiv.common.logger import setup_logger
+from daiv.common.registry import registry
+from daiv.common.utils import now
+from daiv.models.token_reducer import TOKEN_REDUCERS, build_token_reducer
+from daiv.runners.runner_base import RunnerBase
+from evaluate import setup_seeds
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Accuracy against LLM prefix length")
+
+    parser.add_argument("--cfg-path", required=True, help="path to configuration file.")
+    parser.add_argument(
+        "--num-tokens",
+        nargs="+",
+        type=int,
+        default=None,
+        help="patch tokens kept for each evaluation, e.g. 256 144 64 16. "
+        "Without it the model is evaluated once with the reducer of its config.",
+    )
+    parser.add_argument(
+        "--reducer",
+        default="pool",
+        choices=list(TOKEN_REDUCERS),
+        help="reducer used for --num-tokens; learned reducers are only meaningful "
+        "with weights trained for the same number of tokens.",
+    )
+    parser.add_argument("--output", default=None, help="json file to write the report to.")
+    parser.add_argument(
+        "--options",
+        nargs="+",
+        help="override some settings in the used config, the key-value pair "
+        "in xxx=yyy format will be merged into config file (deprecate), "
+        "change to --cfg-options instead.",
+    )
+
+    return parser.parse_args()
+
+
+def log_report(rows):
+    lines = ["{:>8s} {:>8s} {:>10s} {:>12s}  {}".format("tokens", "prefix", "eval s", "agg_metrics", "split")]
+    for row in rows:
+        for split, metrics in row["metrics"].items():
+            agg = (metrics or {}).get("agg_metrics", float("nan"))
+            lines.append(
+                "{:8d} {:8d} {:10.1f} {:12.4f}  {}".format(
+                    row["num_tokens"], row["prefix_tokens"], row["eval_s"], agg, split
+                )
+            )
+    logging.info("\n" + "\n".join(lines))
+
+
+def main():
+    """
+    Evaluate one model with several visual token budgets and report the
+    metrics of every test split against the length of the visual LLM prefix
+    (query tokens + patch tokens). The model is built once, only its
+    token reducer changes between evaluations.
+    """
+    args = parse_args()
+    job_id = now()
+
+    cfg = Config(args)
+
+    init_distributed_mode(cfg.run_cfg)
+    setup_seeds(cfg)
+    setup_logger()
+
+    task = tasks.setup_task(cfg)
+    datasets = task.build_datasets(cfg)
+    model = task.build_model(cfg)
+
+    runner = RunnerBase(cfg=cfg, job_id=job_id, task=task, model=model, datasets=datasets)
+
+    num_patches = model.visual_encoder.patch_embed.num_patches
+    num_queries = model.query_tokens.size(1)
+    dim = model.visual_encoder.num_features
+
+    if args.num_tokens is None:
+        reducer = model.token_reducer
+        reducer_name = type(reducer).__name__ if reducer is not None else None
+        settings = [reducer.num_tokens if reducer is not None else num_patches]
+    else:
+        reducer_name = args.reducer
+        settings = args.num_tokens
+
+    rows = []
+    for num_tokens in settings:
+        if args.num_tokens is not None:
+            model.token_reducer = (
+                build_token_reducer({"type": args.reducer, "num_tokens": num_tokens}, dim)
+                if num_tokens < num_patches
+                else None
+            )
+            if model.token_reducer is not None:
+                model.token_reducer.to(model.device)
+        num_tokens = min(num_tokens, num_patches)
+
+        logging.info("Evaluating with {} patch tokens.".format(num_tokens))
+        start = time.time()
+        metrics = runner.evaluate(cur_epoch="tokens{}".format(num_tokens), skip_reload=True)
+        rows.append(
+            {
+                "num_tokens": num_tokens,
+                "prefix_tokens": num_queries + num_tokens,
+                "eval_s": time.time() - start,
+                "metrics": metrics or {},
+            }
+        )
+
+    if is_main_process():
+        log_report(rows)
+
+        output = args.output or os.path.join(
+            registry.get_path("output_dir"), "token_reduction_{}.json".format(job_id)
+        )
+        with open(output, "w") as f:
+            json.dump({"reducer": reducer_name, "results": rows}, f, indent=2)
+        logging.info("Report written to {}".format(output))
+
+
+if __name__ == "__main__":
+    main()
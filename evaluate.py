@@ -22,12 +22,7 @@ from daiv.common.optims import (
 )
 from daiv.common.utils import now
 
-# imports modules for registration
-from daiv.datasets.builders import *
-from daiv.models import *
-from daiv.processors import *
 from daiv.runners.runner_base import RunnerBase
-from daiv.tasks import *
 
 
 def parse_args():
@@ -0,0 +1,106 @@
+"""
+ Copyright (c) 2022, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+"""
+
+import argparse
+import logging
+
+import torch
+from omegaconf import OmegaConf
+
+import daiv.tasks as tasks
+from daiv.common.config import Config
+from daiv.common.logger import setup_logger
+from daiv.common.registry import registry
+from daiv.models import load_preprocess
+from daiv.models.embedding_export import (
+    ImageTextFileDataset,
+    dataset_ids,
+    export_embeddings,
+    list_image_files,
+    read_jsonl_records,
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Embedding export")
+
+    parser.add_argument("--cfg-path", required=True, help="path to configuration file.")
+    parser.add_argument("--output-dir", required=True, help="directory of the embedding index.")
+    parser.add_argument("--mode", default="image", choices=["image", "text", "multimodal"])
+
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--dataset", help="name of a dataset of the config.")
+    source.add_argument("--image-dir", help="directory of images, exported with their relative path as id.")
+    source.add_argument("--jsonl", help='JSONL file of {"id", "image", "text"} records.')
+
+    parser.add_argument("--split", default="train", help="split of --dataset.")
+    parser.add_argument(
+        "--id-key",
+        default=None,
+        help="annotation field used as id of --dataset rows (the row index by default).",
+    )
+    parser.add_argument("--image-root", default=None, help="root of the image paths of --jsonl.")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--num-workers", type=int, default=8)
+    parser.add_argument("--shard-size", type=int, default=16384)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument(
+        "--options",
+        nargs="+",
+        help="override some settings in the used config, the key-value pair "
+        "in xxx=yyy format will be merged into config file (deprecate), "
+        "change to --cfg-options instead.",
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    """
+    Export the embeddings of a dataset, an image directory or a JSONL file to
+    an EmbeddingIndex in --output-dir. Rerun the same command to resume an
+    interrupted export. Read the index with daiv.models.retrieval.EmbeddingIndex,
+    e.g. chunked_topk(index, index, k=2) for near-duplicates.
+    """
+    args = parse_args()
+
+    cfg = Config(args)
+    setup_logger()
+
+    task = tasks.setup_task(cfg)
+    model = task.build_model(cfg).to(args.device).eval()
+
+    if args.dataset is not None:
+        dataset = task.build_datasets(cfg)[args.dataset][args.split]
+        ids = dataset_ids(dataset, args.id_key)
+    else:
+        model_cls = registry.get_model_class(cfg.model_cfg.arch)
+        preprocess_cfg = OmegaConf.load(model_cls.default_config_path(cfg.model_cfg.model_type)).preprocess
+        vis_processors, txt_processors = load_preprocess(preprocess_cfg)
+
+        if args.image_dir is not None:
+            records = list_image_files(args.image_dir)
+        else:
+            records = read_jsonl_records(args.jsonl, args.image_root)
+        dataset = ImageTextFileDataset(records, vis_processors["eval"], txt_processors["eval"], mode=args.mode)
+        ids = [record["id"] for record in records]
+
+    index = export_embeddings(
+        model,
+        dataset,
+        ids,
+        args.output_dir,
+        mode=args.mode,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        shard_size=args.shard_size,
+    )
+    logging.info("{} embeddings in {}".format(len(index), args.output_dir))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+ Copyright (c) 2022, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+"""
+
+import argparse
+import logging
+import os
+
+import daiv.tasks as tasks
+from daiv.common.config import Config
+from daiv.common.logger import setup_logger
+from daiv.models.image_encoder_export import (
+    check_exported_image_encoder,
+    export_image_encoder,
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Image encoder export")
+
+    parser.add_argument("--cfg-path", required=True, help="path to configuration file.")
+    parser.add_argument("--output", required=True, help="path of the exported model.")
+    parser.add_argument(
+        "--format", default="torchscript", choices=["torchscript", "onnx"]
+    )
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument(
+        "--dynamic-batch", action="store_true", help="export with a dynamic batch size."
+    )
+    parser.add_argument("--opset-version", type=int, default=14)
+    parser.add_argument(
+        "--options",
+        nargs="+",
+        help="override some settings in the used config, the key-value pair "
+        "in xxx=yyy format will be merged into config file (deprecate), "
+        "change to --cfg-options instead.",
+    )
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+    """
+    Export the image-encoding stage (ViT, Q-Former and projections) of a config's
+    model for serving with ImageEncoderRuntime, and check it against the eager model.
+    """
+    args = parse_args()
+
+    cfg = Config(args)
+    setup_logger()
+
+    task = tasks.setup_task(cfg)
+    model = task.build_model(cfg).float().eval()
+
+    output_dir = os.path.dirname(os.path.abspath(args.output))
+    os.makedirs(output_dir, exist_ok=True)
+
+    stage, inputs = export_image_encoder(
+        model,
+        args.output,
+        export_format=args.format,
+        batch_size=args.batch_size,
+        dynamic_batch=args.dynamic_batch,
+        opset_version=args.opset_version,
+    )
+
+    max_diff = check_exported_image_encoder(stage, inputs, args.output)
+    logging.info("Max abs difference against the eager model: {}".format(max_diff))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+ Copyright (c) 2022, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+"""
+
+import argparse
+import json
+
+from daiv.common.import_report import (
+    config_import_statement,
+    log_import_summary,
+    measure_imports,
+    summarize_imports,
+)
+from daiv.common.logger import setup_logger
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Import time report")
+
+    parser.add_argument(
+        "--modules",
+        nargs="+",
+        default=["daiv"],
+        help="modules to import, e.g. daiv daiv.models.bliva_vicuna7b",
+    )
+    parser.add_argument(
+        "--cfg-path",
+        default=None,
+        help="import what the model, datasets, task and runner of this config need instead.",
+    )
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--output", default=None, help="json file to write the summary to.")
+
+    return parser.parse_args()
+
+
+def main():
+    """
+    Report where the startup time of a CLI goes, measured with
+    ``python -X importtime`` in a fresh interpreter.
+    """
+    args = parse_args()
+    setup_logger()
+
+    if args.cfg_path is not None:
+        statement = config_import_statement(args.cfg_path)
+    else:
+        statement = "\n".join("import {}".format(module) for module in args.modules)
+
+    records, wall_s = measure_imports(statement)
+    summary = summarize_imports(records, top=args.top)
+    log_import_summary(summary, wall_s=wall_s)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(dict(summary, wall_ms=wall_s * 1000), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+ Copyright (c) 2022, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+"""
+
+import argparse
+import logging
+import os
+
+import torch
+
+import daiv.tasks as tasks
+from daiv.common.config import Config
+from daiv.common.logger import setup_logger
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Merge a LoRA adapter into Vicuna")
+
+    parser.add_argument("--cfg-path", required=True, help="path to configuration file.")
+    parser.add_argument("--output-dir", required=True, help="where the merged model is saved.")
+    parser.add_argument(
+        "--adapter",
+        default=None,
+        help="multi_lora adapter to merge, a name from the config or a path; required "
+        "with multi_lora. Without multi_lora the peft adapter of the checkpoint is merged.",
+    )
+    parser.add_argument(
+        "--options",
+        nargs="+",
+        help="override some settings in the used config, the key-value pair "
+        "in xxx=yyy format will be merged into config file (deprecate), "
+        "change to --cfg-options instead.",
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    """
+    Export a bliva_vicuna_lora model for single-adapter deployment: the
+    adapter is merged into the Vicuna weights, saved with its tokenizer under
+    <output-dir>/llm, and the other BLIVA weights are saved to
+    <output-dir>/bliva.pth. Serve it as bliva_vicuna with
+    llm_model: <output-dir>/llm and finetuned: <output-dir>/bliva.pth.
+    """
+    args = parse_args()
+
+    cfg = Config(args)
+    setup_logger()
+
+    task = tasks.setup_task(cfg)
+    model = task.build_model(cfg).eval()
+
+    adapter = args.adapter
+    if model.adapter_pool is not None and adapter is None:
+        raise ValueError("--adapter is required with multi_lora, merging nothing would save the bare LLM.")
+    if adapter is not None and model.adapter_pool is not None and os.path.exists(adapter):
+        model.adapter_pool.register(os.path.basename(adapter.rstrip("/")), adapter)
+        adapter = os.path.basename(adapter.rstrip("/"))
+
+    model.merge_and_unload(adapter)
+
+    llm_dir = os.path.join(args.output_dir, "llm")
+    os.makedirs(llm_dir, exist_ok=True)
+    model.llm_model.save_pretrained(llm_dir)
+    model.llm_tokenizer.save_pretrained(llm_dir)
+
+    state_dict = {k: v for k, v in model.state_dict().items() if not k.startswith("llm_model.")}
+    torch.save({"model": state_dict}, os.path.join(args.output_dir, "bliva.pth"))
+
+    logging.info("Merged model saved to {}".format(args.output_dir))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+ Copyright (c) 2022, salesforce.com, inc.
+ All rights reserved.
+ SPDX-License-Identifier: BSD-3-Clause
+ For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
+"""
+
+import argparse
+import copy
+import json
+import os
+
+from omegaconf import OmegaConf
+
+import daiv.tasks as tasks
+from daiv.common.config import Config
+from daiv.common.logger import setup_logger
+from daiv.common.utils import now
+from daiv.models.quantization import (
+    quantization_report,
+    quantize_model,
+    save_quantized_checkpoint,
+)
+
+from daiv.runners.runner_base import RunnerBase
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Quantization")
+
+    parser.add_argument("--cfg-path", required=True, help="path to configuration file.")
+    parser.add_argument("--bits", type=int, default=8, help="weight bits, 8 or 4.")
+    parser.add_argument(
+        "--group-size", type=int, default=-1, help="-1 for per-channel quantization."
+    )
+    parser.add_argument(
+        "--modules", nargs="+", default=None, help="submodules to quantize."
+    )
+    parser.add_argument(
+        "--num-batches", type=int, default=10, help="batches used for the report."
+    )
+    parser.add_argument(
+        "--options",
+        nargs="+",
+        help="override some settings in the used config, the key-value pair "
+        "in xxx=yyy format will be merged into config file (deprecate), "
+        "change to --cfg-options instead.",
+    )
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+    """
+    Quantize the model of a config, save the quantized checkpoint and report
+    latency and agreement against the fp32 model on the first test split.
+    """
+    job_id = now()
+    args = parse_args()
+
+    cfg = Config(args)
+    setup_logger()
+
+    # the full-precision model is the reference, the quantization section only gives the defaults
+    model_quantization_cfg = cfg.model_cfg.pop("quantization", None) or {}
+
+    task = tasks.setup_task(cfg)
+    datasets = task.build_datasets(cfg)
+    model = task.build_model(cfg).float().eval()
+
+    quantization_cfg = OmegaConf.create({"bits": args.bits, "group_size": args.group_size})
+    modules = args.modules or model_quantization_cfg.get("modules", None)
+    if modules is not None:
+        quantization_cfg.modules = list(modules)
+
+    quantized_model = quantize_model(copy.deepcopy(model), quantization_cfg)
+
+    runner = RunnerBase(
+        cfg=cfg, job_id=job_id, task=task, model=model, datasets=datasets
+    )
+
+    save_to = os.path.join(runner.output_dir, "checkpoint_int{}.pth".format(args.bits))
+    save_quantized_checkpoint(quantized_model, save_to, quantization_cfg)
+
+    if len(runner.test_splits) > 0:
+        data_loader = runner.dataloaders[runner.test_splits[0]]
+        report = quantization_report(
+            model, quantized_model, data_loader, num_batches=args.num_batches
+        )
+        with open(os.path.join(runner.output_dir, "quantization_report.json"), "w") as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
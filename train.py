@@ -24,16 +24,8 @@ from daiv.common.optims import (
 from daiv.common.registry import registry
 from daiv.common.utils import now
 
-# imports modules for registration
-from daiv.datasets.builders import *
-from daiv.models import *
-from daiv.processors import *
-from daiv.runners import *
-from daiv.tasks import *
 import torch.distributed as dist
 
-import wandb
-
 def parse_args():
     parser = argparse.ArgumentParser(description="Training")
 
@@ -89,9 +81,6 @@ def main():
 
     init_distributed_mode(cfg.run_cfg)
     
-    if get_rank() == 0:
-        wandb.init(project="bliva")
-    
     setup_seeds(cfg)
 
     # set after init_distributed_mode() to only log on master.
@@ -108,8 +97,6 @@ def main():
         cfg=cfg, job_id=job_id, task=task, model=model, datasets=datasets
     )
     runner.train()
-
-    wandb.finish()
     
 if __name__ == "__main__":
     main()